@@ -0,0 +1,218 @@
+# gateway_usp/api/card_vault.py
+
+import frappe
+
+from ..utils.metrics import instrumented_job
+
+DOCTYPE = "USP Saved Card"
+
+# Clientes sincronizados por lote en el job diario
+SYNC_BATCH_SIZE = 200
+
+# Segundos sin volver a encolar la sincronización bajo demanda de un mismo cliente
+ON_DEMAND_SYNC_TTL = 600
+
+# Prefijos BIN de las marcas que acepta el gateway
+BRAND_PREFIXES = (
+    (("34", "37"), "Amex"),
+    (("4",), "Visa"),
+    (("51", "52", "53", "54", "55", "22", "23", "24", "25", "26", "27"), "Mastercard"),
+    (("6011", "65"), "Discover"),
+)
+
+
+def card_brand(card_number):
+    number = (card_number or "").replace(" ", "")
+    for prefixes, brand in BRAND_PREFIXES:
+        if number.startswith(prefixes):
+            return brand
+    return ""
+
+
+def get_customer_token(customer):
+    """Token del cliente en XpressPago guardado en Customer.usp_customer_token"""
+    if not customer:
+        return None
+    return frappe.db.get_value("Customer", customer, "usp_customer_token")
+
+
+def set_customer_token(customer, customer_token):
+    if customer and customer_token:
+        frappe.db.set_value("Customer", customer, "usp_customer_token", customer_token, update_modified=False)
+
+
+def get_cards(customer):
+    """Tarjetas activas del cliente desde la bóveda local (sin llamadas al gateway)"""
+    cards = frappe.get_all(
+        DOCTYPE,
+        filters={"customer": customer, "status": "Active"},
+        fields=["card_token", "last_four", "brand", "expiry_month", "expiry_year"],
+        order_by="modified desc"
+    )
+    return [
+        {
+            "token": card.card_token,
+            "last_four": card.last_four,
+            "brand": card.brand or "",
+            "expiry": f"{card.expiry_month}/{card.expiry_year}"
+        }
+        for card in cards
+    ]
+
+
+def has_cards(customer):
+    return bool(frappe.db.exists(DOCTYPE, {"customer": customer}))
+
+
+def upsert_card(customer, customer_token, card_token, last_four=None, brand=None,
+                expiry_month=None, expiry_year=None, cardholder_name=None, status="Active"):
+    """Crea o actualiza la tarjeta en la bóveda"""
+    values = {
+        "customer": customer,
+        "customer_token": customer_token,
+        "last_four": last_four,
+        "brand": brand,
+        "expiry_month": expiry_month,
+        "expiry_year": expiry_year,
+        "cardholder_name": cardholder_name,
+        "status": status,
+        "last_synced": frappe.utils.now()
+    }
+    if frappe.db.exists(DOCTYPE, card_token):
+        frappe.db.set_value(DOCTYPE, card_token, {k: v for k, v in values.items() if v is not None})
+    else:
+        frappe.get_doc(dict(values, doctype=DOCTYPE, card_token=card_token)).insert(ignore_permissions=True)
+
+
+def store_added_card(customer, customer_token, card_token, card_data):
+    """Registra en la bóveda la tarjeta recién agregada en el gateway"""
+    if not (customer and card_token):
+        return
+    number = (card_data.get("card_number") or "").replace(" ", "")
+    upsert_card(
+        customer,
+        customer_token,
+        card_token,
+        last_four=number[-4:],
+        brand=card_brand(number),
+        expiry_month=card_data.get("expiry_month"),
+        expiry_year=card_data.get("expiry_year"),
+        cardholder_name=card_data.get("cardholder_name")
+    )
+
+
+def _remote_customer(response):
+    """Token y tarjetas de la respuesta de CustomerManager.search_customer"""
+    if response.get("success") and response.get("data"):
+        response = response["data"]
+    elif not response.get("IsSuccess"):
+        return None, None
+    return response.get("CustomerToken"), response.get("CreditCards") or []
+
+
+def sync_customer_cards(customer, customer_manager=None):
+    """
+    Refresca la bóveda del cliente desde el gateway
+
+    La búsqueda del gateway no lista todas las tarjetas del cliente, así que una tarjeta
+    ausente en la respuesta no se desactiva; las bajas llegan por estado o vencimiento.
+    """
+    if customer_manager is None:
+        from .xpresspago_sdk import CustomerManager, get_xpresspago_sdk
+        customer_manager = CustomerManager(get_xpresspago_sdk())
+
+    customer_token, remote_cards = _remote_customer(
+        customer_manager.search_customer({"unique_identifier": customer})
+    )
+    if customer_token is None:
+        return False
+
+    set_customer_token(customer, customer_token)
+
+    for card in remote_cards:
+        if not card.get("Token"):
+            continue
+        upsert_card(
+            customer,
+            customer_token,
+            card["Token"],
+            last_four=(card.get("Number") or "")[-4:],
+            brand=card.get("Brand") or card_brand(card.get("Number")),
+            expiry_month=card.get("ExpirationMonth"),
+            expiry_year=card.get("ExpirationYear"),
+            status="Active" if card.get("Status") == "Active" else "Inactive"
+        )
+    return True
+
+
+def request_card_sync(customer):
+    """
+    Encola la sincronización de un cliente (p. ej. bóveda vacía para un cliente existente)
+
+    Se encola una vez cada ON_DEMAND_SYNC_TTL por cliente: recargar el formulario mientras
+    la bóveda sigue vacía no agrega otro job.
+    """
+    try:
+        cache = frappe.cache()
+        if not cache.set(cache.make_key(f"usp_card_sync|{customer}"), 1, nx=True, ex=ON_DEMAND_SYNC_TTL):
+            return
+    except Exception as e:
+        # Sin Redis no hay deduplicación, pero la sincronización se encola igual
+        frappe.log_error(f"Error reservando la sincronización de {customer}: {str(e)}")
+
+    frappe.enqueue(
+        "gateway_usp.api.card_vault.sync_customer_cards",
+        queue="short",
+        enqueue_after_commit=True,
+        customer=customer
+    )
+
+
+def _expire_cards():
+    """Marca Expired las tarjetas activas cuyo vencimiento ya pasó"""
+    today = frappe.utils.getdate()
+    for card in frappe.get_all(DOCTYPE, filters={"status": "Active"},
+                               fields=["name", "expiry_month", "expiry_year"]):
+        try:
+            month = int(card.expiry_month)
+            year = int(card.expiry_year)
+        except (TypeError, ValueError):
+            continue
+        if year < 100:
+            year += 2000
+        if (year, month) < (today.year, today.month):
+            frappe.db.set_value(DOCTYPE, card.name, "status", "Expired")
+
+
+@instrumented_job("sync_card_vault")
+def sync_card_vault():
+    """Sincroniza la bóveda de todos los clientes con token (diario)"""
+    settings = frappe.get_single("USP Payment Gateway Settings")
+    if not settings.is_enabled or settings.use_mock_mode or frappe.conf.get("usp_use_mock"):
+        return
+
+    from .xpresspago_sdk import CustomerManager, get_xpresspago_sdk
+    customer_manager = CustomerManager(get_xpresspago_sdk())
+
+    last_name = ""
+    while True:
+        customers = frappe.get_all(
+            "Customer",
+            filters={"usp_customer_token": ("is", "set"), "name": (">", last_name)},
+            pluck="name",
+            order_by="name asc",
+            limit=SYNC_BATCH_SIZE
+        )
+        if not customers:
+            break
+        for customer in customers:
+            try:
+                sync_customer_cards(customer, customer_manager)
+                frappe.db.commit()
+            except Exception as e:
+                frappe.db.rollback()
+                frappe.log_error(f"Error sincronizando tarjetas de {customer}: {str(e)}")
+        last_name = customers[-1]
+
+    _expire_cards()
+    frappe.db.commit()
@@ -0,0 +1,283 @@
+# gateway_usp/api/checkout.py
+
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+from frappe.utils.password import decrypt, encrypt
+
+from .idempotency import client_tracking
+from .xpresspago_sdk import CustomerManager, TransactionManager, get_xpresspago_sdk
+from ..utils.payload_store import save_payload
+
+REALTIME_EVENT = "usp_checkout_result"
+
+# Cola dedicada si existe un worker para ella en common_site_config (workers: {"usp_checkout": ...})
+DEDICATED_QUEUE = "usp_checkout"
+
+# Tiempo que el resultado queda disponible para consultas de respaldo del navegador
+RESULT_TTL = 3600
+
+# Timeout del job: búsqueda de cliente, alta de tarjeta y venta (30s) con margen para reintentos
+JOB_TIMEOUT = 300
+
+
+def is_async_checkout(payment_data):
+    """True si el pago debe procesarse en segundo plano"""
+    if "async_mode" in payment_data:
+        return bool(payment_data.get("async_mode"))
+    return bool(frappe.db.get_single_value("USP Payment Gateway Settings", "async_checkout"))
+
+
+def _checkout_queue():
+    queue = frappe.conf.get("usp_checkout_queue")
+    if queue:
+        return queue
+    return DEDICATED_QUEUE if DEDICATED_QUEUE in (frappe.conf.get("workers") or {}) else "short"
+
+
+def _result_key(checkout_id):
+    return f"usp_checkout|{checkout_id}"
+
+
+def enqueue_checkout(kind, payment_data, amount):
+    """
+    Registra la transacción como Pending y encola las llamadas al gateway
+
+    Args:
+        kind: saved_card o new_card
+        payment_data: datos del pago ya validados
+        amount: monto validado
+    """
+    transaction = frappe.get_doc({
+        "doctype": "USP Transaction",
+        "reference_doctype": payment_data.get("reference_doctype"),
+        "reference_docname": payment_data.get("reference_docname"),
+        "amount": flt(amount),
+        "currency": payment_data.get("currency", "USD"),
+        "customer": payment_data.get("customer"),
+        "status": "Pending",
+        "payment_method": "Credit Card"
+    })
+    if kind == "new_card":
+        transaction.card_last_four = payment_data["card_data"].get("card_number", "")[-4:]
+    transaction.insert(ignore_permissions=True)
+
+    job_data = dict(payment_data)
+    if job_data.get("card_data"):
+        # Los argumentos del job viven en Redis: los datos de tarjeta viajan cifrados con la llave del sitio
+        job_data["card_data"] = encrypt(json.dumps(job_data["card_data"]))
+
+    checkout_id = transaction.name
+    _store_result(checkout_id, {"checkout_id": checkout_id, "status": "Pending"}, frappe.session.user)
+
+    frappe.enqueue(
+        "gateway_usp.api.checkout.run_checkout",
+        queue=_checkout_queue(),
+        timeout=JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        checkout_id=checkout_id,
+        kind=kind,
+        payment_data=job_data,
+        amount=flt(amount),
+        user=frappe.session.user
+    )
+
+    return {
+        "success": True,
+        "queued": True,
+        "checkout_id": checkout_id,
+        "transaction_id": checkout_id,
+        "status": "Pending",
+        "message": _("Pago en proceso")
+    }
+
+
+def run_checkout(checkout_id, kind, payment_data, amount, user):
+    """Job: ejecuta las llamadas al gateway y publica el resultado al usuario"""
+    try:
+        if payment_data.get("card_data"):
+            payment_data["card_data"] = json.loads(decrypt(payment_data["card_data"]))
+
+        sdk = get_xpresspago_sdk()
+        if kind == "new_card":
+            result = _charge_new_card(sdk, payment_data, amount)
+        else:
+            result = TransactionManager(sdk).process_sale({
+                "amount": flt(amount),
+                "customer_id": payment_data.get("customer_id"),
+                "card_token": payment_data.get("card_token"),
+                "order_tracking_number": client_tracking(payment_data)
+            })
+    except Exception as e:
+        # Antes de la venta (cliente, tarjeta, descifrado): no hubo cobro
+        frappe.db.rollback()
+        frappe.log_error(f"Error en checkout asíncrono USP {checkout_id}: {str(e)}")
+        _mark_failed(checkout_id, str(e))
+        result = None
+        outcome = {
+            "checkout_id": checkout_id,
+            "success": False,
+            "charged": False,
+            "status": "Failed",
+            "transaction_id": checkout_id,
+            "message": str(e)
+        }
+
+    if result is not None:
+        # La venta ya se envió: desde aquí ningún error marca la transacción como fallida
+        transaction_id = _finish_checkout(checkout_id, kind, payment_data, amount, result)
+        outcome = {
+            "checkout_id": checkout_id,
+            "success": bool(result.get("IsSuccess")),
+            "charged": bool(result.get("IsSuccess")),
+            "status": "Pending" if result.get("IsSuccess") else "Failed",
+            "transaction_id": transaction_id,
+            "response_code": result.get("ResponseCode"),
+            "message": result.get("ResponseMessage")
+        }
+
+    if not outcome["success"]:
+        # Sin cobro (error previo o rechazo del gateway): el documento puede cobrarse de nuevo
+        from .idempotency import mark_failed
+        mark_failed(payment_data, outcome.get("message"))
+
+    _store_result(checkout_id, outcome, user)
+    frappe.publish_realtime(REALTIME_EVENT, outcome, user=user, after_commit=True)
+    frappe.db.commit()
+
+
+def _finish_checkout(checkout_id, kind, payment_data, amount, result):
+    """
+    Registra el resultado de una venta ya enviada; devuelve el nombre final de la transacción
+
+    El resultado del gateway se confirma primero y por separado. Renombrar, guardar el payload,
+    notificar y auditar son pasos independientes: si fallan se registran en el log pero
+    no cambian el estado, porque el cliente pudo haber sido cobrado.
+    """
+    if not _run_step("guardar el resultado", checkout_id, _record_outcome, checkout_id, result):
+        return checkout_id
+
+    name = _run_step("renombrar", checkout_id, _rename_to_gateway_id, checkout_id, result) or checkout_id
+    _run_step("guardar el payload", name, save_payload, name, response_data=dict(result))
+
+    if not result.get("IsSuccess"):
+        # El estado se escribió sin hooks: la notificación se encola aquí, ya con el nombre final
+        _run_step("notificar", name, _queue_notification, name)
+
+    if kind == "new_card":
+        from gateway_usp.utils.payment_utils import log_usp_transaction
+        _run_step("auditar", name, log_usp_transaction, "new_card_payment", {
+            "customer": payment_data.get("customer"),
+            "amount": amount,
+            "card_last_four": payment_data["card_data"].get("card_number", "")[-4:]
+        }, result)
+    return name
+
+
+def _run_step(label, name, func, *args, **kwargs):
+    """Ejecuta y confirma un paso posterior a la venta; ante error revierte solo ese paso"""
+    try:
+        value = func(*args, **kwargs)
+        frappe.db.commit()
+        return True if value is None else value
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(f"Checkout USP {name}: no se pudo {label} tras la venta: {str(e)}",
+                         "USP Checkout")
+        return None
+
+
+def _charge_new_card(sdk, payment_data, amount):
+    """Cliente, tarjeta y venta: las mismas llamadas que process_payment_with_new_card"""
+    from .payment_controller import _add_card_to_customer, _get_or_create_customer
+
+    customer_manager = CustomerManager(sdk)
+    customer_response = _get_or_create_customer(customer_manager, payment_data.get("customer"))
+    if not customer_response.get("success"):
+        raise Exception(f"Error gestionando cliente: {customer_response.get('error')}")
+
+    customer_token = customer_response.get("customer_token")
+    card_response = _add_card_to_customer(customer_manager, customer_token, payment_data["card_data"],
+                                          customer=payment_data.get("customer"))
+    if not card_response.get("success"):
+        raise Exception(f"Error agregando tarjeta: {card_response.get('error')}")
+
+    return TransactionManager(sdk).process_sale({
+        "amount": flt(amount),
+        "customer_id": customer_token,
+        "card_token": card_response.get("card_token"),
+        "order_tracking_number": client_tracking(payment_data)
+    })
+
+
+def _record_outcome(checkout_id, result):
+    """
+    Persiste el TransactionId y el estado devueltos por el gateway
+
+    Con db.set_value (sin hooks ni validaciones) para que nada impida guardarlo; los webhooks
+    buscan por transaction_id, así que funcionan aunque el renombrado posterior falle.
+    """
+    timestamp = frappe.utils.now()
+    values = {
+        "transaction_id": result.get("TransactionId") or checkout_id,
+        "gateway_response_code": result.get("ResponseCode"),
+        "gateway_message": result.get("ResponseMessage"),
+        "updated_at": timestamp
+    }
+    if not result.get("IsSuccess"):
+        values.update({
+            "status": "Failed",
+            "error_message": result.get("ResponseMessage"),
+            "processed_at": timestamp
+        })
+    frappe.db.set_value("USP Transaction", checkout_id, values)
+
+
+def _rename_to_gateway_id(checkout_id, result):
+    """El nombre sale de transaction_id: se renombra al ID del gateway para que ambos coincidan"""
+    gateway_id = result.get("TransactionId")
+    if not gateway_id or gateway_id == checkout_id:
+        return checkout_id
+    frappe.rename_doc("USP Transaction", checkout_id, gateway_id, force=True, show_alert=False)
+    return gateway_id
+
+
+def _queue_notification(name):
+    from gateway_usp.utils.notifications import queue_notification
+    queue_notification(frappe.get_doc("USP Transaction", name))
+
+
+def _mark_failed(checkout_id, message):
+    try:
+        frappe.db.set_value("USP Transaction", checkout_id, {
+            "status": "Failed",
+            "error_message": message
+        })
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+
+
+def _store_result(checkout_id, outcome, user):
+    """Guarda el resultado junto con el usuario que inició el checkout (solo él puede consultarlo)"""
+    frappe.cache().set_value(_result_key(checkout_id), dict(outcome, user=user), expires_in_sec=RESULT_TTL)
+
+
+@frappe.whitelist()
+def get_checkout_status(checkout_id):
+    """
+    Resultado de un checkout asíncrono (respaldo si el navegador no recibió el evento realtime)
+
+    Solo para quien inició el checkout o quien puede leer USP Transaction: el resultado
+    incluye el ID de transacción y la respuesta del gateway.
+    """
+    outcome = frappe.cache().get_value(_result_key(checkout_id), expires=True)
+    if not outcome:
+        return {"checkout_id": checkout_id, "status": "Unknown"}
+
+    outcome = dict(outcome)
+    if outcome.pop("user", None) != frappe.session.user and not frappe.has_permission("USP Transaction", "read"):
+        frappe.throw(_("No tiene permiso para consultar este pago"), frappe.PermissionError)
+    return outcome
@@ -0,0 +1,246 @@
+# gateway_usp/api/circuit_breaker.py
+
+import threading
+import time
+from collections import deque
+
+import frappe
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Valores por defecto; se pueden sobreescribir en site_config.json
+DEFAULTS = {
+    "usp_cb_window": 200,               # muestras consideradas para percentiles y tasa de error
+    "usp_cb_min_calls": 20,             # mínimo de muestras antes de abrir o adaptar timeouts
+    "usp_cb_error_threshold": 0.5,      # tasa de error que abre el circuito
+    "usp_cb_open_seconds": 30,          # tiempo abierto antes de permitir una prueba
+    "usp_cb_timeout_factor": 2.0,       # timeout = p99 * factor
+    "usp_cb_min_timeout": 2.0,          # timeout mínimo en segundos
+    "usp_cb_sync_interval": 1.0,        # segundos entre sincronizaciones con la caché del sitio
+}
+
+# Lotes de muestras guardados por operación en Redis (cada lote es una sincronización de un worker)
+SHARED_BATCHES = 50
+
+# Operaciones que mueven dinero: un timeout deja el resultado desconocido, así que
+# siempre usan el timeout configurado y nunca el adaptativo
+FIXED_TIMEOUT_OPERATIONS = {"Sale"}
+
+
+class CircuitOpenError(Exception):
+    """El circuito de la operación está abierto: se rechaza la llamada sin tocar la red"""
+
+
+def _conf(key):
+    return frappe.conf.get(key) or DEFAULTS[key]
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por ambiente y operación
+
+    Cada proceso acumula muestras localmente y, como máximo una vez por intervalo,
+    las publica en la caché del sitio y lee las del resto de workers junto con el estado
+    compartido del circuito. allow() y timeout() no tocan Redis entre sincronizaciones.
+    """
+
+    def __init__(self, environment, operation, default_timeout, adaptive=True):
+        self.environment = environment
+        self.operation = operation
+        self.default_timeout = default_timeout
+        self.adaptive = adaptive
+
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.current_timeout = default_timeout
+        self.p50 = None
+        self.p99 = None
+        self.error_rate = 0.0
+        self.sample_count = 0
+
+        self._pending = []
+        self._local = deque(maxlen=_conf("usp_cb_window"))
+        self._last_sync = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def _state_key(self):
+        return f"usp_circuit_state|{self.environment}|{self.operation}"
+
+    @property
+    def _samples_key(self):
+        return f"usp_circuit_samples|{self.environment}|{self.operation}"
+
+    def allow(self):
+        """True si la llamada puede salir al gateway"""
+        self._maybe_sync()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() < self.open_until:
+                return False
+            # Pasado el tiempo abierto: una sola llamada de prueba por proceso
+            if self._probe_in_flight:
+                return False
+            self.state = HALF_OPEN
+            self._probe_in_flight = True
+            return True
+
+    def timeout(self):
+        """Timeout adaptativo según el p99 observado, acotado por el timeout por defecto"""
+        return self.current_timeout
+
+    def record(self, latency, success):
+        """Registra el resultado de una llamada (latencia en segundos)"""
+        with self._lock:
+            sample = (round(latency * 1000, 1), 1 if success else 0)
+            self._pending.append(sample)
+            self._local.append(sample)
+            was_probe = self._probe_in_flight
+            self._probe_in_flight = False
+
+        if was_probe:
+            # El resultado de la prueba decide el estado de inmediato
+            self._set_shared_state(CLOSED if success else OPEN)
+            self._maybe_sync(force=True)
+        else:
+            self._maybe_sync(force=not success)
+
+    def snapshot(self):
+        """Estado actual para diagnósticos"""
+        self._maybe_sync(force=True)
+        return {
+            "environment": self.environment,
+            "operation": self.operation,
+            "state": self.state,
+            "open_until": self.open_until if self.state != CLOSED else None,
+            "error_rate": round(self.error_rate, 3),
+            "p50_ms": self.p50,
+            "p99_ms": self.p99,
+            "timeout": self.current_timeout,
+            "default_timeout": self.default_timeout,
+            "adaptive_timeout": self.adaptive,
+            "samples": self.sample_count
+        }
+
+    def _maybe_sync(self, force=False):
+        now = time.monotonic()
+        interval = _conf("usp_cb_sync_interval")
+        # Ante errores se sincroniza antes, pero nunca más de 5 veces por segundo
+        if now - self._last_sync < (0.2 if force else interval):
+            return
+        self._last_sync = now
+        try:
+            self._sync()
+        except Exception:
+            # Sin Redis se sigue funcionando con las muestras locales
+            self._evaluate(list(self._local))
+            self._check_threshold()
+
+    def _check_threshold(self):
+        if self.state == CLOSED and self.sample_count >= _conf("usp_cb_min_calls") \
+                and self.error_rate >= _conf("usp_cb_error_threshold"):
+            self._set_shared_state(OPEN)
+
+    def _sync(self):
+        cache = frappe.cache()
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        if pending:
+            cache.rpush(self._samples_key, ";".join(f"{lat}:{ok}" for lat, ok in pending))
+            cache.ltrim(self._samples_key, -SHARED_BATCHES, -1)
+
+        samples = []
+        for batch in cache.lrange(self._samples_key, 0, -1) or []:
+            if isinstance(batch, bytes):
+                batch = batch.decode()
+            for item in batch.split(";"):
+                latency, _, ok = item.partition(":")
+                samples.append((float(latency), int(ok or 0)))
+
+        window = _conf("usp_cb_window")
+        self._evaluate(samples[-window:])
+
+        shared = cache.get_value(self._state_key, expires=True) or {}
+        with self._lock:
+            shared_state = shared.get("state", CLOSED)
+            if shared_state == OPEN and not self._probe_in_flight:
+                self.state = OPEN
+                self.open_until = shared.get("open_until", 0.0)
+            elif shared_state == CLOSED and self.state != HALF_OPEN:
+                self.state = CLOSED
+
+        self._check_threshold()
+
+    def _evaluate(self, samples):
+        latencies = sorted(lat for lat, _ok in samples)
+        errors = sum(1 for _lat, ok in samples if not ok)
+
+        self.sample_count = len(samples)
+        self.error_rate = errors / len(samples) if samples else 0.0
+        self.p50 = _percentile(latencies, 50)
+        self.p99 = _percentile(latencies, 99)
+
+        if self.adaptive and self.p99 is not None and self.sample_count >= _conf("usp_cb_min_calls"):
+            adaptive = self.p99 / 1000.0 * _conf("usp_cb_timeout_factor")
+            self.current_timeout = round(
+                min(self.default_timeout, max(_conf("usp_cb_min_timeout"), adaptive)), 2
+            )
+        else:
+            self.current_timeout = self.default_timeout
+
+    def _set_shared_state(self, state):
+        open_until = time.time() + _conf("usp_cb_open_seconds") if state == OPEN else 0.0
+        with self._lock:
+            self.state = state
+            self.open_until = open_until
+            if state == CLOSED:
+                # Empezar la ventana de nuevo tras recuperarse
+                self._local.clear()
+        try:
+            cache = frappe.cache()
+            cache.set_value(self._state_key, {"state": state, "open_until": open_until}, expires_in_sec=3600)
+            if state == CLOSED:
+                cache.delete_value(self._samples_key)
+        except Exception:
+            pass
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(environment, operation, default_timeout):
+    """Breaker del proceso para el sitio, ambiente y operación"""
+    key = (getattr(frappe.local, "site", None), environment, operation)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(environment, operation, default_timeout,
+                                         adaptive=operation not in FIXED_TIMEOUT_OPERATIONS)
+                _breakers[key] = breaker
+    return breaker
+
+
+def circuit_snapshot(environment):
+    """Estado de los breakers de todas las operaciones del ambiente"""
+    from .xpresspago_sdk import OPERATION_TIMEOUTS
+
+    return [
+        get_breaker(environment, operation, timeout).snapshot()
+        for operation, timeout in OPERATION_TIMEOUTS.items()
+    ]
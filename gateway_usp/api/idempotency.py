@@ -0,0 +1,163 @@
+# gateway_usp/api/idempotency.py
+
+import hashlib
+import json
+
+import frappe
+from frappe import _
+
+from ..utils.metrics import inc
+
+DOCTYPE = "USP Payment Idempotency"
+
+# El candado debe sobrevivir al request completo (cliente, tarjeta y Sale)
+LOCK_SECONDS = 120
+
+# Largo máximo de clientTracking que acepta el gateway
+CLIENT_TRACKING_LENGTH = 50
+
+
+def idempotency_key(reference_doctype, reference_docname, client_key=None):
+    """Llave estable del cobro: documento de referencia más la llave opcional del cliente"""
+    raw = f"{reference_doctype}\n{reference_docname}\n{client_key or ''}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def client_tracking(payment_data):
+    """
+    clientTracking de la venta: documento de referencia más client_key
+
+    Cada client_key es un cobro distinto del mismo documento; con solo el documento, la
+    idempotencia de Sale (retry.IdempotencyRecord) devolvería la aprobación del cobro anterior.
+    Si no cabe en el campo del gateway, el final se reemplaza por un hash del valor completo.
+    """
+    reference_docname = payment_data.get("reference_docname")
+    client_key = payment_data.get("client_key")
+    tracking = f"{reference_docname}:{client_key}" if client_key else reference_docname
+    if not tracking or len(tracking) <= CLIENT_TRACKING_LENGTH:
+        return tracking
+    digest = hashlib.sha1(tracking.encode()).hexdigest()[:12]
+    return f"{tracking[:CLIENT_TRACKING_LENGTH - len(digest) - 1]}~{digest}"
+
+
+def _key_for(payment_data):
+    if not (payment_data.get("reference_doctype") and payment_data.get("reference_docname")):
+        return None
+    return idempotency_key(
+        payment_data.get("reference_doctype"),
+        payment_data.get("reference_docname"),
+        payment_data.get("client_key")
+    )
+
+
+def _stored(key):
+    return frappe.db.get_value(DOCTYPE, key, ["status", "response", "attempts"], as_dict=True)
+
+
+def _replay(stored):
+    response = json.loads(stored.response) if isinstance(stored.response, str) else dict(stored.response or {})
+    response["replayed"] = True
+    inc("usp_payment_idempotency_events_total", event="replayed")
+    return response
+
+
+def _acquire_lock(key):
+    """Candado por llave: solo serializa cobros del mismo documento"""
+    cache = frappe.cache()
+    lock_key = cache.make_key(f"usp_payment_lock|{key}")
+    if not cache.set(lock_key, 1, nx=True, ex=LOCK_SECONDS):
+        return False
+
+    # Se libera cuando termina la transacción de BD, con el resultado ya visible para el siguiente
+    def release():
+        cache.delete(lock_key)
+
+    frappe.db.after_commit.add(release)
+    frappe.db.after_rollback.add(release)
+    return True
+
+
+def run_idempotent(payment_data, process):
+    """
+    Ejecuta process() una sola vez por documento de referencia (y client_key)
+
+    Las repeticiones de un cobro aprobado devuelven la respuesta guardada; un cobro
+    fallido o rechazado permite un nuevo intento. Sin documento de referencia no hay protección.
+    """
+    key = _key_for(payment_data)
+    if not key:
+        return process()
+
+    # Camino feliz: una lectura por llave primaria, sin candado
+    stored = _stored(key)
+    if stored and stored.status == "Completed":
+        return _replay(stored)
+
+    if not _acquire_lock(key):
+        inc("usp_payment_idempotency_events_total", event="in_progress")
+        return {
+            "success": False,
+            "in_progress": True,
+            "message": _("Ya hay un pago en curso para este documento")
+        }
+
+    # El dueño anterior del candado pudo haber guardado su resultado mientras esperábamos
+    stored = _stored(key)
+    if stored and stored.status == "Completed":
+        return _replay(stored)
+
+    response = process()
+    _save(key, payment_data, stored, response)
+    return response
+
+
+def _save(key, payment_data, stored, response):
+    # Solo un cobro aprobado por el gateway (o encolado, hasta que el worker informe) cierra
+    # la llave; un rechazo la deja abierta para reintentar
+    values = {
+        "status": "Completed" if response.get("charged") or response.get("queued") else "Failed",
+        "transaction_id": response.get("transaction_id"),
+        "response": json.dumps(response, default=str)
+    }
+
+    if stored:
+        values["attempts"] = (stored.attempts or 0) + 1
+        frappe.db.set_value(DOCTYPE, key, values)
+    else:
+        try:
+            frappe.get_doc(dict(
+                values,
+                doctype=DOCTYPE,
+                idempotency_key=key,
+                reference_doctype=payment_data.get("reference_doctype"),
+                reference_docname=payment_data.get("reference_docname"),
+                client_key=payment_data.get("client_key")
+            )).insert(ignore_permissions=True)
+        except frappe.DuplicateEntryError:
+            # El índice único es la última barrera si el candado se perdió (p. ej. Redis reiniciado)
+            inc("usp_payment_idempotency_events_total", event="conflict")
+            frappe.log_error(f"Cobro duplicado para {payment_data.get('reference_doctype')} "
+                             f"{payment_data.get('reference_docname')} ({key})", "USP Idempotency")
+            return
+
+    inc("usp_payment_idempotency_events_total", event="stored")
+
+
+def mark_failed(payment_data, message=None):
+    """Permite un nuevo intento cuando un cobro encolado termina fallando en el worker"""
+    key = _key_for(payment_data)
+    if not key or not frappe.db.exists(DOCTYPE, key):
+        return
+    frappe.db.set_value(DOCTYPE, key, {
+        "status": "Failed",
+        "response": json.dumps({"success": False, "message": message})
+    })
+
+
+@frappe.whitelist()
+def clear_payment_idempotency(reference_doctype, reference_docname, client_key=None):
+    """Libera un documento para un nuevo cobro tras verificarlo en el gateway"""
+    frappe.only_for("System Manager")
+    key = idempotency_key(reference_doctype, reference_docname, client_key)
+    frappe.db.set_value(DOCTYPE, key, "status", "Failed")
+    return {"success": True}
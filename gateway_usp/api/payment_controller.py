@@ -5,8 +5,13 @@ from frappe import _
 from frappe.utils import flt, now, get_url
 import json
 from .xpresspago_sdk import get_xpresspago_sdk, CustomerManager, TransactionManager
+from .idempotency import client_tracking
+from .webhook_inbox import LIFECYCLE_RANK
+from ..utils.metrics import inc, observe, instrumented_endpoint, instrumented_job
+from ..utils.payload_store import save_payload
 
 @frappe.whitelist()
+@instrumented_endpoint("process_payment")
 def process_payment(payment_data):
     """
     Procesa un pago a través de XpressPago
@@ -19,38 +24,9 @@ def process_payment(payment_data):
         if isinstance(payment_data, str):
             payment_data = json.loads(payment_data)
         
-        # Obtener SDK configurado
-        sdk = get_xpresspago_sdk()
-        transaction_manager = TransactionManager(sdk)
-        
-        # Procesar el pago
-        result = transaction_manager.process_sale({
-            "amount": flt(payment_data.get("amount")),
-            "customer_id": payment_data.get("customer_id"),
-            "card_token": payment_data.get("card_token"),
-            "order_tracking_number": payment_data.get("reference_docname")
-        })
-        
-        # Crear registro de transacción
-        transaction = frappe.get_doc({
-            "doctype": "USP Transaction",
-            "reference_doctype": payment_data.get("reference_doctype"),
-            "reference_docname": payment_data.get("reference_docname"),
-            "amount": flt(payment_data.get("amount")),
-            "currency": payment_data.get("currency", "USD"),
-            "customer": payment_data.get("customer"),
-            "transaction_id": result.get("TransactionId"),
-            "status": "Pending",
-            "response_data": json.dumps(result)
-        })
-        transaction.insert(ignore_permissions=True)
-        
-        return {
-            "success": True,
-            "transaction_id": result.get("TransactionId"),
-            "status": result.get("Status"),
-            "message": _("Pago procesado exitosamente")
-        }
+        # Un solo cobro por documento de referencia (doble clic, reintentos del cliente)
+        from .idempotency import run_idempotent
+        return run_idempotent(payment_data, lambda: _process_saved_card_payment(payment_data))
         
     except Exception as e:
         frappe.log_error(f"Error procesando pago USP: {str(e)}")
@@ -60,7 +36,49 @@ def process_payment(payment_data):
             "message": _("Error al procesar el pago")
         }
 
+def _process_saved_card_payment(payment_data):
+    """Cobro con tarjeta guardada (síncrono o encolado)"""
+    # Checkout asíncrono: el worker llama al gateway y publica el resultado por realtime
+    from .checkout import enqueue_checkout, is_async_checkout
+    if is_async_checkout(payment_data):
+        return enqueue_checkout("saved_card", payment_data, payment_data.get("amount"))
+    
+    # Obtener SDK configurado
+    sdk = get_xpresspago_sdk()
+    transaction_manager = TransactionManager(sdk)
+    
+    # Procesar el pago
+    result = transaction_manager.process_sale({
+        "amount": flt(payment_data.get("amount")),
+        "customer_id": payment_data.get("customer_id"),
+        "card_token": payment_data.get("card_token"),
+        "order_tracking_number": client_tracking(payment_data)
+    })
+    
+    # Crear registro de transacción
+    transaction = frappe.get_doc({
+        "doctype": "USP Transaction",
+        "reference_doctype": payment_data.get("reference_doctype"),
+        "reference_docname": payment_data.get("reference_docname"),
+        "amount": flt(payment_data.get("amount")),
+        "currency": payment_data.get("currency", "USD"),
+        "customer": payment_data.get("customer"),
+        "transaction_id": result.get("TransactionId"),
+        "status": "Pending"
+    })
+    transaction.insert(ignore_permissions=True)
+    save_payload(transaction.name, response_data=dict(result))
+    
+    return {
+        "success": True,
+        "charged": bool(result.get("IsSuccess")),
+        "transaction_id": result.get("TransactionId"),
+        "status": result.get("Status"),
+        "message": _("Pago procesado exitosamente")
+    }
+
 @frappe.whitelist()
+@instrumented_endpoint("process_payment_with_new_card")
 def process_payment_with_new_card(payment_data):
     """
     Procesa un pago con una nueva tarjeta de crédito - MEJORADO
@@ -91,11 +109,13 @@ def process_payment_with_new_card(payment_data):
         except (ValueError, TypeError):
             frappe.throw(f"Monto inválido: {amount}")
         
-        # Log para debug
-        frappe.log_error(
-            f"Procesando pago USP - Amount: {amount}, Customer: {payment_data.get('customer')}, Currency: {payment_data.get('currency', 'USD')}",
-            "USP Payment Debug"
-        )
+        # Log para debug (muestreado con usp_audit_debug_sample_rate)
+        from gateway_usp.utils.audit import audit
+        audit("payment_debug", {
+            "amount": amount,
+            "customer": payment_data.get("customer"),
+            "currency": payment_data.get("currency", "USD")
+        }, level="debug")
         
         card_data = payment_data.get('card_data')
         card_required_fields = ['card_number', 'cardholder_name', 'expiry_month', 'expiry_year', 'cvv']
@@ -107,69 +127,8 @@ def process_payment_with_new_card(payment_data):
         from gateway_usp.utils.payment_utils import validate_payment_amount
         validate_payment_amount(amount, payment_data.get('currency', 'USD'))
         
-        # Obtener SDK configurado
-        sdk = get_xpresspago_sdk()
-        customer_manager = CustomerManager(sdk)
-        transaction_manager = TransactionManager(sdk)
-        
-        # 1. Buscar o crear cliente en XpressPago
-        customer_response = _get_or_create_customer(customer_manager, payment_data.get('customer'))
-        
-        if not customer_response.get('success'):
-            frappe.throw(f"Error con cliente: {customer_response.get('error')}")
-        
-        customer_token = customer_response.get('customer_token')
-        
-        # 2. Agregar tarjeta al cliente
-        card_response = _add_card_to_customer(customer_manager, customer_token, card_data)
-        
-        if not card_response.get('success'):
-            frappe.throw(f"Error agregando tarjeta: {card_response.get('error')}")
-        
-        card_token = card_response.get('card_token')
-        
-        # 3. Procesar el pago
-        transaction_response = transaction_manager.process_sale({
-            "amount": flt(amount),
-            "customer_id": customer_token,
-            "card_token": card_token,
-            "order_tracking_number": payment_data.get("reference_docname")
-        })
-        
-        # 4. Crear registro de transacción
-        transaction = frappe.get_doc({
-            "doctype": "USP Transaction",
-            "reference_doctype": payment_data.get("reference_doctype"),
-            "reference_docname": payment_data.get("reference_docname"),
-            "amount": flt(amount),
-            "currency": payment_data.get("currency", "USD"),
-            "customer": payment_data.get("customer"),
-            "transaction_id": transaction_response.get("TransactionId"),
-            "status": "Pending",
-            "payment_method": "Credit Card",
-            "card_last_four": card_data.get("card_number")[-4:],
-            "response_data": json.dumps(transaction_response)
-        })
-        transaction.insert(ignore_permissions=True)
-        
-        # 5. Log de auditoría
-        from gateway_usp.utils.payment_utils import log_usp_transaction
-        log_usp_transaction(
-            "new_card_payment",
-            {
-                "customer": payment_data.get("customer"),
-                "amount": amount,
-                "card_last_four": card_data.get("card_number")[-4:]
-            },
-            transaction_response
-        )
-        
-        return {
-            "success": True,
-            "transaction_id": transaction_response.get("TransactionId"),
-            "status": transaction_response.get("Status"),
-            "message": _("Pago procesado exitosamente con nueva tarjeta")
-        }
+        from .idempotency import run_idempotent
+        return run_idempotent(payment_data, lambda: _process_new_card_payment(payment_data, card_data, amount))
         
     except Exception as e:
         frappe.log_error(f"Error procesando pago con nueva tarjeta: {str(e)}")
@@ -179,21 +138,103 @@ def process_payment_with_new_card(payment_data):
             "message": _("Error al procesar el pago con nueva tarjeta")
         }
 
+def _process_new_card_payment(payment_data, card_data, amount):
+    """Cliente, tarjeta y cobro con una tarjeta nueva (síncrono o encolado)"""
+    from .checkout import enqueue_checkout, is_async_checkout
+    if is_async_checkout(payment_data):
+        return enqueue_checkout("new_card", payment_data, amount)
+    
+    # Obtener SDK configurado
+    sdk = get_xpresspago_sdk()
+    customer_manager = CustomerManager(sdk)
+    transaction_manager = TransactionManager(sdk)
+    
+    # 1. Buscar o crear cliente en XpressPago
+    customer_response = _get_or_create_customer(customer_manager, payment_data.get('customer'))
+    
+    if not customer_response.get('success'):
+        frappe.throw(f"Error con cliente: {customer_response.get('error')}")
+    
+    customer_token = customer_response.get('customer_token')
+    
+    # 2. Agregar tarjeta al cliente
+    card_response = _add_card_to_customer(customer_manager, customer_token, card_data,
+                                          customer=payment_data.get("customer"))
+    
+    if not card_response.get('success'):
+        frappe.throw(f"Error agregando tarjeta: {card_response.get('error')}")
+    
+    card_token = card_response.get('card_token')
+    
+    # 3. Procesar el pago
+    transaction_response = transaction_manager.process_sale({
+        "amount": flt(amount),
+        "customer_id": customer_token,
+        "card_token": card_token,
+        "order_tracking_number": client_tracking(payment_data)
+    })
+    
+    # 4. Crear registro de transacción
+    transaction = frappe.get_doc({
+        "doctype": "USP Transaction",
+        "reference_doctype": payment_data.get("reference_doctype"),
+        "reference_docname": payment_data.get("reference_docname"),
+        "amount": flt(amount),
+        "currency": payment_data.get("currency", "USD"),
+        "customer": payment_data.get("customer"),
+        "transaction_id": transaction_response.get("TransactionId"),
+        "status": "Pending",
+        "payment_method": "Credit Card",
+        "card_last_four": card_data.get("card_number")[-4:]
+    })
+    transaction.insert(ignore_permissions=True)
+    save_payload(transaction.name, response_data=dict(transaction_response))
+    
+    # 5. Log de auditoría
+    from gateway_usp.utils.payment_utils import log_usp_transaction
+    log_usp_transaction(
+        "new_card_payment",
+        {
+            "customer": payment_data.get("customer"),
+            "amount": amount,
+            "card_last_four": card_data.get("card_number")[-4:]
+        },
+        transaction_response
+    )
+    
+    return {
+        "success": True,
+        "charged": bool(transaction_response.get("IsSuccess")),
+        "transaction_id": transaction_response.get("TransactionId"),
+        "status": transaction_response.get("Status"),
+        "message": _("Pago procesado exitosamente con nueva tarjeta")
+    }
+
 def _get_or_create_customer(customer_manager, customer_name):
     """Obtiene o crea un cliente en XpressPago"""
     try:
-        # Obtener datos del cliente desde ERPNext
-        customer_doc = frappe.get_doc("Customer", customer_name)
+        from gateway_usp.api import card_vault
+        
+        # Token guardado en Customer.usp_customer_token: sin llamadas al gateway
+        customer_token = card_vault.get_customer_token(customer_name)
+        if customer_token:
+            return {
+                "success": True,
+                "customer_token": customer_token,
+                "existing": True
+            }
         
         # Primero intentar buscar el cliente existente
         search_response = customer_manager.search_customer({
             "unique_identifier": customer_name
         })
         
-        if search_response.get("success") and search_response.get("data"):
+        customer_token, _cards = card_vault._remote_customer(search_response)
+        if customer_token:
+            card_vault.set_customer_token(customer_name, customer_token)
             return {
                 "success": True,
-                "customer_token": search_response["data"].get("CustomerToken"),
+                "customer_token": customer_token,
                 "existing": True
             }
         
@@ -204,6 +245,7 @@ def _get_or_create_customer(customer_manager, customer_name):
         create_response = customer_manager.create_customer(customer_data)
         
         if create_response.get("IsSuccess"):
+            card_vault.set_customer_token(customer_name, create_response.get("CustomerToken"))
             return {
                 "success": True,
                 "customer_token": create_response.get("CustomerToken"),
@@ -222,7 +264,7 @@ def _get_or_create_customer(customer_manager, customer_name):
             "error": str(e)
         }
 
-def _add_card_to_customer(customer_manager, customer_token, card_data):
+def _add_card_to_customer(customer_manager, customer_token, card_data, customer=None):
     """Agrega una tarjeta a un cliente en XpressPago"""
     try:
         # Preparar datos de la tarjeta según la documentación
@@ -250,6 +292,13 @@ def _add_card_to_customer(customer_manager, customer_token, card_data):
             if card_response.get("CreditCards"):
                 card_token = card_response["CreditCards"][0].get("Token")
             
+            # Las tarjetas del cliente cambiaron: descartar los detalles cacheados
+            from gateway_usp.api.token_cache import invalidate
+            invalidate(customer_manager.sdk, customer, customer_token, card_token)
+            
+            from gateway_usp.api.card_vault import store_added_card
+            store_added_card(customer, customer_token, card_token, card_data)
+            
             return {
                 "success": True,
                 "card_token": card_token,
@@ -268,6 +317,32 @@ def _add_card_to_customer(customer_manager, customer_token, card_data):
             "error": str(e)
         }
 
+def run_bulk_sales(transactions, max_concurrency=None, batch_size=100):
+    """
+    Cobra en bloque tokens guardados (pensado para frappe.enqueue en facturación recurrente)
+    
+    Args:
+        transactions: lista de dicts con card_token, amount, customer, reference_doctype, reference_docname
+            y client_key opcional (un cobro distinto por cada client_key del mismo documento)
+        max_concurrency: máximo de ventas simultáneas
+        batch_size: filas por inserción en bloque
+    """
+    from .xpresspago_sdk import BulkSaleReport
+    
+    if isinstance(transactions, str):
+        transactions = json.loads(transactions)
+    
+    sdk = get_xpresspago_sdk()
+    transaction_manager = TransactionManager(sdk)
+    report = BulkSaleReport()
+    
+    for _item in transaction_manager.process_sales(
+        transactions, max_concurrency=max_concurrency, batch_size=batch_size, report=report
+    ):
+        pass
+    
+    return report.as_dict()
+
 @frappe.whitelist()
 def validate_card_details(card_number, expiry_month, expiry_year, cvv):
     """Valida los datos de una tarjeta de crédito"""
@@ -308,9 +383,13 @@ def validate_card_details(card_number, expiry_month, expiry_year, cvv):
         }
 
 @frappe.whitelist(allow_guest=True)
+@instrumented_endpoint("webhook_handler")
 def webhook_handler():
     """
-    Maneja webhooks de XpressPago para actualizar estados de transacciones
+    Recibe webhooks de XpressPago: valida, guarda el evento en la bandeja y responde
+
+    La actualización de la transacción y los documentos contables ocurre en un worker
+    (gateway_usp.api.webhook_inbox), fuera del callback HTTP del gateway.
     """
     try:
         # Obtener datos del webhook
@@ -320,28 +399,58 @@ def webhook_handler():
         if not _validate_webhook_signature(data):
             frappe.throw(_("Firma de webhook inválida"))
         
-        # Procesar actualización de estado
-        transaction_id = data.get("transaction_id")
-        new_status = data.get("status")
+        from gateway_usp.api.webhook_inbox import ingest_webhook
+        ingest_webhook(data)
         
-        if transaction_id:
-            transaction = frappe.get_doc("USP Transaction", 
-                                       {"transaction_id": transaction_id})
-            
-            # Actualizar estado
-            transaction.status = new_status
-            transaction.webhook_data = json.dumps(data)
-            transaction.save(ignore_permissions=True)
-            
-            # Actualizar documento relacionado
-            _update_related_document(transaction, new_status)
-            
         return {"status": "success"}
         
     except Exception as e:
         frappe.log_error(f"Error procesando webhook USP: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+def apply_webhook_event(data):
+    """Aplica un webhook guardado a su transacción (desde el worker de la bandeja)"""
+    transaction_id = data.get("transaction_id")
+    new_status = data.get("status")
+    
+    transaction = frappe.get_doc("USP Transaction", 
+                               {"transaction_id": transaction_id})
+    
+    # La etiqueta viene del payload de un webhook sin sesión: solo estados conocidos
+    inc("usp_webhook_events_total", status=new_status if new_status in LIFECYCLE_RANK else "other")
+    if transaction.created_at:
+        observe("usp_webhook_lag_seconds",
+                max((frappe.utils.now_datetime() - frappe.utils.get_datetime(transaction.created_at)).total_seconds(), 0))
+    
+    # Actualizar estado y documento relacionado
+    set_transaction_status(transaction, new_status)
+    save_payload(transaction.name, webhook_data=data)
+    
+    # Eventos que afectan la tarjeta invalidan sus detalles cacheados
+    _invalidate_webhook_tokens(data, transaction)
+
+def set_transaction_status(transaction, status, values=None):
+    """
+    Cambia el estado de la transacción con todos sus efectos
+
+    Guarda el documento (hooks: notificación al cliente) y actualiza el documento relacionado.
+    Lo usan los webhooks y la conciliación.
+    """
+    if values:
+        transaction.update(values)
+    transaction.status = status
+    transaction.save(ignore_permissions=True)
+    _update_related_document(transaction, status)
+
+def _invalidate_webhook_tokens(data, transaction):
+    """Invalida la caché de tokens referenciados por el webhook"""
+    tokens = [data.get(field) for field in ("account_token", "card_token", "customer_token")]
+    if not any(tokens):
+        return
+    
+    from gateway_usp.api.token_cache import invalidate
+    invalidate(get_xpresspago_sdk(), transaction.customer, *tokens)
+
 def _validate_webhook_signature(data):
     """Valida la firma del webhook"""
     # Implementar validación de firma según documentación XpressPago
@@ -382,31 +491,16 @@ def _create_payment_entry(transaction):
     return payment_entry
 
 @frappe.whitelist()
+@instrumented_endpoint("get_customer_cards")
 def get_customer_cards(customer):
-    """Obtiene las tarjetas guardadas de un cliente"""
+    """Obtiene las tarjetas guardadas de un cliente desde la bóveda local"""
     try:
-        sdk = get_xpresspago_sdk()
-        customer_manager = CustomerManager(sdk)
-        
-        # Buscar cliente en XpressPago
-        result = customer_manager.search_customer({
-            "unique_identifier": customer
-        })
+        from gateway_usp.api import card_vault
         
-        cards = []
-        if result.get("success") and result.get("data"):
-            customer_data = result["data"]
-            if customer_data.get("CreditCards"):
-                cards = [
-                    {
-                        "token": card.get("Token"),
-                        "last_four": card.get("Number", "")[-4:],
-                        "brand": card.get("Brand", ""),
-                        "expiry": f"{card.get('ExpirationMonth')}/{card.get('ExpirationYear')}"
-                    }
-                    for card in customer_data["CreditCards"]
-                    if card.get("Status") == "Active"
-                ]
+        cards = card_vault.get_cards(customer)
+        if not cards and card_vault.get_customer_token(customer) and not card_vault.has_cards(customer):
+            # Cliente anterior a la bóveda: se llena en segundo plano
+            card_vault.request_card_sync(customer)
         
         return cards
         
@@ -437,41 +531,26 @@ def create_usp_customer(customer_data):
         }
 
 @frappe.whitelist()
+@instrumented_job("sync_pending_transactions")
 def sync_pending_transactions():
     """Sincronizar transacciones pendientes (ejecutado cada hora)"""
     try:
-        # Obtener transacciones pendientes de más de 10 minutos
-        pending_transactions = frappe.get_all(
-            "USP Transaction",
-            filters={
-                "status": "Pending",
-                "created_at": ["<", frappe.utils.add_minutes(frappe.utils.now(), -10)]
-            },
-            fields=["name", "transaction_id"]
-        )
-        
-        for transaction in pending_transactions:
-            # Consultar estado en XpressPago
-            # Implementar lógica de sincronización
-            pass
-            
+        # Conciliación por páginas con checkpoint (ver gateway_usp.utils.reconciliation)
+        from gateway_usp.utils.reconciliation import run_reconciliation
+        return run_reconciliation()
+        
     except Exception as e:
         frappe.log_error(f"Error sincronizando transacciones: {str(e)}")
 
 @frappe.whitelist()
-def cleanup_old_transactions():
-    """Limpiar transacciones antiguas (ejecutado diariamente)"""
+@instrumented_job("cleanup_old_transactions")
+def cleanup_old_transactions(dry_run=False):
+    """Archivar y limpiar transacciones antiguas (ejecutado diariamente)"""
     try:
-        # Eliminar logs de transacciones de más de 90 días
-        old_date = frappe.utils.add_days(frappe.utils.now(), -90)
-        
-        frappe.db.sql("""
-            DELETE FROM `tabUSP Transaction`
-            WHERE created_at < %s
-            AND status IN ('Cancelled', 'Failed')
-        """, (old_date,))
-        
-        frappe.db.commit()
+        # Archivo gzip JSON Lines y borrado por lotes (ver gateway_usp.utils.retention)
+        from gateway_usp.utils.retention import run_retention
+        frappe.only_for("System Manager")
+        return run_retention(dry_run=frappe.utils.cint(dry_run))
         
     except Exception as e:
         frappe.log_error(f"Error limpiando transacciones: {str(e)}")
\ No newline at end of file
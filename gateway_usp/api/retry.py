@@ -0,0 +1,331 @@
+# gateway_usp/api/retry.py
+
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+
+import frappe
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from .circuit_breaker import CircuitOpenError
+from ..utils import metrics
+
+# Códigos con los que el gateway indica que la venta NO se procesó y puede reenviarse
+RETRYABLE_RESPONSE_CODES = {
+    "19": "Reintente la transacción",
+    "91": "Emisor o switch no disponible",
+    "96": "Mal funcionamiento del sistema",
+}
+
+# Estados HTTP en los que el servicio no aceptó la petición
+RETRYABLE_HTTP_STATUS = {503}
+
+# Código devuelto cuando la venta ya está en curso o su resultado es desconocido
+SALE_IN_DOUBT_CODE = "997"
+
+DEFAULTS = {
+    "usp_retry_max_attempts": 3,
+    "usp_retry_base_delay": 0.2,
+    "usp_retry_max_delay": 2.0,
+    "usp_idempotency_ttl": 86400,
+    # Reserva de una venta en curso: cubre el timeout de Sale con sus reintentos; si el
+    # worker muere a mitad, el documento queda libre poco después y no por un día
+    "usp_idempotency_in_flight_ttl": 120,
+}
+
+_metrics = {
+    "sales": 0,
+    "attempts": 0,
+    "retries": 0,
+    "retried_sales": 0,
+    "recovered_sales": 0,
+    "replayed_sales": 0,
+    "in_doubt_sales": 0,
+    "added_latency_ms": 0.0,
+}
+_metrics_lock = threading.Lock()
+
+
+def _conf(key):
+    return frappe.conf.get(key) or DEFAULTS[key]
+
+
+def _count(**increments):
+    with _metrics_lock:
+        for key, value in increments.items():
+            _metrics[key] += value
+    for key, value in increments.items():
+        if value and key != "added_latency_ms":
+            metrics.inc("usp_sale_retry_events_total", value, event=key)
+
+
+def retry_metrics():
+    """Contadores de reintentos del proceso actual"""
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    metrics["added_latency_ms"] = round(metrics["added_latency_ms"], 1)
+    return metrics
+
+
+def backoff_delay(attempt):
+    """Backoff exponencial con jitter completo"""
+    cap = min(_conf("usp_retry_max_delay"), _conf("usp_retry_base_delay") * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def is_unsent_error(error):
+    """True si la petición nunca llegó al gateway (seguro reenviar)"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def sale_fingerprint(values):
+    """Huella de la venta: token, monto y moneda (el token no se guarda en claro)"""
+    try:
+        amount = f"{float(values.get('amount')):.2f}"
+    except (TypeError, ValueError):
+        amount = str(values.get("amount"))
+    raw = f"{values.get('accountToken')}|{amount}|{values.get('currencyCode')}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+class IdempotencyRecord:
+    """
+    Registro liviano en la caché del sitio que asegura un único envío por venta
+
+    La venta se identifica por client_tracking más la huella de token, monto y moneda:
+    un segundo cobro legítimo sobre el mismo documento (pago parcial, otra tarjeta)
+    es una venta distinta y no recibe el resultado del anterior.
+    """
+
+    IN_FLIGHT = "in_flight"
+    UNKNOWN = "unknown"
+    DONE = "done"
+
+    def __init__(self, client_tracking, fingerprint=""):
+        self.client_tracking = client_tracking
+        self.cache = frappe.cache()
+        self.key = self.cache.make_key(f"{self.prefix(client_tracking)}{fingerprint}")
+
+    @staticmethod
+    def prefix(client_tracking):
+        return f"usp_sale_idempotency|{client_tracking}|"
+
+    def get(self):
+        value = self.cache.get(self.key)
+        return json.loads(value) if value else None
+
+    def begin(self):
+        """Reserva el client_tracking; False si otro proceso ya lo tiene"""
+        value = json.dumps({"state": self.IN_FLIGHT, "started": time.time()})
+        return bool(self.cache.set(self.key, value, nx=True, ex=_conf("usp_idempotency_in_flight_ttl")))
+
+    def complete(self, result):
+        self._store(self.DONE, dict(result))
+
+    def mark_unknown(self, message):
+        self._store(self.UNKNOWN, {"message": message})
+
+    def release(self):
+        """La venta no llegó a enviarse: se libera para permitir un nuevo intento"""
+        self.cache.delete(self.key)
+
+    def _store(self, state, result):
+        value = json.dumps({"state": state, "result": result, "updated": time.time()})
+        self.cache.set(self.key, value, ex=_conf("usp_idempotency_ttl"))
+
+
+def _in_doubt_result(client_tracking, record):
+    state = (record or {}).get("state")
+    message = (
+        "Venta en curso para este client_tracking"
+        if state == IdempotencyRecord.IN_FLIGHT
+        else "Resultado desconocido de un envío previo; verificar en el gateway antes de reintentar"
+    )
+    return {
+        "IsSuccess": False,
+        "ResponseCode": SALE_IN_DOUBT_CODE,
+        "ResponseMessage": f"{message} ({client_tracking})"
+    }
+
+
+def _reserve(values):
+    """Registro de idempotencia de la venta y, si no debe enviarse, el resultado a devolver"""
+    client_tracking = values.get("clientTracking")
+    record = IdempotencyRecord(client_tracking, sale_fingerprint(values)) if client_tracking else None
+
+    if record is not None:
+        existing = record.get()
+        if existing and existing.get("state") == IdempotencyRecord.DONE:
+            _count(replayed_sales=1)
+            return record, existing["result"]
+        if existing or not record.begin():
+            _count(in_doubt_sales=1)
+            return record, _in_doubt_result(client_tracking, existing or record.get())
+    return record, None
+
+
+def _on_error(record, error, last_attempt):
+    """True si el error permite reenviar; si no, deja el registro en su estado final"""
+    if is_unsent_error(error) and not last_attempt:
+        return True
+    if record is not None:
+        if is_unsent_error(error):
+            record.release()
+        else:
+            # Pudo haber llegado al gateway: no se vuelve a enviar
+            record.mark_unknown(str(error))
+    return False
+
+
+def _on_response(record, response, result, last_attempt):
+    """True si la respuesta permite reenviar; si no, deja el registro en su estado final"""
+    retryable = (
+        response.status_code in RETRYABLE_HTTP_STATUS
+        or (not result.get("IsSuccess") and result.get("ResponseCode") in RETRYABLE_RESPONSE_CODES)
+    )
+    if retryable and not last_attempt:
+        return True
+
+    if record is not None:
+        if result.get("IsSuccess"):
+            record.complete(result)
+        elif response.status_code >= 500 and response.status_code not in RETRYABLE_HTTP_STATUS:
+            # 500/502/504: el gateway pudo haber procesado la venta
+            record.mark_unknown(f"HTTP {response.status_code}")
+        else:
+            # Rechazo definitivo: se permite un nuevo intento (p. ej. con otra tarjeta)
+            record.release()
+    return False
+
+
+def sale_with_retries(sdk, values):
+    """
+    Ejecuta Sale con reintentos seguros
+
+    Solo se reenvía cuando hay certeza de que el gateway no procesó la venta
+    (error de conexión antes de enviar, HTTP 503 o código del catálogo de reintentables).
+    Con client_tracking, un registro de idempotencia evita cualquier segundo envío.
+    """
+    record, early_result = _reserve(values)
+    if early_result is not None:
+        return early_result
+
+    max_attempts = max(int(_conf("usp_retry_max_attempts")), 1)
+    started = time.monotonic()
+    first_attempt_ms = None
+    _count(sales=1)
+
+    for attempt in range(max_attempts):
+        attempt_started = time.monotonic()
+        _count(attempts=1)
+        last_attempt = attempt == max_attempts - 1
+
+        try:
+            response = sdk._guarded("Sale", sdk._soap_post, "Sale", values)
+        except CircuitOpenError as e:
+            if record is not None:
+                record.release()
+            return sdk._error_result("Sale", e)
+        except Exception as e:
+            if _on_error(record, e, last_attempt):
+                first_attempt_ms = first_attempt_ms or (time.monotonic() - attempt_started) * 1000
+                time.sleep(_retry_delay(attempt))
+                continue
+            _finish_metrics(attempt, started, first_attempt_ms, recovered=False)
+            return sdk._error_result("Sale", e)
+
+        result = sdk._handle_response("Sale", response)
+        if _on_response(record, response, result, last_attempt):
+            first_attempt_ms = first_attempt_ms or (time.monotonic() - attempt_started) * 1000
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        _finish_metrics(attempt, started, first_attempt_ms, recovered=bool(result.get("IsSuccess")))
+        return result
+
+
+async def sale_with_retries_async(async_sdk, values, deadline=None):
+    """
+    Variante asyncio de sale_with_retries para AsyncXpresspagoSDK (ventas en lote)
+
+    Mismas reglas de reintento e idempotencia; el registro se consulta en el hilo del loop
+    y solo la E/S HTTP corre en el pool de hilos.
+    """
+    sdk = async_sdk.sdk
+    record, early_result = _reserve(values)
+    if early_result is not None:
+        return early_result
+
+    max_attempts = max(int(_conf("usp_retry_max_attempts")), 1)
+    started = time.monotonic()
+    first_attempt_ms = None
+    _count(sales=1)
+
+    for attempt in range(max_attempts):
+        attempt_started = time.monotonic()
+        _count(attempts=1)
+        last_attempt = attempt == max_attempts - 1
+
+        try:
+            response = await async_sdk._request("Sale", sdk._soap_post, "Sale", values, deadline=deadline)
+        except CircuitOpenError as e:
+            if record is not None:
+                record.release()
+            return sdk._error_result("Sale", e)
+        except Exception as e:
+            if _on_error(record, e, last_attempt):
+                first_attempt_ms = first_attempt_ms or (time.monotonic() - attempt_started) * 1000
+                await asyncio.sleep(_retry_delay(attempt))
+                continue
+            _finish_metrics(attempt, started, first_attempt_ms, recovered=False)
+            return sdk._error_result("Sale", e)
+
+        result = sdk._handle_response("Sale", response)
+        if _on_response(record, response, result, last_attempt):
+            first_attempt_ms = first_attempt_ms or (time.monotonic() - attempt_started) * 1000
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+
+        _finish_metrics(attempt, started, first_attempt_ms, recovered=bool(result.get("IsSuccess")))
+        return result
+
+
+def _retry_delay(attempt):
+    _count(retries=1)
+    return backoff_delay(attempt)
+
+
+def _finish_metrics(attempt, started, first_attempt_ms, recovered):
+    if attempt == 0:
+        return
+    # Latencia añadida: todo lo que pasó después del primer intento fallido
+    total_ms = (time.monotonic() - started) * 1000
+    _count(
+        retried_sales=1,
+        recovered_sales=1 if recovered else 0,
+        added_latency_ms=max(total_ms - (first_attempt_ms or 0), 0)
+    )
+
+
+@frappe.whitelist()
+def clear_idempotency_record(client_tracking):
+    """Libera las ventas de un client_tracking en estado desconocido tras verificarlas en el gateway"""
+    frappe.only_for("System Manager")
+    frappe.cache().delete_keys(IdempotencyRecord.prefix(client_tracking))
+    return {"success": True}
+
+
+@frappe.whitelist()
+def get_retry_metrics():
+    """Expone los contadores de reintentos a administradores"""
+    frappe.only_for("System Manager")
+    return retry_metrics()
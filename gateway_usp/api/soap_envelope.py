@@ -0,0 +1,101 @@
+# gateway_usp/api/soap_envelope.py
+
+from xml.sax.saxutils import escape
+
+SOAP_NAMESPACE = "http://schemas.xmlsoap.org/soap/envelope/"
+TEMPURI_NAMESPACE = "http://tempuri.org/"
+
+# Parámetros de cada operación CROEM, en el orden que espera el servicio
+OPERATIONS = {
+    "Ping": (),
+    "Sale": (
+        "APIKey",
+        "accountToken",
+        "accessCode",
+        "merchantAccountNumber",
+        "terminalName",
+        "clientTracking",
+        "amount",
+        "currencyCode",
+        "emailAddress",
+        "cvv",
+    ),
+    "GetTokenDetails": (
+        "APIKey",
+        "accountNumber",
+    ),
+}
+
+_ENVELOPE_OPEN = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    f'<soap:Envelope xmlns:soap="{SOAP_NAMESPACE}" xmlns:tem="{TEMPURI_NAMESPACE}">'
+    "<soap:Header/><soap:Body>"
+)
+_ENVELOPE_CLOSE = "</soap:Body></soap:Envelope>"
+
+
+def _escape(value):
+    """Escapa texto para un nodo XML; evita el costo de escape() si no hay caracteres especiales"""
+    if value is None:
+        return ""
+    text = value if isinstance(value, str) else str(value)
+    if "&" in text or "<" in text or ">" in text:
+        return escape(text)
+    return text
+
+
+class EnvelopeTemplate:
+    """Plantilla precompilada: fragmentos estáticos intercalados con los parámetros"""
+
+    __slots__ = ("operation", "params", "segments", "static_body", "headers")
+
+    def __init__(self, operation, params):
+        self.operation = operation
+        self.params = params
+
+        segments = []
+        current = _ENVELOPE_OPEN + f"<tem:{operation}>"
+        for param in params:
+            segments.append(current + f"<tem:{param}>")
+            current = f"</tem:{param}>"
+        segments.append(current + f"</tem:{operation}>" + _ENVELOPE_CLOSE)
+        self.segments = tuple(segments)
+
+        # Operaciones sin parámetros: el cuerpo completo se calcula una vez
+        self.static_body = (
+            (_ENVELOPE_OPEN + f"<tem:{operation}/>" + _ENVELOPE_CLOSE).encode("utf-8")
+            if not params else None
+        )
+
+        self.headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": f"{TEMPURI_NAMESPACE}{operation}"
+        }
+
+    def encode(self, values=None):
+        """Genera el cuerpo HTTP en bytes con los valores escapados"""
+        if self.static_body is not None:
+            return self.static_body
+
+        values = values or {}
+        segments = self.segments
+        parts = [segments[0]]
+        append = parts.append
+        for param, segment in zip(self.params, segments[1:]):
+            append(_escape(values.get(param)))
+            append(segment)
+        return "".join(parts).encode("utf-8")
+
+
+# Compiladas una sola vez al importar el módulo
+TEMPLATES = {operation: EnvelopeTemplate(operation, params) for operation, params in OPERATIONS.items()}
+
+
+def encode_envelope(operation, values=None):
+    """Cuerpo SOAP minificado y escapado para la operación"""
+    return TEMPLATES[operation].encode(values)
+
+
+def soap_headers(operation):
+    """Cabeceras HTTP de la operación (no modificar el dict devuelto)"""
+    return TEMPLATES[operation].headers
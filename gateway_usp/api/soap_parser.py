@@ -0,0 +1,203 @@
+# gateway_usp/api/soap_parser.py
+
+from collections.abc import Mapping
+from xml.parsers import expat
+
+# Códigos usados cuando la respuesta no trae los suyos
+PARSE_ERROR_CODE = "999"
+DECLINED_CODE = "01"
+APPROVED_CODE = "00"
+
+
+class SoapResult(Mapping):
+    """Resultado compacto de una operación CROEM, compatible con dict"""
+
+    __slots__ = ("IsSuccess", "ResponseCode", "ResponseMessage")
+
+    operation = None
+    _field_names = __slots__
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get("__slots__", ()):
+                if name not in names:
+                    names.append(name)
+        cls._field_names = tuple(names)
+
+    def __init__(self, **values):
+        for name in self._field_names:
+            setattr(self, name, values.get(name))
+
+    def __getitem__(self, key):
+        if key in self._field_names:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        for name in self._field_names:
+            if getattr(self, name) is not None:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """Copia como dict simple (para json.dumps y almacenamiento)"""
+        return dict(self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class SaleResponse(SoapResult):
+    __slots__ = ("TransactionId", "AuthorizationNumber", "Status", "Amount", "Currency")
+    operation = "Sale"
+
+
+class TokenDetailsResponse(SoapResult):
+    __slots__ = ("AccountToken", "CardNumber", "CardHolderName", "ExpirationDate", "CardBrand")
+    operation = "GetTokenDetails"
+
+
+class PingResponse(SoapResult):
+    __slots__ = ("PingResult",)
+    operation = "Ping"
+
+
+# Elementos que interesan por operación -> campo del resultado
+_COMMON_FIELDS = {
+    "IsSuccess": "IsSuccess",
+    "ResponseCode": "ResponseCode",
+    "ResponseMessage": "ResponseMessage",
+    "ResponseDescription": "ResponseMessage",
+    "faultstring": "_fault",
+}
+
+_OPERATION_FIELDS = {
+    "Sale": {
+        "TransactionId": "TransactionId",
+        "TransactionID": "TransactionId",
+        "AuthorizationNumber": "AuthorizationNumber",
+        "AuthorizationCode": "AuthorizationNumber",
+        "Amount": "Amount",
+        "CurrencyCode": "Currency",
+    },
+    "GetTokenDetails": {
+        "AccountToken": "AccountToken",
+        "Token": "AccountToken",
+        "CardNumber": "CardNumber",
+        "MaskedCardNumber": "CardNumber",
+        "CardHolderName": "CardHolderName",
+        "CardholderName": "CardHolderName",
+        "ExpirationDate": "ExpirationDate",
+        "CardType": "CardBrand",
+        "CardBrand": "CardBrand",
+    },
+    "Ping": {
+        "PingResult": "PingResult",
+    },
+}
+
+_RESULT_CLASSES = {
+    "Sale": SaleResponse,
+    "GetTokenDetails": TokenDetailsResponse,
+    "Ping": PingResponse,
+}
+
+# Mapa completo precalculado (comunes + específicos) por operación
+_WANTED = {
+    operation: {**_COMMON_FIELDS, **fields}
+    for operation, fields in _OPERATION_FIELDS.items()
+}
+
+
+def _extract(source, wanted):
+    """Recorre el XML con expat y extrae solo el texto de los elementos buscados"""
+    values = {}
+    current = [None]
+    buffer = []
+
+    def start(name, attrs):
+        target = wanted.get(name.rpartition(":")[2])
+        if target is not None and target not in values:
+            current[0] = target
+            buffer.clear()
+
+    def end(name):
+        target = current[0]
+        if target is not None:
+            values[target] = "".join(buffer).strip()
+            current[0] = None
+
+    def data(text):
+        if current[0] is not None:
+            buffer.append(text)
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+
+    if isinstance(source, (bytes, str)):
+        parser.Parse(source, True)
+    else:
+        # Iterable de fragmentos (p. ej. response.iter_content())
+        for chunk in source:
+            if chunk:
+                parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+
+    return values
+
+
+def parse_soap_response(source, operation):
+    """
+    Parsea una respuesta SOAP CROEM de forma incremental
+
+    Args:
+        source: bytes/str del cuerpo o iterable de fragmentos
+        operation: Sale, GetTokenDetails o Ping
+    """
+    result_class = _RESULT_CLASSES.get(operation, SoapResult)
+    wanted = _WANTED.get(operation, _COMMON_FIELDS)
+
+    try:
+        values = _extract(source, wanted)
+    except expat.ExpatError as e:
+        return result_class(
+            IsSuccess=False,
+            ResponseCode=PARSE_ERROR_CODE,
+            ResponseMessage=f"Parse error: {str(e)}"
+        )
+
+    fault = values.pop("_fault", None)
+    if fault is not None:
+        return result_class(
+            IsSuccess=False,
+            ResponseCode=PARSE_ERROR_CODE,
+            ResponseMessage=f"SOAP Fault: {fault}"
+        )
+
+    is_success = values.get("IsSuccess")
+    if is_success is not None:
+        values["IsSuccess"] = is_success.lower() == "true"
+    elif operation == "Ping":
+        # Ping solo devuelve PingResult
+        values["IsSuccess"] = bool(values.get("PingResult"))
+    else:
+        values["IsSuccess"] = values.get("ResponseCode") == APPROVED_CODE
+
+    if not values.get("ResponseCode"):
+        values["ResponseCode"] = APPROVED_CODE if values["IsSuccess"] else DECLINED_CODE
+    if not values.get("ResponseMessage"):
+        values["ResponseMessage"] = "Success" if values["IsSuccess"] else "Transaction declined"
+
+    if operation == "Sale":
+        values["Status"] = "Completed" if values["IsSuccess"] else "Failed"
+
+    return result_class(**values)
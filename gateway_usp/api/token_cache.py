@@ -0,0 +1,190 @@
+# gateway_usp/api/token_cache.py
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import frappe
+
+from ..utils import metrics
+
+# Valores por defecto; se pueden sobreescribir en site_config.json
+DEFAULTS = {
+    "usp_token_cache_size": 1024,           # entradas en la caché en memoria de cada proceso
+    "usp_token_cache_local_ttl": 30,        # segundos en memoria (acota lo que otro worker puede quedar desactualizado)
+    "usp_token_cache_ttl": 600,             # segundos en Redis para tokens encontrados
+    "usp_token_cache_negative_ttl": 60,     # segundos en Redis para tokens inexistentes
+}
+
+# Código CROEM de token inexistente: es la única respuesta negativa que se guarda
+TOKEN_NOT_FOUND_CODE = "T04"
+
+_metrics = {
+    "local_hits": 0,
+    "redis_hits": 0,
+    "negative_hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "invalidations": 0,
+}
+_metrics_lock = threading.Lock()
+
+
+def _conf(key):
+    return frappe.conf.get(key) or DEFAULTS[key]
+
+
+def _count(name):
+    with _metrics_lock:
+        _metrics[name] += 1
+    metrics.inc("usp_token_cache_events_total", event=name)
+
+
+class LocalTTLCache:
+    """LRU en memoria con vencimiento por entrada, seguro entre hilos"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local = None
+_local_lock = threading.Lock()
+
+
+def _get_local():
+    global _local
+    if _local is None:
+        with _local_lock:
+            if _local is None:
+                _local = LocalTTLCache(int(_conf("usp_token_cache_size")))
+    return _local
+
+
+def _cache_key(sdk, account_number):
+    # La API key nunca se guarda en claro en la clave
+    api_key_hash = hashlib.sha256((sdk.api_key or "").encode()).hexdigest()[:16]
+    return f"usp_token_details|{sdk.environment}|{api_key_hash}|{account_number}"
+
+
+def _local_key(key):
+    return (getattr(frappe.local, "site", None), key)
+
+
+def get_token_details(sdk, account_number):
+    """
+    GetTokenDetails con caché en dos niveles: memoria del proceso y Redis
+
+    Los tokens inexistentes (T04 en una respuesta HTTP 200) se guardan con un TTL corto para
+    no repetir la consulta; los errores de red, HTTP o del gateway no se guardan nunca.
+    """
+    from .xpresspago_sdk import MockXpresspagoSDK
+
+    if isinstance(sdk, MockXpresspagoSDK) or not account_number:
+        return sdk.get_token_details(account_number)
+
+    key = _cache_key(sdk, account_number)
+    local = _get_local()
+
+    entry = local.get(_local_key(key))
+    if entry is not None:
+        _count("local_hits")
+        return _from_entry(entry)
+
+    entry = frappe.cache().get_value(key, expires=True)
+    if entry is not None:
+        _count("redis_hits")
+        local.set(_local_key(key), entry, _conf("usp_token_cache_local_ttl"))
+        return _from_entry(entry)
+
+    _count("misses")
+    try:
+        values = sdk._token_details_values(account_number)
+        response = sdk._guarded("GetTokenDetails", sdk._soap_post, "GetTokenDetails", values)
+    except Exception as e:
+        return sdk._error_result("GetTokenDetails", e)
+    result = sdk._handle_response("GetTokenDetails", response)
+
+    if result.get("IsSuccess"):
+        entry = {"found": True, "result": dict(result)}
+        ttl = _conf("usp_token_cache_ttl")
+    elif result.get("ResponseCode") == TOKEN_NOT_FOUND_CODE and response.status_code == 200:
+        # Solo el T04 de la respuesta SOAP prueba que el token no existe; el SDK reporta
+        # cualquier error HTTP (401, 403, 429, 5xx) también como T04
+        entry = {"found": False, "result": dict(result)}
+        ttl = _conf("usp_token_cache_negative_ttl")
+    else:
+        return result
+
+    frappe.cache().set_value(key, entry, expires_in_sec=ttl)
+    local.set(_local_key(key), entry, min(ttl, _conf("usp_token_cache_local_ttl")))
+    _count("stores")
+    return result
+
+
+def _from_entry(entry):
+    if not entry["found"]:
+        _count("negative_hits")
+    return dict(entry["result"])
+
+
+def invalidate(sdk, *account_numbers):
+    """Elimina de ambos niveles los detalles de los tokens o identificadores indicados"""
+    local = _get_local()
+    cache = frappe.cache()
+    for account_number in account_numbers:
+        if not account_number:
+            continue
+        key = _cache_key(sdk, account_number)
+        local.delete(_local_key(key))
+        cache.delete_value(key)
+        _count("invalidations")
+
+
+def token_cache_metrics():
+    """Contadores de aciertos y fallos de la caché del proceso actual"""
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    lookups = metrics["local_hits"] + metrics["redis_hits"] + metrics["misses"]
+    metrics["hit_ratio"] = round((metrics["local_hits"] + metrics["redis_hits"]) / lookups, 3) if lookups else None
+    metrics["local_entries"] = len(_get_local())
+    return metrics
+
+
+@frappe.whitelist()
+def get_token_cache_metrics():
+    """Expone los contadores de la caché de tokens a administradores"""
+    frappe.only_for("System Manager")
+    return token_cache_metrics()
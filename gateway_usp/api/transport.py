@@ -0,0 +1,159 @@
+# gateway_usp/api/transport.py
+
+import os
+import ssl
+import threading
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+# Valores por defecto del pool; se pueden sobreescribir en site_config.json
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 20
+DEFAULT_POOL_BLOCK = False
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """Adapter con contexto TLS compartido para reutilizar sesiones TLS entre conexiones"""
+
+    def __init__(self, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.ssl_context is not None:
+            pool_kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+
+class GatewayTransport:
+    """Sesión HTTP keep-alive compartida por ambiente dentro de un proceso"""
+
+    def __init__(self, environment, pool_connections=None, pool_maxsize=None, pool_block=None):
+        self.environment = environment
+        self.pid = os.getpid()
+        self.pool_connections = pool_connections or DEFAULT_POOL_CONNECTIONS
+        self.pool_maxsize = pool_maxsize or DEFAULT_POOL_MAXSIZE
+        self.pool_block = DEFAULT_POOL_BLOCK if pool_block is None else pool_block
+
+        # Un único SSLContext por transporte: OpenSSL guarda la caché de sesiones en el contexto
+        self.ssl_context = ssl.create_default_context()
+
+        self.adapter = PooledHTTPAdapter(
+            ssl_context=self.ssl_context,
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=0
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        """POST sobre el pool de conexiones"""
+        return self._send("POST", url, data=data, headers=headers, timeout=timeout)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        """GET sobre el pool de conexiones"""
+        return self._send("GET", url, params=params, headers=headers, timeout=timeout)
+
+    def _send(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        with self._lock:
+            self._requests += 1
+        return response
+
+    def stats(self):
+        """Contadores de conexiones nuevas vs reutilizadas"""
+        new_connections = 0
+        pool_requests = 0
+
+        # urllib3 lleva num_connections/num_requests por host en cada pool
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            new_connections += getattr(pool, "num_connections", 0)
+            pool_requests += getattr(pool, "num_requests", 0)
+
+        return {
+            "environment": self.environment,
+            "pid": self.pid,
+            "requests": self._requests,
+            "new_connections": new_connections,
+            "reused_connections": max(pool_requests - new_connections, 0),
+            "pool_connections": self.pool_connections,
+            "pool_maxsize": self.pool_maxsize,
+            "pool_block": self.pool_block
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def _get_pool_config():
+    """Lee la configuración del pool desde site_config.json"""
+    conf = getattr(frappe, "conf", None) or {}
+    return {
+        "pool_connections": conf.get("usp_http_pool_connections"),
+        "pool_maxsize": conf.get("usp_http_pool_maxsize"),
+        "pool_block": conf.get("usp_http_pool_block")
+    }
+
+
+def get_transport(environment="SANDBOX"):
+    """Obtiene el transporte compartido del ambiente para el proceso actual"""
+    pid = os.getpid()
+    key = (pid, environment)
+
+    transport = _transports.get(key)
+    if transport is not None:
+        return transport
+
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            # Descartar sesiones heredadas de un fork (gunicorn --preload, workers RQ)
+            for stale_key in [k for k in _transports if k[0] != pid]:
+                _transports.pop(stale_key, None)
+
+            transport = GatewayTransport(environment, **_get_pool_config())
+            _transports[key] = transport
+
+    return transport
+
+
+def reset_transports():
+    """Cierra y descarta todos los transportes del proceso"""
+    with _transports_lock:
+        for transport in _transports.values():
+            try:
+                transport.close()
+            except Exception:
+                pass
+        _transports.clear()
+
+
+def transport_stats():
+    """Estadísticas de reutilización de conexiones del proceso actual"""
+    pid = os.getpid()
+    return [t.stats() for (t_pid, _env), t in list(_transports.items()) if t_pid == pid]
+
+
+@frappe.whitelist()
+def get_transport_stats():
+    """Expone las estadísticas del pool HTTP a administradores"""
+    frappe.only_for("System Manager")
+    return transport_stats()
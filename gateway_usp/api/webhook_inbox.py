@@ -0,0 +1,319 @@
+# gateway_usp/api/webhook_inbox.py
+
+import hashlib
+import json
+import time
+
+import frappe
+
+from .token_cache import LocalTTLCache
+from ..utils.metrics import inc, instrumented_job
+
+DOCTYPE = "USP Webhook Event"
+
+# Cola dedicada si existe un worker para ella en common_site_config (workers: {"usp_webhooks": ...})
+DEDICATED_QUEUE = "usp_webhooks"
+
+# Un worker retiene la transacción mientras aplica sus eventos en orden
+LOCK_SECONDS = 300
+
+# Intentos antes de dar un evento por fallido (p. ej. la transacción aún no existe)
+MAX_ATTEMPTS = 5
+
+# Antigüedad a partir de la cual el cron reencola eventos que nadie procesó
+STALE_SECONDS = 60
+
+DEFAULT_RETENTION_DAYS = 30
+
+# Ventana de deduplicación de reentregas del gateway
+DEDUP_TTL = 86400
+
+# Reserva de un evento mientras se guarda; pasa a DEDUP_TTL solo cuando el evento quedó confirmado
+PENDING_TTL = 60
+DEDUP_LOCAL_SIZE = 4096
+
+# Espera desde el último evento de una transacción antes de aplicar su estado final
+DEFAULT_COALESCE_WINDOW = 2.0
+
+# Orden del ciclo de vida: un evento solo se aplica si avanza la transacción.
+# Completed está por encima de Failed/Cancelled: una aprobación tardía del gateway es autoritativa
+# (p. ej. la conciliación marcó Failed antes de que llegara la confirmación)
+LIFECYCLE_RANK = {
+    "Pending": 0,
+    "Authorized": 1,
+    "Failed": 2,
+    "Cancelled": 2,
+    "Completed": 3,
+    "Partially Refunded": 4,
+    "Refunded": 5,
+}
+
+# Campos de identidad que el gateway puede enviar; si no hay ninguno se usa el hash del payload
+EVENT_ID_FIELDS = ("event_id", "webhook_id", "id")
+
+_recent = LocalTTLCache(DEDUP_LOCAL_SIZE)
+
+
+def _queue():
+    queue = frappe.conf.get("usp_webhook_queue")
+    if queue:
+        return queue
+    return DEDICATED_QUEUE if DEDICATED_QUEUE in (frappe.conf.get("workers") or {}) else "short"
+
+
+def event_hash(data):
+    """Identidad del evento: su ID si el gateway lo envía, si no el hash del payload canónico"""
+    for field in EVENT_ID_FIELDS:
+        if data.get(field):
+            return hashlib.sha256(f"id:{data[field]}".encode()).hexdigest()
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _is_duplicate(digest):
+    """
+    True si el evento ya se recibió dentro de DEDUP_TTL (memoria local y luego Redis)
+
+    Un evento nuevo queda reservado por PENDING_TTL y se marca como visto solo cuando su
+    inserción se confirma; si el request falla, la reserva se libera y la reentrega se acepta.
+    """
+    local_key = (getattr(frappe.local, "site", None), digest)
+    if _recent.get(local_key):
+        return True
+
+    cache = key = None
+    try:
+        cache = frappe.cache()
+        key = cache.make_key(f"usp_webhook_seen|{digest}")
+        if not cache.set(key, 1, nx=True, ex=PENDING_TTL):
+            return True
+    except Exception:
+        # Sin Redis es preferible procesar un duplicado que perder un evento
+        cache = None
+
+    def confirm():
+        _recent.set(local_key, True, DEDUP_TTL)
+        if cache is not None:
+            try:
+                cache.set(key, 1, ex=DEDUP_TTL)
+            except Exception:
+                pass
+
+    def release():
+        if cache is not None:
+            try:
+                cache.delete(key)
+            except Exception:
+                pass
+
+    frappe.db.after_commit.add(confirm)
+    frappe.db.after_rollback.add(release)
+    return False
+
+
+def ingest_webhook(data):
+    """Guarda el webhook en la bandeja y encola su procesamiento; no toca la transacción"""
+    data = dict(data)
+    data.pop("cmd", None)
+    transaction_id = data.get("transaction_id")
+
+    digest = event_hash(data)
+    if _is_duplicate(digest):
+        inc("usp_webhook_inbox_events_total", event="duplicate")
+        return None
+
+    event = frappe.get_doc({
+        "doctype": DOCTYPE,
+        "transaction_id": transaction_id,
+        "event_status": data.get("status"),
+        "event_hash": digest,
+        "status": "Queued" if transaction_id else "Ignored",
+        "received_at": frappe.utils.now(),
+        "payload": json.dumps(data, default=str)
+    })
+    event.insert(ignore_permissions=True)
+    inc("usp_webhook_inbox_events_total", event="received" if transaction_id else "ignored")
+
+    if transaction_id:
+        enqueue_transaction(transaction_id)
+    return event.name
+
+
+def enqueue_transaction(transaction_id):
+    frappe.enqueue(
+        "gateway_usp.api.webhook_inbox.process_transaction_events",
+        queue=_queue(),
+        enqueue_after_commit=True,
+        transaction_id=transaction_id
+    )
+
+
+def _queued_events(transaction_id, limit=None):
+    return frappe.get_all(
+        DOCTYPE,
+        filters={"transaction_id": transaction_id, "status": "Queued"},
+        fields=["name", "payload", "attempts", "event_status", "received_at"],
+        order_by="received_at asc, creation asc",
+        limit=limit
+    )
+
+
+def process_transaction_events(transaction_id):
+    """
+    Aplica los eventos pendientes de una transacción (ver _process_queued)
+
+    Un candado por transaction_id garantiza que un solo worker la procesa a la vez;
+    transacciones distintas se procesan en paralelo.
+    """
+    cache = frappe.cache()
+    lock = cache.make_key(f"usp_webhook_lock|{transaction_id}")
+
+    while True:
+        if not cache.set(lock, 1, nx=True, ex=LOCK_SECONDS):
+            # Quien tiene el candado revisa de nuevo la bandeja al soltarlo
+            return
+        try:
+            _wait_for_burst(transaction_id)
+            blocked = _process_queued(transaction_id)
+        finally:
+            cache.delete(lock)
+
+        # Un evento pudo llegar entre la última lectura y la liberación del candado
+        if blocked or not _queued_events(transaction_id, limit=1):
+            return
+
+
+def _coalesce_window():
+    window = frappe.conf.get("usp_webhook_coalesce_window")
+    return DEFAULT_COALESCE_WINDOW if window is None else float(window)
+
+
+def _wait_for_burst(transaction_id):
+    """Espera a que la transacción deje de recibir eventos (como máximo una ventana)"""
+    window = _coalesce_window()
+    if window <= 0:
+        return
+    latest = _queued_events(transaction_id)[-1:]
+    if latest:
+        age = (frappe.utils.now_datetime() - frappe.utils.get_datetime(latest[0].received_at)).total_seconds()
+        if age < window:
+            time.sleep(window - age)
+
+
+def _rank(status):
+    return LIFECYCLE_RANK.get(status, -1)
+
+
+def _final_event(events):
+    """Evento con el estado más avanzado; ante empate, el último en llegar"""
+    return max(enumerate(events), key=lambda item: (_rank(item[1].event_status), item[0]))[1]
+
+
+def _events_to_apply(current, events):
+    """
+    Eventos a aplicar en orden: el estado final y, si la ráfaga pasa por encima de Completed,
+    antes el Completed (su pago se registra aunque llegue junto con un reembolso)
+    """
+    final = _final_event(events)
+    if not _moves_forward(current, final.event_status):
+        return []
+    completed = _rank("Completed")
+    if _rank(current) < completed < _rank(final.event_status):
+        passed = [event for event in events if event.event_status == "Completed"]
+        if passed:
+            return [passed[-1], final]
+    return [final]
+
+
+def _moves_forward(current, new):
+    if current == new:
+        return False
+    if current not in LIFECYCLE_RANK or new not in LIFECYCLE_RANK:
+        # Estados fuera del ciclo conocido se aplican como antes
+        return True
+    return _rank(new) > _rank(current)
+
+
+def _process_queued(transaction_id):
+    """
+    Aplica el estado final de los eventos pendientes
+
+    Si la ráfaga pasa por encima de Completed (p. ej. Completed y Refunded juntos) se aplica
+    primero el Completed y luego el final (ver _events_to_apply).
+    Los eventos intermedios quedan como Coalesced; los que no avanzan la transacción
+    (reentregas tardías, retrocesos) quedan como Superseded sin tocarla.
+    True si la transacción quedó pendiente de reintento.
+    """
+    from .payment_controller import apply_webhook_event
+
+    events = _queued_events(transaction_id)
+    if not events:
+        return False
+
+    try:
+        current = frappe.db.get_value("USP Transaction", {"transaction_id": transaction_id}, "status")
+        if current is None:
+            raise frappe.DoesNotExistError(f"USP Transaction {transaction_id} no existe")
+
+        to_apply = _events_to_apply(current, events)
+        for event in to_apply:
+            apply_webhook_event(json.loads(event.payload))
+    except Exception as e:
+        frappe.db.rollback()
+        attempts = max(event.attempts or 0 for event in events) + 1
+        retry = attempts < MAX_ATTEMPTS
+        for event in events:
+            frappe.db.set_value(DOCTYPE, event.name, {
+                "status": "Queued" if retry else "Failed",
+                "attempts": attempts,
+                "error": str(e)
+            }, update_modified=False)
+        frappe.db.commit()
+        inc("usp_webhook_inbox_events_total", len(events), event="retry" if retry else "failed")
+        if not retry:
+            frappe.log_error(f"Error procesando webhook USP {transaction_id}: {str(e)}")
+        return retry
+
+    processed_at = frappe.utils.now()
+    for event in events:
+        if not to_apply:
+            status = "Superseded"
+        elif event in to_apply:
+            status = "Processed"
+        else:
+            status = "Coalesced"
+        frappe.db.set_value(DOCTYPE, event.name, {
+            "status": status,
+            "processed_at": processed_at,
+            "attempts": (event.attempts or 0) + 1
+        }, update_modified=False)
+        inc("usp_webhook_inbox_events_total", event=status.lower())
+    frappe.db.commit()
+    return False
+
+
+@instrumented_job("requeue_stale_webhook_events")
+def requeue_stale_webhook_events():
+    """Red de seguridad (cron cada minuto): reencola transacciones con eventos sin procesar"""
+    cutoff = frappe.utils.add_to_date(frappe.utils.now_datetime(), seconds=-STALE_SECONDS)
+    transaction_ids = frappe.get_all(
+        DOCTYPE,
+        filters={"status": "Queued", "received_at": ("<", cutoff)},
+        pluck="transaction_id",
+        distinct=True,
+        limit=500
+    )
+    for transaction_id in transaction_ids:
+        enqueue_transaction(transaction_id)
+
+
+@instrumented_job("purge_webhook_events")
+def purge_webhook_events():
+    """Elimina eventos ya resueltos más viejos que usp_webhook_retention_days (diario)"""
+    days = frappe.conf.get("usp_webhook_retention_days") or DEFAULT_RETENTION_DAYS
+    cutoff = frappe.utils.add_days(frappe.utils.now(), -int(days))
+    frappe.db.delete(DOCTYPE, {
+        "status": ("in", ["Processed", "Ignored", "Coalesced", "Superseded"]),
+        "received_at": ("<", cutoff)
+    })
+    frappe.db.commit()
@@ -0,0 +1,141 @@
+# gateway_usp/api/widget_cache.py
+
+import hashlib
+import time
+
+import frappe
+
+DEFAULT_TTL = 900           # segundos que una entrada se considera fresca
+STALE_FACTOR = 4            # la entrada se conserva TTL * factor para servirla vencida mientras se refresca
+LOCK_SECONDS = 30           # duración máxima del refresco de un worker
+WAIT_FOR_REFRESH = 2.0      # espera máxima cuando no hay ninguna copia y otro worker está refrescando
+DEFAULT_CULTURES = ("es", "en")
+
+
+def _ttl():
+    return frappe.conf.get("usp_widget_cache_ttl") or DEFAULT_TTL
+
+
+def _cache_key(sdk, culture):
+    # La API key nunca se guarda en claro en la clave
+    api_key_hash = hashlib.sha256((sdk.api_key or "").encode()).hexdigest()[:16]
+    return f"usp_widget|{sdk.environment}|{api_key_hash}|{culture}"
+
+
+def _result(entry, cache_status):
+    return {
+        "IsSuccess": True,
+        "WidgetHTML": entry["html"],
+        "ResponseCode": "T00",
+        "ResponseMessage": "Success",
+        "CacheStatus": cache_status
+    }
+
+
+def _acquire_lock(cache, key):
+    return bool(cache.set(cache.make_key(f"{key}|lock"), 1, nx=True, ex=LOCK_SECONDS))
+
+
+def _release_lock(cache, key):
+    cache.delete(cache.make_key(f"{key}|lock"))
+
+
+def _store(cache, key, entry):
+    ttl = _ttl()
+    entry["expires_at"] = time.time() + ttl
+    cache.set_value(key, entry, expires_in_sec=ttl * STALE_FACTOR)
+    return entry
+
+
+def _refresh(sdk, cache, key, culture, entry):
+    """Descarga el widget con revalidación condicional y actualiza la caché"""
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = sdk._guarded("Widget", sdk._widget_get, sdk._widget_params(None, culture), headers or None)
+    except Exception:
+        # Gateway caído o circuito abierto: la copia vencida sigue siendo válida para el checkout
+        if entry:
+            return _result(entry, "stale")
+        raise
+
+    if response.status_code == 304 and entry:
+        return _result(_store(cache, key, entry), "revalidated")
+
+    result = sdk._handle_response("Widget", response)
+    if not result.get("IsSuccess"):
+        # Ante un error del gateway se sigue sirviendo la copia vencida si existe
+        return _result(entry, "stale") if entry else result
+
+    _store(cache, key, {
+        "html": result["WidgetHTML"],
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified")
+    })
+    result["CacheStatus"] = "miss"
+    return result
+
+
+def get_cached_widget(sdk, culture="es", force_refresh=False):
+    """
+    Widget de tokenización desde la caché del sitio
+
+    Solo un worker refresca una entrada vencida; el resto sirve la copia anterior
+    mientras tanto (o espera brevemente si todavía no existe ninguna).
+    """
+    cache = frappe.cache()
+    key = _cache_key(sdk, culture)
+    entry = cache.get_value(key, expires=True)
+
+    if entry and not force_refresh and time.time() < entry["expires_at"]:
+        return _result(entry, "hit")
+
+    if _acquire_lock(cache, key):
+        try:
+            return _refresh(sdk, cache, key, culture, entry)
+        finally:
+            _release_lock(cache, key)
+
+    if entry:
+        return _result(entry, "stale")
+
+    # Primera carga en curso en otro worker: esperar su resultado en vez de duplicar la descarga
+    deadline = time.monotonic() + WAIT_FOR_REFRESH
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        entry = cache.get_value(key, expires=True)
+        if entry:
+            return _result(entry, "hit")
+
+    return sdk.create_token_widget(culture=culture, use_cache=False)
+
+
+def invalidate_widget_cache(sdk, cultures=None):
+    """Elimina las entradas de widget del SDK indicado"""
+    cache = frappe.cache()
+    for culture in cultures or _cultures():
+        cache.delete_value(_cache_key(sdk, culture))
+
+
+def _cultures():
+    return frappe.conf.get("usp_widget_cultures") or DEFAULT_CULTURES
+
+
+def prewarm_widget_cache():
+    """Carga el widget de todas las culturas configuradas (job tras guardar la configuración)"""
+    from .xpresspago_sdk import MockXpresspagoSDK, get_xpresspago_sdk
+
+    sdk = get_xpresspago_sdk()
+    if isinstance(sdk, MockXpresspagoSDK):
+        return
+
+    for culture in _cultures():
+        try:
+            get_cached_widget(sdk, culture, force_refresh=True)
+        except Exception as e:
+            frappe.log_error(f"Error precargando widget USP ({culture}): {str(e)}")
@@ -0,0 +1,194 @@
+# gateway_usp/api/xpresspago_async.py
+
+import asyncio
+import functools
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import frappe
+
+from ..utils import metrics
+from .circuit_breaker import CircuitOpenError
+from .retry import sale_with_retries_async
+from .xpresspago_sdk import MockXpresspagoSDK, get_xpresspago_sdk
+
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+class DeadlineExceeded(Exception):
+    """La operación no terminó dentro del plazo indicado"""
+
+
+class AsyncXpresspagoSDK:
+    """
+    Variante asyncio del SDK CROEM para procesos batch
+
+    Reutiliza el SDK síncrono para construir los sobres y parsear las respuestas;
+    solo la E/S HTTP corre en un pool de hilos sobre el transporte keep-alive compartido.
+    """
+
+    def __init__(self, sdk, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, executor=None):
+        """
+        Args:
+            sdk: instancia de XpresspagoSDK ya configurada
+            max_concurrency: máximo de llamadas simultáneas al gateway
+            executor: pool de hilos propio (opcional)
+        """
+        self.sdk = sdk
+        self.max_concurrency = max(int(max_concurrency or DEFAULT_MAX_CONCURRENCY), 1)
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._loop = None
+        self._semaphore = None
+
+    @property
+    def environment(self):
+        return self.sdk.environment
+
+    async def ping(self, deadline: float | None = None) -> dict[str, Any]:
+        """Ping asíncrono"""
+        return await self._call("Ping", self.sdk._soap_post, "Ping", deadline=deadline)
+
+    async def create_token_widget(self, token=None, culture="es", deadline: float | None = None) -> dict[str, Any]:
+        """Widget de tokenización asíncrono"""
+        params = self.sdk._widget_params(token, culture)
+        return await self._call("Widget", self.sdk._widget_get, params, deadline=deadline)
+
+    async def sale(self, account_token: str, amount: float, currency_code: str = "840",
+                   client_tracking: str | None = None, deadline: float | None = None, **kwargs) -> dict[str, Any]:
+        """Venta asíncrona con los mismos reintentos e idempotencia por client_tracking que sale()"""
+        try:
+            values = self.sdk._sale_values(account_token, amount, currency_code, client_tracking, **kwargs)
+            result = await sale_with_retries_async(self, values, deadline=deadline)
+        except Exception as e:
+            result = self.sdk._error_result("Sale", e)
+        self.sdk._record_sale_result(result)
+        return result
+
+    async def get_token_details(self, account_number: str, deadline: float | None = None) -> dict[str, Any]:
+        """Detalles de token asíncronos"""
+        values = self.sdk._token_details_values(account_number)
+        return await self._call("GetTokenDetails", self.sdk._soap_post, "GetTokenDetails", values, deadline=deadline)
+
+    async def gather(self, operation: str, calls: Iterable[dict[str, Any]],
+                     deadline: float | None = None) -> list[dict[str, Any]]:
+        """
+        Ejecuta muchas llamadas de la misma operación respetando el límite de concurrencia
+
+        Args:
+            operation: ping, sale, get_token_details o create_token_widget
+            calls: kwargs de cada llamada
+            deadline: plazo por llamada en segundos
+        """
+        method = getattr(self, operation)
+        return await asyncio.gather(*(method(deadline=deadline, **kwargs) for kwargs in calls))
+
+    def run_sync(self, awaitable):
+        """Fachada síncrona para jobs de Frappe: ejecuta la corrutina en un loop propio"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(awaitable)
+        raise RuntimeError("run_sync no puede usarse dentro de un event loop activo")
+
+    def run_batch(self, operation: str, calls: Iterable[dict[str, Any]],
+                  deadline: float | None = None) -> list[dict[str, Any]]:
+        """Versión síncrona de gather()"""
+        return self.run_sync(self.gather(operation, list(calls), deadline=deadline))
+
+    def close(self):
+        """Libera el pool de hilos propio"""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_semaphore(self):
+        # Los semáforos quedan ligados a un loop; run_sync crea uno nuevo en cada llamada
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix="usp-async"
+            )
+        return self._executor
+
+    async def _request(self, operation, request_func, *args, deadline=None):
+        """Petición HTTP bajo el breaker; devuelve la respuesta o lanza el error"""
+        loop = asyncio.get_running_loop()
+        # El breaker usa la caché del sitio: se consulta siempre desde el hilo del loop
+        breaker = self.sdk.breaker(operation)
+        async with self._get_semaphore():
+            if not breaker.allow():
+                metrics.inc("usp_gateway_circuit_rejections_total",
+                            operation=operation, environment=self.environment)
+                raise CircuitOpenError(f"Circuito abierto para {operation}")
+
+            timeout = breaker.timeout()
+            if deadline:
+                timeout = min(timeout, deadline)
+
+            started = time.monotonic()
+            future = loop.run_in_executor(
+                self._get_executor(),
+                functools.partial(request_func, *args, timeout=timeout)
+            )
+            try:
+                response = await asyncio.wait_for(future, deadline) if deadline else await future
+            except asyncio.TimeoutError:
+                self.sdk._record_latency(breaker, operation, time.monotonic() - started, None)
+                raise DeadlineExceeded(f"Deadline de {deadline}s excedido")
+            except Exception:
+                self.sdk._record_latency(breaker, operation, time.monotonic() - started, None)
+                raise
+            self.sdk._record_latency(breaker, operation, time.monotonic() - started, response.status_code)
+        return response
+
+    async def _call(self, operation, request_func, *args, deadline=None):
+        try:
+            response = await self._request(operation, request_func, *args, deadline=deadline)
+            return self.sdk._handle_response(operation, response)
+        except Exception as e:
+            return self.sdk._error_result(operation, e)
+
+
+class AsyncMockXpresspagoSDK(AsyncXpresspagoSDK):
+    """Variante asyncio del SDK Mock; no usa red ni hilos"""
+
+    async def ping(self, deadline: float | None = None) -> dict[str, Any]:
+        return await self._mock_call(self.sdk.ping)
+
+    async def create_token_widget(self, token=None, culture="es", deadline: float | None = None) -> dict[str, Any]:
+        return await self._mock_call(self.sdk.create_token_widget, token=token, culture=culture)
+
+    async def sale(self, account_token: str, amount: float, currency_code: str = "840",
+                   client_tracking: str | None = None, deadline: float | None = None, **kwargs) -> dict[str, Any]:
+        return await self._mock_call(self.sdk.sale, account_token, amount, currency_code, client_tracking, **kwargs)
+
+    async def get_token_details(self, account_number: str, deadline: float | None = None) -> dict[str, Any]:
+        return await self._mock_call(self.sdk.get_token_details, account_number)
+
+    async def _mock_call(self, func, *args, **kwargs):
+        async with self._get_semaphore():
+            # Ceder el control para que el orden de finalización sea realista
+            await asyncio.sleep(0)
+            return func(*args, **kwargs)
+
+
+def wrap_sdk(sdk, max_concurrency=None, executor=None):
+    """Envuelve un SDK síncrono en la variante asyncio que le corresponde"""
+    max_concurrency = max_concurrency or frappe.conf.get("usp_async_max_concurrency") or DEFAULT_MAX_CONCURRENCY
+    async_class = AsyncMockXpresspagoSDK if isinstance(sdk, MockXpresspagoSDK) else AsyncXpresspagoSDK
+    return async_class(sdk, max_concurrency=max_concurrency, executor=executor)
+
+
+def get_async_xpresspago_sdk(max_concurrency=None):
+    """Obtiene el SDK asyncio configurado según USP Payment Gateway Settings"""
+    return wrap_sdk(get_xpresspago_sdk(), max_concurrency=max_concurrency)
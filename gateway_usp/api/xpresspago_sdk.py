@@ -1,19 +1,43 @@
 # gateway_usp/api/xpresspago_sdk.py
 
+import asyncio
+import os
+import threading
 import frappe
 import requests
 import json
+import time
+import uuid
 import hmac
 import hashlib
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from frappe.utils import flt
 from typing import Dict, Any, Optional
 
+from .circuit_breaker import CircuitOpenError, get_breaker
+from .retry import sale_with_retries
+from .soap_envelope import encode_envelope, soap_headers
+from .soap_parser import parse_soap_response
+from .transport import get_transport
+from ..utils import metrics
+
+# Timeouts por defecto de cada operación (segundos)
+OPERATION_TIMEOUTS = {
+    "Ping": 10,
+    "Sale": 30,
+    "GetTokenDetails": 10,
+    "Widget": 10
+}
+
+# Código devuelto cuando el circuit breaker rechaza la llamada
+CIRCUIT_OPEN_CODE = "998"
+
 class XpresspagoSDK:
     """SDK mejorado basado en documentación CROEM API Token v6.5"""
     
     def __init__(self, environment="SANDBOX", api_key=None, access_code=None, 
-                 merchant_account_number=None, terminal_name=None):
+                 merchant_account_number=None, terminal_name=None, base_urls=None):
         """
         Inicializa el SDK con configuración CROEM
         
@@ -23,6 +47,7 @@ class XpresspagoSDK:
             access_code: Código de acceso del comercio
             merchant_account_number: MID provisto por el Banco Adquirente
             terminal_name: TID provisto por el Banco Adquirente
+            base_urls: URLs alternativas por ambiente (p. ej. servidor CROEM local)
         """
         self.environment = environment
         self.api_key = api_key or "TEST_API_KEY"
@@ -31,7 +56,7 @@ class XpresspagoSDK:
         self.terminal_name = terminal_name or "TEST_TERMINAL"
         
         # URLs basadas en la documentación CROEM
-        self.base_urls = {
+        self.base_urls = base_urls or {
             "SANDBOX": {
                 "api": "https://tokenv2test.merchantprocess.net/TokenWebService.asmx",
                 "widget": "https://apicomponentv2-test.merchantprocess.net/UIComponent/CreditCard"
@@ -42,72 +67,149 @@ class XpresspagoSDK:
             }
         }
         
-        self.base_url = self.base_urls.get(environment, self.base_urls["SANDBOX"])["api"]
-        self.widget_url = self.base_urls.get(environment, self.base_urls["SANDBOX"])["widget"]
+        urls = self.base_urls.get(environment) or next(iter(self.base_urls.values()))
+        self.base_url = urls["api"]
+        self.widget_url = urls["widget"]
+        
+        # Pool keep-alive compartido por ambiente y proceso
+        self.transport = get_transport(environment)
     
     def ping(self) -> Dict[str, Any]:
         """Verifica la disponibilidad del servicio según documentación CROEM"""
         try:
-            headers = {
-                "Content-Type": "text/xml; charset=utf-8",
-                "SOAPAction": "http://tempuri.org/Ping"
-            }
-            
-            soap_body = """<?xml version="1.0" encoding="utf-8"?>
-            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
-                          xmlns:tem="http://tempuri.org/">
-                <soap:Header/>
-                <soap:Body>
-                    <tem:Ping></tem:Ping>
-                </soap:Body>
-            </soap:Envelope>"""
-            
-            response = requests.post(
-                self.base_url,
-                data=soap_body,
-                headers=headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                return {
-                    "IsSuccess": True,
-                    "PingResult": datetime.now().strftime("%m/%d/%Y %I:%M:%S %p"),
-                    "ResponseCode": "00",
-                    "ResponseMessage": "Service Available"
-                }
-            else:
-                return {
-                    "IsSuccess": False,
-                    "ResponseCode": "999",
-                    "ResponseMessage": f"HTTP Error: {response.status_code}"
-                }
-                
+            response = self._guarded("Ping", self._soap_post, "Ping")
+            return self._handle_response("Ping", response)
         except Exception as e:
-            frappe.log_error(f"Error en ping: {str(e)}")
-            return {
-                "IsSuccess": False,
-                "ResponseCode": "999",
-                "ResponseMessage": f"Connection Error: {str(e)}"
-            }
+            return self._error_result("Ping", e)
     
-    def create_token_widget(self, token=None, culture="es") -> Dict[str, Any]:
+    def create_token_widget(self, token=None, culture="es", use_cache=True) -> Dict[str, Any]:
         """Obtiene el widget de tokenización según documentación CROEM"""
         try:
-            params = {
-                "APIKey": self.api_key,
-                "Culture": culture
-            }
-            
-            if token:
-                params["Token"] = token
-            
-            response = requests.get(
-                self.widget_url,
-                params=params,
-                timeout=10
-            )
-            
+            if use_cache and not token:
+                # El HTML solo depende de APIKey y cultura: se sirve desde la caché del sitio
+                from .widget_cache import get_cached_widget
+                return get_cached_widget(self, culture)
+            response = self._guarded("Widget", self._widget_get, self._widget_params(token, culture))
+            return self._handle_response("Widget", response)
+        except Exception as e:
+            return self._error_result("Widget", e)
+    
+    def sale(self, account_token: str, amount: float, currency_code: str = "840", 
+             client_tracking: str = None, **kwargs) -> Dict[str, Any]:
+        """Procesa una venta usando token según documentación CROEM"""
+        try:
+            values = self._sale_values(account_token, amount, currency_code, client_tracking, **kwargs)
+            # Reintentos con backoff, deduplicados por client_tracking
+            result = sale_with_retries(self, values)
+        except Exception as e:
+            result = self._error_result("Sale", e)
+        self._record_sale_result(result)
+        return result
+    
+    def get_token_details(self, account_number: str) -> Dict[str, Any]:
+        """Obtiene detalles de un token según documentación CROEM"""
+        try:
+            values = self._token_details_values(account_number)
+            response = self._guarded("GetTokenDetails", self._soap_post, "GetTokenDetails", values)
+            return self._handle_response("GetTokenDetails", response)
+        except Exception as e:
+            return self._error_result("GetTokenDetails", e)
+    
+    def _sale_values(self, account_token, amount, currency_code="840", client_tracking=None, **kwargs):
+        """Parámetros SOAP de Sale"""
+        return {
+            "APIKey": self.api_key,
+            "accountToken": account_token,
+            "accessCode": self.access_code,
+            "merchantAccountNumber": self.merchant_account_number,
+            "terminalName": self.terminal_name,
+            "clientTracking": client_tracking,
+            "amount": amount,
+            "currencyCode": currency_code,
+            "emailAddress": kwargs.get("email_address"),
+            "cvv": kwargs.get("cvv")
+        }
+    
+    def _token_details_values(self, account_number):
+        """Parámetros SOAP de GetTokenDetails"""
+        return {
+            "APIKey": self.api_key,
+            "accountNumber": account_number
+        }
+    
+    def _widget_params(self, token=None, culture="es"):
+        """Parámetros GET del UIComponent"""
+        params = {
+            "APIKey": self.api_key,
+            "Culture": culture
+        }
+        if token:
+            params["Token"] = token
+        return params
+    
+    def breaker(self, operation: str):
+        """Circuit breaker compartido de la operación en este ambiente"""
+        return get_breaker(self.environment, operation, OPERATION_TIMEOUTS[operation])
+    
+    def _guarded(self, operation: str, request_func, *args):
+        """Ejecuta la petición HTTP bajo el circuit breaker con timeout adaptativo"""
+        breaker = self.breaker(operation)
+        if not breaker.allow():
+            metrics.inc("usp_gateway_circuit_rejections_total", operation=operation, environment=self.environment)
+            raise CircuitOpenError(f"Circuito abierto para {operation}")
+        
+        started = time.monotonic()
+        try:
+            response = request_func(*args, timeout=breaker.timeout())
+        except Exception:
+            self._record_latency(breaker, operation, time.monotonic() - started, None)
+            raise
+        
+        self._record_latency(breaker, operation, time.monotonic() - started, response.status_code)
+        return response
+    
+    def _record_latency(self, breaker, operation, latency, status_code):
+        """Alimenta el circuit breaker y el histograma de latencia del gateway"""
+        # Los rechazos de negocio no cuentan como fallo; solo errores de red y 5xx
+        success = status_code is not None and status_code < 500
+        breaker.record(latency, success)
+        metrics.observe(
+            "usp_gateway_request_duration_seconds", latency,
+            operation=operation,
+            environment=self.environment,
+            outcome="ok" if success else ("network_error" if status_code is None else "http_5xx")
+        )
+    
+    def _record_sale_result(self, result):
+        """Cuenta el resultado de Sale por código para calcular la tasa de aprobación"""
+        metrics.inc(
+            "usp_sale_results_total",
+            environment=self.environment,
+            approved="true" if result.get("IsSuccess") else "false",
+            code=result.get("ResponseCode") or ""
+        )
+    
+    def _soap_post(self, operation: str, values: Optional[Dict[str, Any]] = None, timeout: float = 10):
+        """Envía una operación SOAP con el sobre precompilado sobre el transporte compartido"""
+        return self.transport.post(
+            self.base_url,
+            data=encode_envelope(operation, values),
+            headers=soap_headers(operation),
+            timeout=timeout
+        )
+    
+    def _widget_get(self, params, headers: Optional[Dict[str, str]] = None, timeout: float = 10):
+        """Descarga el widget de tokenización sobre el transporte compartido"""
+        return self.transport.get(
+            self.widget_url,
+            params=params,
+            headers=headers,
+            timeout=timeout
+        )
+    
+    def _handle_response(self, operation: str, response) -> Dict[str, Any]:
+        """Convierte la respuesta HTTP de una operación en el resultado del SDK"""
+        if operation == "Widget":
             if response.status_code == 200:
                 return {
                     "IsSuccess": True,
@@ -115,143 +217,75 @@ class XpresspagoSDK:
                     "ResponseCode": "T00",
                     "ResponseMessage": "Success"
                 }
-            else:
-                return {
-                    "IsSuccess": False,
-                    "ResponseCode": "T01",
-                    "ResponseMessage": f"Widget Error: {response.status_code}"
-                }
-                
-        except Exception as e:
-            frappe.log_error(f"Error obteniendo widget: {str(e)}")
             return {
                 "IsSuccess": False,
                 "ResponseCode": "T01",
-                "ResponseMessage": f"Widget Error: {str(e)}"
-            }
-    
-    def sale(self, account_token: str, amount: float, currency_code: str = "840", 
-             client_tracking: str = None, **kwargs) -> Dict[str, Any]:
-        """Procesa una venta usando token según documentación CROEM"""
-        try:
-            soap_body = f"""<?xml version="1.0" encoding="utf-8"?>
-            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
-                          xmlns:tem="http://tempuri.org/">
-                <soap:Header/>
-                <soap:Body>
-                    <tem:Sale>
-                        <tem:APIKey>{self.api_key}</tem:APIKey>
-                        <tem:accountToken>{account_token}</tem:accountToken>
-                        <tem:accessCode>{self.access_code}</tem:accessCode>
-                        <tem:merchantAccountNumber>{self.merchant_account_number}</tem:merchantAccountNumber>
-                        <tem:terminalName>{self.terminal_name}</tem:terminalName>
-                        <tem:clientTracking>{client_tracking or ''}</tem:clientTracking>
-                        <tem:amount>{amount}</tem:amount>
-                        <tem:currencyCode>{currency_code}</tem:currencyCode>
-                        <tem:emailAddress>{kwargs.get('email_address', '')}</tem:emailAddress>
-                        <tem:cvv>{kwargs.get('cvv', '')}</tem:cvv>
-                    </tem:Sale>
-                </soap:Body>
-            </soap:Envelope>"""
-            
-            headers = {
-                "Content-Type": "text/xml; charset=utf-8",
-                "SOAPAction": "http://tempuri.org/Sale"
+                "ResponseMessage": f"Widget Error: {response.status_code}"
             }
-            
-            response = requests.post(
-                self.base_url,
-                data=soap_body,
-                headers=headers,
-                timeout=30
-            )
-            
-            # Parsear respuesta SOAP
-            if response.status_code == 200:
-                return self._parse_soap_response(response.text, "Sale")
-            else:
+        
+        if response.status_code != 200:
+            if operation == "GetTokenDetails":
                 return {
                     "IsSuccess": False,
-                    "ResponseCode": "999",
-                    "ResponseMessage": f"HTTP Error: {response.status_code}"
+                    "ResponseCode": "T04",
+                    "ResponseMessage": "Token not found"
                 }
-                
-        except Exception as e:
-            frappe.log_error(f"Error en sale: {str(e)}")
             return {
                 "IsSuccess": False,
                 "ResponseCode": "999",
-                "ResponseMessage": f"Transaction Error: {str(e)}"
+                "ResponseMessage": f"HTTP Error: {response.status_code}"
             }
+        
+        result = self._parse_soap_response(response.content, operation)
+        
+        if operation == "Ping" and result.get("ResponseCode") != "999":
+            # El servicio respondió: está disponible aunque no envíe PingResult
+            result.IsSuccess = True
+            result.PingResult = result.PingResult or datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")
+            result.ResponseMessage = "Service Available"
+        
+        return result
     
-    def get_token_details(self, account_number: str) -> Dict[str, Any]:
-        """Obtiene detalles de un token según documentación CROEM"""
-        try:
-            soap_body = f"""<?xml version="1.0" encoding="utf-8"?>
-            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
-                          xmlns:tem="http://tempuri.org/">
-                <soap:Header/>
-                <soap:Body>
-                    <tem:GetTokenDetails>
-                        <tem:APIKey>{self.api_key}</tem:APIKey>
-                        <tem:accountNumber>{account_number}</tem:accountNumber>
-                    </tem:GetTokenDetails>
-                </soap:Body>
-            </soap:Envelope>"""
-            
-            headers = {
-                "Content-Type": "text/xml; charset=utf-8",
-                "SOAPAction": "http://tempuri.org/GetTokenDetails"
+    def _error_result(self, operation: str, error: Exception) -> Dict[str, Any]:
+        """Registra el error y devuelve el resultado de fallo de la operación"""
+        if isinstance(error, CircuitOpenError):
+            # Fallo rápido: no se registra en Error Log para no inundarlo durante una caída
+            return {
+                "IsSuccess": False,
+                "ResponseCode": CIRCUIT_OPEN_CODE,
+                "ResponseMessage": f"Service Unavailable: {str(error)}"
             }
-            
-            response = requests.post(
-                self.base_url,
-                data=soap_body,
-                headers=headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                return self._parse_soap_response(response.text, "GetTokenDetails")
-            else:
-                return {
-                    "IsSuccess": False,
-                    "ResponseCode": "T04",
-                    "ResponseMessage": "Token not found"
-                }
-                
-        except Exception as e:
-            frappe.log_error(f"Error obteniendo token details: {str(e)}")
+        if operation == "Ping":
+            frappe.log_error(f"Error en ping: {str(error)}")
+            return {
+                "IsSuccess": False,
+                "ResponseCode": "999",
+                "ResponseMessage": f"Connection Error: {str(error)}"
+            }
+        if operation == "Widget":
+            frappe.log_error(f"Error obteniendo widget: {str(error)}")
             return {
                 "IsSuccess": False,
                 "ResponseCode": "T01",
-                "ResponseMessage": f"Error: {str(e)}"
+                "ResponseMessage": f"Widget Error: {str(error)}"
             }
-    
-    def _parse_soap_response(self, xml_response: str, operation: str) -> Dict[str, Any]:
-        """Parser simple para respuestas SOAP"""
-        try:
-            # Implementación básica de parsing
-            # En una implementación completa, usarías un parser XML más robusto
-            if "IsSuccess" in xml_response and "true" in xml_response:
-                return {
-                    "IsSuccess": True,
-                    "TransactionId": f"TXN_{datetime.now().strftime('%Y%m%d%H%M%S')}",
-                    "ResponseCode": "00",
-                    "ResponseMessage": "Success"
-                }
-            else:
-                return {
-                    "IsSuccess": False,
-                    "ResponseCode": "01",
-                    "ResponseMessage": "Transaction declined"
-                }
-        except Exception as e:
+        if operation == "GetTokenDetails":
+            frappe.log_error(f"Error obteniendo token details: {str(error)}")
             return {
                 "IsSuccess": False,
-                "ResponseCode": "999",
-                "ResponseMessage": f"Parse error: {str(e)}"
+                "ResponseCode": "T01",
+                "ResponseMessage": f"Error: {str(error)}"
             }
+        frappe.log_error(f"Error en sale: {str(error)}")
+        return {
+            "IsSuccess": False,
+            "ResponseCode": "999",
+            "ResponseMessage": f"Transaction Error: {str(error)}"
+        }
+    
+    def _parse_soap_response(self, xml_response, operation: str) -> Dict[str, Any]:
+        """Parsea la respuesta SOAP conservando TransactionId y ResponseCode del gateway"""
+        return parse_soap_response(xml_response, operation)
 
 
 class MockXpresspagoSDK(XpresspagoSDK):
@@ -266,7 +300,7 @@ class MockXpresspagoSDK(XpresspagoSDK):
             "ResponseMessage": "Mock Service Available"
         }
     
-    def create_token_widget(self, token=None, culture="es") -> Dict[str, Any]:
+    def create_token_widget(self, token=None, culture="es", use_cache=True) -> Dict[str, Any]:
         """Mock widget que simula HTML válido"""
         mock_html = """
         <div class="mock-widget">
@@ -289,7 +323,7 @@ class MockXpresspagoSDK(XpresspagoSDK):
         """Mock sale que simula transacción exitosa"""
         return {
             "IsSuccess": True,
-            "TransactionId": f"MOCK_TXN_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            "TransactionId": f"MOCK_TXN_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6].upper()}",
             "Amount": amount,
             "Currency": currency_code,
             "Status": "Completed",
@@ -321,8 +355,9 @@ class CustomerManager:
         """Busca un cliente usando token details"""
         unique_id = filters.get("unique_identifier")
         
-        # Usar GetTokenDetails para buscar
-        result = self.sdk.get_token_details(unique_id)
+        # Usar GetTokenDetails para buscar (cacheado en memoria y Redis)
+        from .token_cache import get_token_details
+        result = get_token_details(self.sdk, unique_id)
         
         if result.get("IsSuccess"):
             return {
@@ -359,9 +394,62 @@ class CustomerManager:
         return self.create_customer(customer_data)
 
 
+class BulkSaleReport:
+    """Resumen de una corrida de process_sales"""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.processed = 0
+        self.approved = 0
+        self.failed = 0
+        self.recorded = 0
+        self.errors = {}
+    
+    def add(self, result):
+        self.processed += 1
+        if result.get("IsSuccess"):
+            self.approved += 1
+        else:
+            self.failed += 1
+            code = result.get("ResponseCode") or "unknown"
+            self.errors[code] = self.errors.get(code, 0) + 1
+    
+    def finish(self):
+        self.finished = time.monotonic()
+    
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+    
+    @property
+    def charges_per_second(self):
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+    
+    def as_dict(self):
+        return {
+            "processed": self.processed,
+            "approved": self.approved,
+            "failed": self.failed,
+            "recorded": self.recorded,
+            "elapsed_seconds": round(self.elapsed, 3),
+            "charges_per_second": round(self.charges_per_second, 2),
+            "errors_by_code": dict(self.errors)
+        }
+
+
 class TransactionManager:
     """Gestor de transacciones usando API CROEM"""
     
+    # Columnas escritas en bloque en USP Transaction
+    BULK_FIELDS = (
+        "name", "owner", "modified_by", "creation", "modified", "docstatus",
+        "transaction_id", "reference_doctype", "reference_docname", "customer",
+        "amount", "currency", "status", "payment_method", "gateway_response_code",
+        "gateway_message", "error_message", "created_at",
+        "updated_at", "processed_at"
+    )
+    
     def __init__(self, sdk):
         self.sdk = sdk
     
@@ -375,102 +463,366 @@ class TransactionManager:
             email_address=transaction_data.get("email_address", ""),
             cvv=transaction_data.get("cvv", "")
         )
+    
+    def process_sales(self, transactions, max_concurrency=None, batch_size=100, record=True, report=None):
+        """
+        Procesa ventas en bloque y produce los resultados a medida que terminan
+        
+        Args:
+            transactions: iterable de dicts con el formato de process_sale
+                (más reference_doctype, reference_docname, client_key, customer y currency para el registro)
+            max_concurrency: máximo de ventas simultáneas en el gateway
+            batch_size: filas de USP Transaction por inserción en bloque
+            record: escribir las transacciones en USP Transaction
+            report: BulkSaleReport a completar (opcional)
+        
+        Yields:
+            {"transaction": datos de entrada, "result": resultado del gateway}
+        """
+        from .xpresspago_async import wrap_sdk
+        
+        report = report if report is not None else BulkSaleReport()
+        async_sdk = wrap_sdk(self.sdk, max_concurrency=max_concurrency)
+        # Ventana de tareas en vuelo: no se materializa el iterable completo
+        window = async_sdk.max_concurrency * 2
+        iterator = iter(transactions)
+        rows = []
+        loop = asyncio.new_event_loop()
+        
+        def fill(pending):
+            while len(pending) < window:
+                transaction_data = next(iterator, None)
+                if transaction_data is None:
+                    break
+                pending.add(loop.create_task(self._bulk_sale(async_sdk, transaction_data)))
+        
+        try:
+            pending = set()
+            fill(pending)
+            while pending:
+                done, pending = loop.run_until_complete(
+                    asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                )
+                for task in done:
+                    transaction_data, result = task.result()
+                    report.add(result)
+                    
+                    if record:
+                        rows.append((self._bulk_row(transaction_data, result), result))
+                        if len(rows) >= batch_size:
+                            report.recorded += self._flush_rows(rows)
+                    
+                    yield {"transaction": transaction_data, "result": result}
+                
+                fill(pending)
+        finally:
+            if record and rows:
+                report.recorded += self._flush_rows(rows)
+            loop.close()
+            async_sdk.close()
+            report.finish()
+            frappe.logger("gateway_usp").info({"event": "usp_bulk_sale", **report.as_dict()})
+    
+    async def _bulk_sale(self, async_sdk, transaction_data):
+        from .idempotency import client_tracking
+        
+        result = await async_sdk.sale(
+            account_token=transaction_data.get("card_token"),
+            amount=transaction_data.get("amount"),
+            currency_code="840",  # USD
+            # Sin order_tracking_number explícito: documento de referencia y client_key, como process_payment
+            client_tracking=transaction_data.get("order_tracking_number") or client_tracking(transaction_data),
+            email_address=transaction_data.get("email_address", ""),
+            cvv=transaction_data.get("cvv", "")
+        )
+        return transaction_data, result
+    
+    def _bulk_row(self, transaction_data, result):
+        """Fila de USP Transaction equivalente a la que crea process_payment"""
+        from gateway_usp.gateway_usp.doctype.usp_transaction.usp_transaction import make_transaction_id
+        
+        timestamp = frappe.utils.now()
+        transaction_id = result.get("TransactionId") or make_transaction_id()
+        is_success = bool(result.get("IsSuccess"))
+        user = frappe.session.user
+        
+        values = {
+            "name": transaction_id,
+            "owner": user,
+            "modified_by": user,
+            "creation": timestamp,
+            "modified": timestamp,
+            "docstatus": 0,
+            "transaction_id": transaction_id,
+            "reference_doctype": transaction_data.get("reference_doctype"),
+            "reference_docname": transaction_data.get("reference_docname"),
+            "customer": transaction_data.get("customer"),
+            "amount": flt(transaction_data.get("amount")),
+            "currency": transaction_data.get("currency", "USD"),
+            # Aprobadas quedan pendientes de confirmación por webhook, como en process_payment
+            "status": "Pending" if is_success else "Failed",
+            "payment_method": "Credit Card",
+            "gateway_response_code": result.get("ResponseCode"),
+            "gateway_message": result.get("ResponseMessage"),
+            "error_message": None if is_success else result.get("ResponseMessage"),
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "processed_at": None if is_success else timestamp
+        }
+        return tuple(values[field] for field in self.BULK_FIELDS)
+    
+    def _flush_rows(self, rows):
+        """Inserta las filas acumuladas (y sus respuestas comprimidas) en bloque y confirma el lote"""
+        from gateway_usp.utils import payload_store
+        
+        count = len(rows)
+        name_index = self.BULK_FIELDS.index("name")
+        frappe.db.bulk_insert("USP Transaction", fields=list(self.BULK_FIELDS),
+                              values=[row for row, result in rows], ignore_duplicates=True)
+        frappe.db.bulk_insert(
+            payload_store.DOCTYPE,
+            fields=list(payload_store.BULK_FIELDS),
+            values=[payload_store.bulk_row(row[name_index], response_data=dict(result)) for row, result in rows],
+            ignore_duplicates=True
+        )
+        # Confirmar cada lote: los cobros ya hechos no deben perderse si el job se interrumpe
+        frappe.db.commit()
+        rows.clear()
+        return count
 
 
 # Función actualizada para obtener SDK con manejo de errores mejorado
-def get_xpresspago_sdk():
-    """Obtiene una instancia configurada del SDK con manejo de errores mejorado"""
+def _build_xpresspago_sdk(settings):
+    """Construye el SDK a partir de USP Payment Gateway Settings"""
+    if not settings.is_enabled:
+        frappe.throw("Gateway USP no está habilitado")
+    
+    # Verificar si usar modo mock
+    use_mock = frappe.conf.get('usp_use_mock', False) or settings.get('use_mock_mode', False)
+    
+    # Obtener credenciales con manejo de errores mejorado
+    api_key = None
+    access_code = None
+    merchant_account_number = None
+    terminal_name = None
+    
+    # Obtener credenciales CROEM con manejo de errores
     try:
-        settings = frappe.get_single("USP Payment Gateway Settings")
+        if settings.get('api_key'):
+            api_key = settings.get('api_key')
         
-        if not settings.is_enabled:
-            frappe.throw("Gateway USP no está habilitado")
+        if settings.get('access_code'):
+            # Primero intentar obtener del campo directo
+            access_code = settings.get('access_code')
         
-        # Verificar si usar modo mock
-        use_mock = frappe.conf.get('usp_use_mock', False) or settings.get('use_mock_mode', False)
-        
-        # Obtener credenciales con manejo de errores mejorado
-        api_key = None
-        access_code = None
-        merchant_account_number = None
-        terminal_name = None
+        # Si no está en el campo directo, intentar obtener como contraseña
+        if not access_code:
+            try:
+                access_code = settings.get_password("access_code")
+            except Exception as e:
+                frappe.log_error(f"Error obteniendo access_code: {str(e)}")
+                access_code = None
         
-        # Obtener credenciales CROEM con manejo de errores
-        try:
-            if settings.get('api_key'):
-                api_key = settings.get('api_key')
+        if settings.get('merchant_account_number'):
+            merchant_account_number = settings.get('merchant_account_number')
+        if settings.get('terminal_name'):
+            terminal_name = settings.get('terminal_name')
             
-            if settings.get('access_code'):
-                # Primero intentar obtener del campo directo
-                access_code = settings.get('access_code')
+    except Exception as e:
+        frappe.log_error(f"Error obteniendo credenciales CROEM: {str(e)}")
+    
+    # Fallback a credenciales legacy si CROEM no está disponible
+    if not api_key or not access_code:
+        try:
+            api_key = api_key or settings.get('merchant_id')
+            merchant_account_number = merchant_account_number or settings.get('merchant_id')
+            terminal_name = terminal_name or settings.get('terminal_id')
             
-            # Si no está en el campo directo, intentar obtener como contraseña
             if not access_code:
-                try:
-                    access_code = settings.get_password("access_code")
-                except Exception as e:
-                    frappe.log_error(f"Error obteniendo access_code: {str(e)}")
-                    access_code = None
-            
-            if settings.get('merchant_account_number'):
-                merchant_account_number = settings.get('merchant_account_number')
-            if settings.get('terminal_name'):
-                terminal_name = settings.get('terminal_name')
-                
+                # Intentar obtener secret_key
+                if settings.get('secret_key'):
+                    access_code = settings.get('secret_key')
+                else:
+                    try:
+                        access_code = settings.get_password("secret_key")
+                    except Exception as e:
+                        frappe.log_error(f"Error obteniendo secret_key: {str(e)}")
+                        access_code = None
+                        
         except Exception as e:
-            frappe.log_error(f"Error obteniendo credenciales CROEM: {str(e)}")
-        
-        # Fallback a credenciales legacy si CROEM no está disponible
-        if not api_key or not access_code:
-            try:
-                api_key = api_key or settings.get('merchant_id')
-                merchant_account_number = merchant_account_number or settings.get('merchant_id')
-                terminal_name = terminal_name or settings.get('terminal_id')
-                
-                if not access_code:
-                    # Intentar obtener secret_key
-                    if settings.get('secret_key'):
-                        access_code = settings.get('secret_key')
-                    else:
-                        try:
-                            access_code = settings.get_password("secret_key")
-                        except Exception as e:
-                            frappe.log_error(f"Error obteniendo secret_key: {str(e)}")
-                            access_code = None
-                            
-            except Exception as e:
-                frappe.log_error(f"Error obteniendo credenciales legacy: {str(e)}")
+            frappe.log_error(f"Error obteniendo credenciales legacy: {str(e)}")
+    
+    # Usar valores por defecto si no se encuentran credenciales
+    api_key = api_key or "TEST_API_KEY"
+    access_code = access_code or "TEST_ACCESS_CODE"
+    merchant_account_number = merchant_account_number or "TEST_MERCHANT"
+    terminal_name = terminal_name or "TEST_TERMINAL"
+    
+    if use_mock:
+        return MockXpresspagoSDK(
+            environment=settings.environment,
+            api_key=api_key,
+            access_code=access_code,
+            merchant_account_number=merchant_account_number,
+            terminal_name=terminal_name
+        )
+    else:
+        return XpresspagoSDK(
+            environment=settings.environment,
+            api_key=api_key,
+            access_code=access_code,
+            merchant_account_number=merchant_account_number,
+            terminal_name=terminal_name
+        )
+
+
+def _fallback_sdk():
+    """SDK mock de último recurso cuando la configuración no puede leerse"""
+    return MockXpresspagoSDK(
+        environment="SANDBOX",
+        api_key="FALLBACK_API_KEY",
+        access_code="FALLBACK_ACCESS_CODE",
+        merchant_account_number="FALLBACK_MERCHANT",
+        terminal_name="FALLBACK_TERMINAL"
+    )
+
+
+# Registro de SDKs del proceso: sitio -> (sdk, versión de la configuración, momento de creación)
+_sdk_registry = {}
+_sdk_registry_lock = threading.Lock()
+
+# Canal Redis por el que se avisa a los demás workers que la configuración cambió
+SDK_REGISTRY_CHANNEL = "gateway_usp:sdk_registry"
+
+# Antigüedad máxima de un SDK registrado (además de la comparación de versión en cada consulta)
+SDK_REGISTRY_MAX_AGE = 300
+
+_subscriber = {"pid": None, "thread": None}
+
+
+def _settings_version():
+    """modified de la configuración (una lectura de tabSingles): detecta cambios sin depender del aviso"""
+    return str(frappe.db.get_value("USP Payment Gateway Settings", None, "modified") or "")
+
+
+def get_xpresspago_sdk():
+    """Obtiene una instancia configurada del SDK con manejo de errores mejorado"""
+    site = getattr(frappe.local, "site", None)
+    
+    def registered(version):
+        entry = _sdk_registry.get(site)
+        if entry is None or entry[1] != version or time.monotonic() - entry[2] >= SDK_REGISTRY_MAX_AGE:
+            return None
+        return entry[0]
+    
+    try:
+        version = _settings_version()
+    except Exception as e:
+        frappe.log_error(f"Error crítico inicializando SDK: {str(e)}")
+        return _fallback_sdk()
+    
+    # Un aviso perdido (suscriptor caído, reconexión de Redis) no deja credenciales viejas:
+    # la versión guardada se compara con la actual en cada consulta
+    sdk = registered(version)
+    if sdk is not None:
+        return sdk
+    
+    with _sdk_registry_lock:
+        sdk = registered(version)
+        if sdk is not None:
+            return sdk
         
-        # Usar valores por defecto si no se encuentran credenciales
-        api_key = api_key or "TEST_API_KEY"
-        access_code = access_code or "TEST_ACCESS_CODE"
-        merchant_account_number = merchant_account_number or "TEST_MERCHANT"
-        terminal_name = terminal_name or "TEST_TERMINAL"
+        try:
+            settings = frappe.get_single("USP Payment Gateway Settings")
+            sdk = _build_xpresspago_sdk(settings)
+        except Exception as e:
+            frappe.log_error(f"Error crítico inicializando SDK: {str(e)}")
+            # El mock de último recurso no se registra: se reintenta en la próxima llamada
+            return _fallback_sdk()
         
-        if use_mock:
-            return MockXpresspagoSDK(
-                environment=settings.environment,
-                api_key=api_key,
-                access_code=access_code,
-                merchant_account_number=merchant_account_number,
-                terminal_name=terminal_name
-            )
+        _ensure_registry_subscriber()
+        _sdk_registry[site] = (sdk, version, time.monotonic())
+        return sdk
+
+
+def clear_sdk_registry(site=None):
+    """Descarta el SDK registrado del sitio en este proceso (todos si site es None)"""
+    with _sdk_registry_lock:
+        if site is None:
+            _sdk_registry.clear()
         else:
-            return XpresspagoSDK(
-                environment=settings.environment,
-                api_key=api_key,
-                access_code=access_code,
-                merchant_account_number=merchant_account_number,
-                terminal_name=terminal_name
-            )
+            _sdk_registry.pop(site, None)
+
+
+def invalidate_sdk_registry(after_commit=True):
+    """Descarta el SDK del sitio actual en este proceso y avisa al resto de workers"""
+    site = getattr(frappe.local, "site", None)
+    clear_sdk_registry(site)
     
-    except Exception as e:
-        frappe.log_error(f"Error crítico inicializando SDK: {str(e)}")
-        # Retornar SDK mock como último recurso
-        return MockXpresspagoSDK(
-            environment="SANDBOX",
-            api_key="FALLBACK_API_KEY",
-            access_code="FALLBACK_ACCESS_CODE",
-            merchant_account_number="FALLBACK_MERCHANT",
-            terminal_name="FALLBACK_TERMINAL"
-        )
\ No newline at end of file
+    def publish():
+        try:
+            frappe.cache().publish(SDK_REGISTRY_CHANNEL, site or "")
+        except Exception as e:
+            frappe.log_error(f"Error publicando invalidación del SDK USP: {str(e)}")
+    
+    if after_commit:
+        # Publicar antes del commit permitiría a otro worker reconstruir con la configuración anterior
+        frappe.db.after_commit.add(publish)
+    else:
+        publish()
+
+
+def on_clear_cache():
+    """Hook clear_cache: bench clear-cache descarta el SDK registrado en todos los workers"""
+    invalidate_sdk_registry(after_commit=False)
+
+
+def sdk_registry_info():
+    """Versión y antigüedad del SDK registrado para el sitio actual"""
+    entry = _sdk_registry.get(getattr(frappe.local, "site", None))
+    if entry is None:
+        return {"registered": False}
+    return {
+        "registered": True,
+        "sdk": type(entry[0]).__name__,
+        "environment": entry[0].environment,
+        "settings_version": entry[1],
+        "age_seconds": round(time.monotonic() - entry[2], 1)
+    }
+
+
+def _ensure_registry_subscriber():
+    """Arranca (una vez por proceso) el hilo que escucha invalidaciones de otros workers"""
+    pid = os.getpid()
+    if _subscriber["pid"] == pid and _subscriber["thread"].is_alive():
+        return
+    
+    try:
+        client = frappe.cache()
+    except Exception:
+        return
+    
+    thread = threading.Thread(
+        target=_listen_registry_invalidations,
+        args=(client,),
+        name="usp-sdk-registry",
+        daemon=True
+    )
+    _subscriber.update(pid=pid, thread=thread)
+    thread.start()
+
+
+def _listen_registry_invalidations(client):
+    # Sin contexto de Frappe: este hilo solo toca el diccionario del registro
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SDK_REGISTRY_CHANNEL)
+            for message in pubsub.listen():
+                site = message.get("data")
+                if isinstance(site, bytes):
+                    site = site.decode()
+                clear_sdk_registry(site or None)
+        except Exception:
+            # Redis caído: se reintenta; mientras tanto SDK_REGISTRY_MAX_AGE acota el desfase
+            time.sleep(5)
\ No newline at end of file
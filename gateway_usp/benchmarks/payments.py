@@ -0,0 +1,413 @@
+# gateway_usp/benchmarks/payments.py
+#
+# Benchmark end-to-end de process_payment y process_payment_with_new_card
+# contra el SDK Mock o el servidor CROEM local (gateway_usp.utils.croem_standin).
+#
+# Ejecutar en un sitio de desarrollo (inserta transacciones y las borra al terminar;
+# los Error Log de auditoría se conservan):
+#   bench --site dev.local execute gateway_usp.benchmarks.payments.run \
+#       --kwargs '{"iterations": 500, "workers": 4, "gateway": "standin", "latency": "lognormal:80:0.4"}'
+#
+# Guardar una línea base (se versiona en el repositorio):
+#   ... run --kwargs '{"output": "apps/gateway_usp/gateway_usp/benchmarks/baselines/payments.json"}'
+#
+# Comparar contra la línea base (sale con código 1 si hay regresión):
+#   python -m gateway_usp.benchmarks.payments compare baselines/payments.json resultado.json [tolerancia]
+
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "payments.json")
+
+ENDPOINTS = ("process_payment", "process_payment_with_new_card")
+
+# Métricas comparadas por el gate: (clave, True si un valor mayor es peor)
+GATED_METRICS = (
+    ("p50_ms", True),
+    ("p95_ms", True),
+    ("p99_ms", True),
+    ("throughput_per_second", False),
+)
+
+TEST_CARD = {
+    "card_number": "4111111111111111",
+    "cardholder_name": "CLIENTE BENCHMARK",
+    "expiry_month": "12",
+    "expiry_year": "2029",
+    "cvv": "123"
+}
+
+
+class SectionTimer:
+    """
+    Acumula tiempo exclusivo por sección (sdk, db_insert, db_commit, logging) por hilo
+
+    Una sección anidada pausa a la que la contiene; logging absorbe lo anidado
+    (el insert de Error Log cuenta como logging, no como db_insert).
+    """
+
+    ABSORBING = {"logging"}
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.totals = {}
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.current = {}
+        return self._local.stack
+
+    def begin_request(self):
+        self._stack()
+        self._local.current = {}
+
+    def end_request(self):
+        current = getattr(self._local, "current", {})
+        with self._lock:
+            for section, elapsed in current.items():
+                self.totals[section] = self.totals.get(section, 0.0) + elapsed
+        return current
+
+    def wrap(self, section, func):
+        timer = self
+
+        def timed(*args, **kwargs):
+            stack = timer._stack()
+            if stack and stack[-1][0] in timer.ABSORBING:
+                return func(*args, **kwargs)
+
+            now = time.perf_counter()
+            if stack:
+                parent, started = stack[-1]
+                timer._add(parent, now - started)
+            stack.append([section, now])
+            try:
+                return func(*args, **kwargs)
+            finally:
+                now = time.perf_counter()
+                _section, started = stack.pop()
+                timer._add(section, now - started)
+                if stack:
+                    stack[-1][1] = now
+
+        timed.__wrapped__ = func
+        return timed
+
+    def _add(self, section, elapsed):
+        current = self._local.current
+        current[section] = current.get(section, 0.0) + elapsed
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return round(sorted_values[index], 2)
+
+
+def _instrument(timer):
+    """Reemplaza temporalmente los puntos medidos; devuelve la función que los restaura"""
+    import frappe
+    from frappe.model.document import Document
+
+    from gateway_usp.api import xpresspago_sdk
+    from gateway_usp.utils import audit, payment_utils
+
+    targets = [
+        (xpresspago_sdk.TransactionManager, "process_sale", "sdk"),
+        (xpresspago_sdk.CustomerManager, "search_customer", "sdk"),
+        (xpresspago_sdk.CustomerManager, "create_customer", "sdk"),
+        (xpresspago_sdk.CustomerManager, "save_customer", "sdk"),
+        (Document, "insert", "db_insert"),
+        (frappe, "log_error", "logging"),
+        (payment_utils, "log_usp_transaction", "logging"),
+        (audit, "audit", "logging"),
+        (audit, "flush_audit", "logging"),
+    ]
+
+    originals = []
+    for owner, name, section in targets:
+        original = getattr(owner, name)
+        originals.append((owner, name, original))
+        setattr(owner, name, timer.wrap(section, original))
+
+    def restore():
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+    return restore
+
+
+def _make_sdk(gateway, standin):
+    from gateway_usp.api.xpresspago_sdk import MockXpresspagoSDK, XpresspagoSDK
+
+    if gateway == "mock":
+        return MockXpresspagoSDK()
+    return XpresspagoSDK(environment="SANDBOX", base_urls=standin.base_urls)
+
+
+def _payload(endpoint, index, customer, amount):
+    payment_data = {
+        "amount": amount,
+        "currency": "USD",
+        "customer": customer,
+        "customer_id": customer,
+        "card_token": f"bench-token-{index}",
+        "reference_docname": None
+    }
+    if endpoint == "process_payment_with_new_card":
+        payment_data["card_data"] = dict(TEST_CARD)
+    return payment_data
+
+
+def _worker(site, sites_path, user, endpoint, indexes, customer, amount, timer, samples, errors, created):
+    import frappe
+    from gateway_usp.api import payment_controller
+
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    frappe.set_user(user)
+    commit = timer.wrap("db_commit", frappe.db.commit)
+    handler = getattr(payment_controller, endpoint)
+
+    try:
+        for index in indexes:
+            timer.begin_request()
+            started = time.perf_counter()
+            result = handler(_payload(endpoint, index, customer, amount))
+            if result.get("success"):
+                commit()
+                created.append(result.get("transaction_id"))
+            else:
+                frappe.db.rollback()
+                errors.append(result.get("error"))
+            elapsed = time.perf_counter() - started
+            samples.append((elapsed, timer.end_request()))
+    finally:
+        frappe.destroy()
+
+
+def run_endpoint(endpoint, iterations=200, workers=1, gateway="mock", latency="lognormal:80:0.4",
+                 customer=None, amount=10.0, cleanup=True):
+    """
+    Ejecuta un endpoint N veces con W hilos (cada uno con su conexión a la base de datos)
+
+    Returns:
+        dict con latencias p50/p95/p99, throughput y desglose por sección
+    """
+    import frappe
+    from gateway_usp.api import payment_controller
+    from gateway_usp.utils.croem_standin import CroemStandIn, FaultProfile
+
+    if endpoint not in ENDPOINTS:
+        frappe.throw(f"Endpoint desconocido: {endpoint}")
+
+    customer = customer or frappe.db.get_value("Customer", {}, "name")
+    if endpoint == "process_payment_with_new_card" and not customer:
+        frappe.throw("process_payment_with_new_card requiere un Customer existente")
+
+    standin = CroemStandIn(default_profile=FaultProfile(latency=latency)).start() if gateway == "standin" else None
+    sdk = _make_sdk(gateway, standin)
+
+    timer = SectionTimer()
+    restore = _instrument(timer)
+    original_factory = payment_controller.get_xpresspago_sdk
+    payment_controller.get_xpresspago_sdk = lambda: sdk
+
+    samples, errors, created = [], [], []
+    shards = [list(range(i, iterations, workers)) for i in range(workers)]
+    threads = [
+        threading.Thread(
+            target=_worker,
+            args=(frappe.local.site, frappe.local.sites_path, frappe.session.user, endpoint, shard,
+                  customer, amount, timer, samples, errors, created),
+            name=f"usp-bench-{i}"
+        )
+        for i, shard in enumerate(shards)
+    ]
+
+    started = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        wall = time.perf_counter() - started
+        payment_controller.get_xpresspago_sdk = original_factory
+        restore()
+        if standin is not None:
+            standin.stop()
+
+    if cleanup:
+        _cleanup(created)
+
+    latencies = sorted(elapsed * 1000 for elapsed, _sections in samples)
+    total_request_time = sum(elapsed for elapsed, _sections in samples) or 1.0
+    breakdown = {}
+    for section, seconds in sorted(timer.totals.items()):
+        breakdown[section] = {
+            "mean_ms": round(seconds * 1000 / max(len(samples), 1), 3),
+            "share": round(seconds / total_request_time, 4)
+        }
+    accounted = sum(timer.totals.values())
+    breakdown["other"] = {
+        "mean_ms": round((total_request_time - accounted) * 1000 / max(len(samples), 1), 3),
+        "share": round(max(total_request_time - accounted, 0) / total_request_time, 4)
+    }
+
+    return {
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_samples": sorted(set(str(e) for e in errors))[:5],
+        "wall_seconds": round(wall, 3),
+        "throughput_per_second": round(len(samples) / wall, 2) if wall else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "p99_ms": _percentile(latencies, 99),
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+        "breakdown": breakdown
+    }
+
+
+def _cleanup(transaction_ids):
+    """Borra las transacciones creadas por el benchmark"""
+    import frappe
+
+    for start in range(0, len(transaction_ids), 500):
+        chunk = [t for t in transaction_ids[start:start + 500] if t]
+        if chunk:
+            frappe.db.delete("USP Transaction Payload", {"transaction": ["in", chunk]})
+            frappe.db.delete("USP Transaction", {"transaction_id": ["in", chunk]})
+    frappe.db.commit()
+
+
+def run(iterations=200, workers=1, gateway="mock", latency="lognormal:80:0.4", endpoints=None,
+        customer=None, amount=10.0, output=None, baseline=None, cleanup=True):
+    """
+    Ejecuta el benchmark de ambos endpoints y guarda el resultado en JSON
+
+    Args:
+        gateway: mock (MockXpresspagoSDK) o standin (XpresspagoSDK real contra el servidor local)
+        latency: distribución de latencia del servidor local (ver croem_standin.LatencyDistribution)
+        output: ruta del JSON (por defecto private/files/usp_benchmarks/ del sitio)
+        baseline: JSON con el que comparar al terminar (por defecto baselines/payments.json si existe)
+    """
+    import frappe
+
+    iterations, workers = int(iterations), max(int(workers), 1)
+    results = {
+        "benchmark": "payments",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "site": frappe.local.site,
+        "python": sys.version.split()[0],
+        "config": {
+            "iterations": iterations,
+            "workers": workers,
+            "gateway": gateway,
+            "latency": latency if gateway == "standin" else None,
+            "amount": amount
+        },
+        "endpoints": {}
+    }
+
+    for endpoint in endpoints or ENDPOINTS:
+        results["endpoints"][endpoint] = run_endpoint(
+            endpoint, iterations=iterations, workers=workers, gateway=gateway,
+            latency=latency, customer=customer, amount=amount, cleanup=cleanup
+        )
+
+    if not output:
+        folder = frappe.get_site_path("private", "files", "usp_benchmarks")
+        os.makedirs(folder, exist_ok=True)
+        output = os.path.join(folder, f"payments-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    save_results(results, output)
+    results["output"] = output
+
+    baseline = baseline or (BASELINE_PATH if os.path.exists(BASELINE_PATH) else None)
+    if baseline and os.path.abspath(baseline) != os.path.abspath(output):
+        results["comparison"] = compare(load_results(baseline), results)
+
+    print(format_results(results))
+    return results
+
+
+def save_results(results, path):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, tolerance=0.15):
+    """
+    Compara dos resultados; una métrica es regresión si empeora más que la tolerancia relativa
+
+    Returns:
+        dict con passed, regressions y la variación de cada métrica
+    """
+    regressions = []
+    deltas = {}
+    for endpoint, base in baseline.get("endpoints", {}).items():
+        now = current.get("endpoints", {}).get(endpoint)
+        if now is None:
+            regressions.append(f"{endpoint}: no se ejecutó")
+            continue
+        for metric, higher_is_worse in GATED_METRICS:
+            old, new = base.get(metric), now.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            deltas[f"{endpoint}.{metric}"] = round(change, 4)
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            if worse:
+                regressions.append(f"{endpoint}.{metric}: {old} -> {new} ({change:+.1%})")
+
+    if baseline.get("config") != current.get("config"):
+        deltas["config_mismatch"] = True
+
+    return {"passed": not regressions, "tolerance": tolerance, "regressions": regressions, "deltas": deltas}
+
+
+def format_results(results):
+    lines = [f"Benchmark de pagos ({results['config']['gateway']}, "
+             f"{results['config']['iterations']} iteraciones, {results['config']['workers']} hilos)"]
+    for endpoint, data in results["endpoints"].items():
+        lines.append(
+            f"  {endpoint:32} p50 {data['p50_ms']} ms  p95 {data['p95_ms']} ms  p99 {data['p99_ms']} ms  "
+            f"{data['throughput_per_second']} pagos/s  errores {data['errors']}"
+        )
+        for section, values in data["breakdown"].items():
+            lines.append(f"    {section:12} {values['mean_ms']:>9} ms  {values['share']:>7.1%}")
+    comparison = results.get("comparison")
+    if comparison:
+        lines.append("  Gate: " + ("OK" if comparison["passed"] else "REGRESIÓN"))
+        lines.extend(f"    {regression}" for regression in comparison["regressions"])
+    return "\n".join(lines)
+
+
+def main(argv):
+    if len(argv) < 3 or argv[0] != "compare":
+        print("Uso: python -m gateway_usp.benchmarks.payments compare <baseline.json> <resultado.json> [tolerancia]")
+        return 2
+    tolerance = float(argv[3]) if len(argv) > 3 else 0.15
+    comparison = compare(load_results(argv[1]), load_results(argv[2]), tolerance)
+    print(json.dumps(comparison, indent=2))
+    return 0 if comparison["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
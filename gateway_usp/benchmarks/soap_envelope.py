@@ -0,0 +1,119 @@
+# gateway_usp/benchmarks/soap_envelope.py
+#
+# Throughput y tamaño de los sobres SOAP: f-strings anteriores vs plantillas precompiladas.
+# Uso: python -m gateway_usp.benchmarks.soap_envelope [iteraciones]
+
+import sys
+import time
+
+from gateway_usp.api.soap_envelope import encode_envelope
+
+CREDENTIALS = {
+    "APIKey": "3f9c2d1e-7b6a-4c58-9e21-0a1b2c3d4e5f",
+    "accessCode": "A1B2C3D4E5",
+    "merchantAccountNumber": "112233445566",
+    "terminalName": "TERM0001",
+}
+
+SAMPLE_VALUES = {
+    "Ping": {},
+    "Sale": {
+        **CREDENTIALS,
+        "accountToken": "8f2c1e6a-55b0-4d39-9a8e-1f0c2b7d4e11",
+        "clientTracking": "ACC-SINV-2024-00042",
+        "amount": 125.5,
+        "currencyCode": "840",
+        "emailAddress": "cliente@example.com",
+        "cvv": "123",
+    },
+    "GetTokenDetails": {
+        "APIKey": CREDENTIALS["APIKey"],
+        "accountNumber": "CUST-00017",
+    },
+}
+
+
+def legacy_envelope(operation, v):
+    """Sobres tal como se construían antes (f-strings indentados, sin escapar)"""
+    if operation == "Ping":
+        return """<?xml version="1.0" encoding="utf-8"?>
+            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
+                          xmlns:tem="http://tempuri.org/">
+                <soap:Header/>
+                <soap:Body>
+                    <tem:Ping></tem:Ping>
+                </soap:Body>
+            </soap:Envelope>"""
+    if operation == "Sale":
+        return f"""<?xml version="1.0" encoding="utf-8"?>
+            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
+                          xmlns:tem="http://tempuri.org/">
+                <soap:Header/>
+                <soap:Body>
+                    <tem:Sale>
+                        <tem:APIKey>{v['APIKey']}</tem:APIKey>
+                        <tem:accountToken>{v['accountToken']}</tem:accountToken>
+                        <tem:accessCode>{v['accessCode']}</tem:accessCode>
+                        <tem:merchantAccountNumber>{v['merchantAccountNumber']}</tem:merchantAccountNumber>
+                        <tem:terminalName>{v['terminalName']}</tem:terminalName>
+                        <tem:clientTracking>{v['clientTracking'] or ''}</tem:clientTracking>
+                        <tem:amount>{v['amount']}</tem:amount>
+                        <tem:currencyCode>{v['currencyCode']}</tem:currencyCode>
+                        <tem:emailAddress>{v.get('emailAddress', '')}</tem:emailAddress>
+                        <tem:cvv>{v.get('cvv', '')}</tem:cvv>
+                    </tem:Sale>
+                </soap:Body>
+            </soap:Envelope>"""
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" 
+                          xmlns:tem="http://tempuri.org/">
+                <soap:Header/>
+                <soap:Body>
+                    <tem:GetTokenDetails>
+                        <tem:APIKey>{v['APIKey']}</tem:APIKey>
+                        <tem:accountNumber>{v['accountNumber']}</tem:accountNumber>
+                    </tem:GetTokenDetails>
+                </soap:Body>
+            </soap:Envelope>"""
+
+
+def _legacy_body(operation, values):
+    # requests codifica el str a bytes antes de enviarlo; se incluye en la medición
+    return legacy_envelope(operation, values).encode("utf-8")
+
+
+def _throughput(func, operation, values, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(operation, values)
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed
+
+
+def run(iterations=50000):
+    """Sobres por segundo y bytes por sobre, antes vs después"""
+    report = {}
+    for operation, values in SAMPLE_VALUES.items():
+        legacy_size = len(_legacy_body(operation, values))
+        compiled_size = len(encode_envelope(operation, values))
+        report[operation] = {
+            "legacy_per_sec": round(_throughput(_legacy_body, operation, values, iterations)),
+            "compiled_per_sec": round(_throughput(encode_envelope, operation, values, iterations)),
+            "legacy_bytes": legacy_size,
+            "compiled_bytes": compiled_size,
+            "size_reduction_pct": round((1 - compiled_size / legacy_size) * 100, 1),
+        }
+    return report
+
+
+def _print_report(report):
+    print(f"{'operación':<16}{'antes/s':>12}{'después/s':>12}{'bytes antes':>13}{'bytes después':>15}{'ahorro %':>10}")
+    for operation, row in report.items():
+        print(
+            f"{operation:<16}{row['legacy_per_sec']:>12}{row['compiled_per_sec']:>12}"
+            f"{row['legacy_bytes']:>13}{row['compiled_bytes']:>15}{row['size_reduction_pct']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    _print_report(run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
@@ -0,0 +1,150 @@
+# gateway_usp/benchmarks/soap_parser.py
+#
+# Micro-benchmark del parser de respuestas SOAP.
+# Uso: python -m gateway_usp.benchmarks.soap_parser [iteraciones]
+
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from gateway_usp.api.soap_parser import parse_soap_response
+
+SAMPLE_RESPONSES = {
+    "Sale": b"""<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+  <soap:Body>
+    <SaleResponse xmlns="http://tempuri.org/">
+      <SaleResult>
+        <IsSuccess>true</IsSuccess>
+        <ResponseCode>00</ResponseCode>
+        <ResponseDescription>Aprobada</ResponseDescription>
+        <TransactionId>428391027</TransactionId>
+        <AuthorizationNumber>083512</AuthorizationNumber>
+        <ClientTracking>ACC-SINV-2024-00042</ClientTracking>
+        <Amount>125.50</Amount>
+        <CurrencyCode>840</CurrencyCode>
+      </SaleResult>
+    </SaleResponse>
+  </soap:Body>
+</soap:Envelope>""",
+    "GetTokenDetails": b"""<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <GetTokenDetailsResponse xmlns="http://tempuri.org/">
+      <GetTokenDetailsResult>
+        <IsSuccess>true</IsSuccess>
+        <ResponseCode>T00</ResponseCode>
+        <ResponseDescription>Success</ResponseDescription>
+        <AccountToken>8f2c1e6a-55b0-4d39-9a8e-1f0c2b7d4e11</AccountToken>
+        <MaskedCardNumber>411111******1111</MaskedCardNumber>
+        <CardHolderName>JUAN PEREZ</CardHolderName>
+        <ExpirationDate>1227</ExpirationDate>
+        <CardType>VISA</CardType>
+      </GetTokenDetailsResult>
+    </GetTokenDetailsResponse>
+  </soap:Body>
+</soap:Envelope>""",
+    "Ping": b"""<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <PingResponse xmlns="http://tempuri.org/">
+      <PingResult>10/17/2026 10:15:02 AM</PingResult>
+    </PingResponse>
+  </soap:Body>
+</soap:Envelope>""",
+}
+
+
+def legacy_parse(xml_response, operation):
+    """Parser anterior (verificación por substrings), como referencia"""
+    if "IsSuccess" in xml_response and "true" in xml_response:
+        return {
+            "IsSuccess": True,
+            "TransactionId": f"TXN_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            "ResponseCode": "00",
+            "ResponseMessage": "Success"
+        }
+    return {
+        "IsSuccess": False,
+        "ResponseCode": "01",
+        "ResponseMessage": "Transaction declined"
+    }
+
+
+def etree_parse(xml_response, operation):
+    """Parseo DOM completo con ElementTree, como referencia"""
+    root = ET.fromstring(xml_response)
+    values = {}
+    for element in root.iter():
+        if len(element) == 0 and element.text:
+            values.setdefault(element.tag.rpartition("}")[2], element.text.strip())
+    return values
+
+
+def _time_per_call(func, payload, operation, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(payload, operation)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def _allocations_per_call(func, payload, operation, iterations):
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        # Conservar los resultados para medir también su tamaño en memoria
+        results.append(func(payload, operation))
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    return {
+        "retained_blocks_per_call": round(blocks / iterations, 2),
+        "retained_bytes_per_call": round(size / iterations, 1),
+        "peak_bytes": peak
+    }
+
+
+def run(iterations=20000):
+    """Compara tiempo y asignaciones por respuesta entre el parser anterior y el actual"""
+    report = {}
+    for operation, payload in SAMPLE_RESPONSES.items():
+        text = payload.decode("utf-8")
+        report[operation] = {
+            "legacy": {
+                "us_per_call": round(_time_per_call(legacy_parse, text, operation, iterations), 2),
+                **_allocations_per_call(legacy_parse, text, operation, min(iterations, 2000))
+            },
+            "etree": {
+                "us_per_call": round(_time_per_call(etree_parse, payload, operation, iterations), 2),
+                **_allocations_per_call(etree_parse, payload, operation, min(iterations, 2000))
+            },
+            "expat": {
+                "us_per_call": round(_time_per_call(parse_soap_response, payload, operation, iterations), 2),
+                **_allocations_per_call(parse_soap_response, payload, operation, min(iterations, 2000))
+            },
+            "expat_result": parse_soap_response(payload, operation).to_dict()
+        }
+    return report
+
+
+def _print_report(report):
+    print(f"{'operación':<16}{'parser':<8}{'us/llamada':>12}{'bloques/llamada':>18}{'bytes/llamada':>16}")
+    for operation, data in report.items():
+        for name in ("legacy", "etree", "expat"):
+            row = data[name]
+            print(
+                f"{operation:<16}{name:<8}{row['us_per_call']:>12}"
+                f"{row['retained_blocks_per_call']:>18}{row['retained_bytes_per_call']:>16}"
+            )
+        print(f"{'':<16}-> {data['expat_result']}")
+
+
+if __name__ == "__main__":
+    _print_report(run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,216 @@
+# gateway_usp/benchmarks/transaction_indexes.py
+#
+# Benchmark de las consultas frecuentes sobre USP Transaction, sin y con los índices
+# compuestos (ver usp_transaction.COMPOSITE_INDEXES).
+#
+# Trabaja sobre una copia vacía de la tabla (CREATE TABLE ... LIKE) sembrada con datos
+# sintéticos; la tabla real no se toca. Ejecutar en un sitio de desarrollo:
+#   bench --site dev.local execute gateway_usp.benchmarks.transaction_indexes.run \
+#       --kwargs '{"rows": 1000000, "repeat": 50}'
+
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from gateway_usp.benchmarks.payments import _percentile, save_results
+
+BENCH_TABLE = "_usp_transaction_index_bench"
+
+# Distribución de estados aproximada a producción
+STATUS_WEIGHTS = (
+    ("Completed", 70),
+    ("Failed", 10),
+    ("Pending", 5),
+    ("Authorized", 5),
+    ("Cancelled", 5),
+    ("Refunded", 5),
+)
+
+SEED_COLUMNS = ("name", "transaction_id", "reference_doctype", "reference_docname", "customer",
+                "amount", "currency", "status", "created_at", "creation", "modified",
+                "owner", "modified_by", "docstatus")
+
+# nombre -> (SQL con {table}, generador de parámetros)
+QUERIES = {
+    "pending_scan": (
+        "SELECT name, transaction_id FROM `{table}` "
+        "WHERE status = 'Pending' AND created_at < %(cutoff)s ORDER BY created_at, name LIMIT 200",
+        lambda ctx: {"cutoff": ctx["now"] - timedelta(minutes=10)},
+    ),
+    "retention_scan": (
+        "SELECT name FROM `{table}` "
+        "WHERE status = 'Failed' AND created_at < %(cutoff)s ORDER BY name LIMIT 500",
+        lambda ctx: {"cutoff": ctx["now"] - timedelta(days=90)},
+    ),
+    "reference_lookup": (
+        "SELECT name, status FROM `{table}` "
+        "WHERE reference_doctype = %(doctype)s AND reference_docname = %(docname)s",
+        lambda ctx: {"doctype": "Sales Invoice", "docname": f"SINV-{random.randrange(ctx['rows']):08d}"},
+    ),
+    "customer_history": (
+        "SELECT name, amount, status FROM `{table}` "
+        "WHERE customer = %(customer)s ORDER BY created_at DESC LIMIT 20",
+        lambda ctx: {"customer": f"CUST-{random.randrange(ctx['customers']):06d}"},
+    ),
+    "webhook_lookup": (
+        "SELECT name FROM `{table}` WHERE transaction_id = %(transaction_id)s",
+        lambda ctx: {"transaction_id": f"BENCH-{random.randrange(ctx['rows']):09d}"},
+    ),
+}
+
+
+def _create_table():
+    import frappe
+
+    from gateway_usp.gateway_usp.doctype.usp_transaction.usp_transaction import COMPOSITE_INDEXES
+
+    frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `{BENCH_TABLE}`")
+    frappe.db.sql_ddl(f"CREATE TABLE `{BENCH_TABLE}` LIKE `tabUSP Transaction`")
+    # La copia hereda los índices de la tabla real: se parte sin los compuestos
+    for fields in COMPOSITE_INDEXES:
+        index_name = frappe.db.get_index_name(list(fields))
+        if frappe.db.has_index(BENCH_TABLE, index_name):
+            frappe.db.sql_ddl(f"ALTER TABLE `{BENCH_TABLE}` DROP INDEX `{index_name}`")
+
+
+def _seed(rows, customers, batch_size, now):
+    """Inserta filas sintéticas en lotes de INSERT multi-fila"""
+    import frappe
+
+    statuses = [status for status, weight in STATUS_WEIGHTS for _ in range(weight)]
+    span_seconds = 2 * 365 * 86400
+    placeholders = "(" + ", ".join(["%s"] * len(SEED_COLUMNS)) + ")"
+    columns = ", ".join(f"`{column}`" for column in SEED_COLUMNS)
+
+    started = time.monotonic()
+    for offset in range(0, rows, batch_size):
+        values = []
+        count = min(batch_size, rows - offset)
+        for i in range(offset, offset + count):
+            created = now - timedelta(seconds=random.randrange(span_seconds))
+            values.extend((
+                f"BENCH-{i:09d}",
+                f"BENCH-{i:09d}",
+                "Sales Invoice" if i % 2 else "Payment Request",
+                f"SINV-{i:08d}" if i % 2 else f"PR-{i:08d}",
+                f"CUST-{random.randrange(customers):06d}",
+                round(random.uniform(1, 500), 2),
+                "USD",
+                random.choice(statuses),
+                created,
+                created,
+                created,
+                "Administrator",
+                "Administrator",
+                0,
+            ))
+        frappe.db.sql(
+            f"INSERT INTO `{BENCH_TABLE}` ({columns}) VALUES " + ", ".join([placeholders] * count),
+            values
+        )
+        frappe.db.commit()
+    frappe.db.sql(f"ANALYZE TABLE `{BENCH_TABLE}`")
+    return round(time.monotonic() - started, 1)
+
+
+def _explain(sql, params):
+    import frappe
+
+    plan = frappe.db.sql(f"EXPLAIN {sql}", params, as_dict=True)[0]
+    return {
+        "type": plan.get("type"),
+        "key": plan.get("key"),
+        "rows": plan.get("rows"),
+        "extra": plan.get("Extra")
+    }
+
+
+def _measure(ctx, repeat):
+    import frappe
+
+    results = {}
+    for name, (template, make_params) in QUERIES.items():
+        sql = template.format(table=BENCH_TABLE)
+        timings = []
+        for _ in range(repeat):
+            params = make_params(ctx)
+            started = time.perf_counter()
+            frappe.db.sql(sql, params)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        results[name] = {
+            "plan": _explain(sql, make_params(ctx)),
+            "p50_ms": _percentile(timings, 50),
+            "p95_ms": _percentile(timings, 95),
+            "max_ms": round(timings[-1], 2)
+        }
+    return results
+
+
+def run(rows=1000000, customers=20000, repeat=50, batch_size=5000, keep_table=False, output=None):
+    """
+    Siembra la tabla de prueba, mide las consultas, agrega los índices en línea y vuelve a medir
+
+    Returns:
+        dict con plan (EXPLAIN) y latencias p50/p95 por consulta antes y después
+    """
+    import frappe
+
+    from gateway_usp.gateway_usp.doctype.usp_transaction.usp_transaction import COMPOSITE_INDEXES
+    from gateway_usp.patches.v1_0.add_usp_transaction_indexes import add_index_online
+
+    if frappe.db.db_type != "mariadb":
+        frappe.throw("El benchmark de índices requiere MariaDB")
+
+    rows, customers, repeat = int(rows), int(customers), int(repeat)
+    now = datetime.now()
+    ctx = {"rows": rows, "customers": customers, "now": now}
+
+    _create_table()
+    try:
+        results = {
+            "benchmark": "transaction_indexes",
+            "timestamp": now.isoformat(timespec="seconds"),
+            "site": frappe.local.site,
+            "python": sys.version.split()[0],
+            "config": {"rows": rows, "customers": customers, "repeat": repeat},
+            "seed_seconds": _seed(rows, customers, int(batch_size), now),
+            "before": _measure(ctx, repeat),
+            "index_build_seconds": {}
+        }
+        for fields in COMPOSITE_INDEXES:
+            results["index_build_seconds"][",".join(fields)] = add_index_online(BENCH_TABLE, fields)
+        frappe.db.sql(f"ANALYZE TABLE `{BENCH_TABLE}`")
+        results["after"] = _measure(ctx, repeat)
+    finally:
+        if not keep_table:
+            frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `{BENCH_TABLE}`")
+
+    if not output:
+        folder = frappe.get_site_path("private", "files", "usp_benchmarks")
+        os.makedirs(folder, exist_ok=True)
+        output = os.path.join(folder, f"transaction_indexes-{now.strftime('%Y%m%d-%H%M%S')}.json")
+    save_results(results, output)
+    results["output"] = output
+
+    print(format_results(results))
+    return results
+
+
+def format_results(results):
+    lines = [f"Índices de USP Transaction ({results['config']['rows']} filas, "
+             f"{results['config']['repeat']} repeticiones por consulta)"]
+    for name in QUERIES:
+        before, after = results["before"][name], results["after"][name]
+        lines.append(
+            f"  {name:18} p50 {before['p50_ms']:>9} -> {after['p50_ms']:>7} ms  "
+            f"p95 {before['p95_ms']:>9} -> {after['p95_ms']:>7} ms  "
+            f"filas estimadas {before['plan']['rows']} -> {after['plan']['rows']}  "
+            f"índice {before['plan']['key']} -> {after['plan']['key']}"
+        )
+    for fields, seconds in results["index_build_seconds"].items():
+        lines.append(f"  índice ({fields}) construido en {seconds} s")
+    return "\n".join(lines)
+
@@ -0,0 +1,9 @@
+# Copyright (c) 2026, EduTech and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+
+class USPAuditEvent(Document):
+    # Se escribe en bloque desde gateway_usp.utils.audit; no se edita desde la UI
+    pass
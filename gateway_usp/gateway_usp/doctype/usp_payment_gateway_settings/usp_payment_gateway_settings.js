@@ -77,6 +77,19 @@ frappe.ui.form.on('USP Payment Gateway Settings', {
             } else {
                 frm.dashboard.add_indicator(__('Sandbox'), 'yellow');
             }
+            
+            // Salud del gateway según el prober en segundo plano
+            if (!frm.doc.use_mock_mode) {
+                frappe.call({
+                    method: "gateway_usp.utils.health.get_health",
+                    args: { environment: frm.doc.environment },
+                    callback: function(r) {
+                        if (r.message) {
+                            add_health_indicator(frm, r.message);
+                        }
+                    }
+                });
+            }
         } else {
             frm.dashboard.add_indicator(__('Gateway Deshabilitado'), 'red');
         }
@@ -201,4 +214,23 @@ function show_croem_help() {
         `),
         indicator: 'blue'
     });
-}
\ No newline at end of file
+}
+
+function add_health_indicator(frm, health) {
+    const labels = {
+        healthy: [__('Gateway Disponible'), 'green'],
+        degraded: [__('Gateway Degradado'), 'orange'],
+        down: [__('Gateway Caído'), 'red'],
+        unknown: [__('Salud del Gateway Sin Datos'), 'grey']
+    };
+    let [label, color] = labels[health.status] || labels.unknown;
+    
+    if (health.p95_ms) {
+        label += ` (p95 ${health.p95_ms} ms)`;
+    }
+    if (health.stale && health.status !== 'unknown') {
+        label += ` - ${__('sin muestras recientes')}`;
+        color = 'grey';
+    }
+    frm.dashboard.add_indicator(label, color);
+}
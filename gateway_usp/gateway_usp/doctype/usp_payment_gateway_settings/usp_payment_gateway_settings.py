@@ -110,8 +110,21 @@ class USPPaymentGatewaySettings(Document):
     
     def on_update(self):
         """Después de actualizar"""
+        # El SDK registrado en cada worker quedó desactualizado
+        from gateway_usp.api.xpresspago_sdk import invalidate_sdk_registry
+        invalidate_sdk_registry()
+        
         if self.is_enabled and not self.use_mock_mode:
-            self.test_connection()
+            # El ping corre en segundo plano; el formulario muestra la salud cacheada
+            from gateway_usp.utils.health import request_health_probe
+            request_health_probe()
+            
+            # Recargar el widget con las credenciales nuevas fuera de la petición
+            frappe.enqueue(
+                "gateway_usp.api.widget_cache.prewarm_widget_cache",
+                queue="short",
+                enqueue_after_commit=True
+            )
     
     def test_connection(self):
         """Probar conexión con XpressPago usando SDK actualizado"""
@@ -166,7 +179,26 @@ class USPPaymentGatewaySettings(Document):
             
             results = run_full_connectivity_test()
             
-            if results.get("overall_success"):
+            # Salud observada por el prober en segundo plano
+            from gateway_usp.utils.health import get_gateway_health
+            results["health"] = get_gateway_health(self.environment)
+            
+            # Estado de los circuit breakers compartidos entre workers
+            from gateway_usp.api.circuit_breaker import circuit_snapshot
+            results["circuit_breakers"] = circuit_snapshot(self.environment)
+            open_circuits = [
+                breaker["operation"] for breaker in results["circuit_breakers"]
+                if breaker["state"] != "closed"
+            ]
+            
+            if open_circuits:
+                frappe.msgprint(
+                    f"Circuit breaker abierto para: {', '.join(open_circuits)}<br>"
+                    f"Las llamadas a estas operaciones fallan rápido hasta que el gateway se recupere.",
+                    indicator="red",
+                    title="Gateway Degradado"
+                )
+            elif results.get("overall_success"):
                 frappe.msgprint(
                     "Todos los diagnósticos pasaron exitosamente",
                     indicator="green",
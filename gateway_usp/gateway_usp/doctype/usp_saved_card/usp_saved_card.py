@@ -0,0 +1,9 @@
+# Copyright (c) 2026, EduTech and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+
+class USPSavedCard(Document):
+    # Bóveda local de tarjetas tokenizadas; la mantiene gateway_usp.api.card_vault
+    pass
@@ -44,5 +44,43 @@ frappe.ui.form.on('USP Transaction', {
                 'blue'
             );
         }
+        
+        // Payloads del gateway: se consultan al abrir la sección, no con el documento
+        frm.usp_payload_loaded = false;
+        frm.fields_dict.payload_html.$wrapper.empty();
+        const section = frm.fields_dict.response_data_section;
+        if (section.is_collapsed && !section.is_collapsed()) {
+            load_payloads(frm);
+        }
+        $(section.head).off('click.usp_payload').on('click.usp_payload', function() {
+            load_payloads(frm);
+        });
     }
-});
\ No newline at end of file
+});
+
+function load_payloads(frm) {
+    if (frm.usp_payload_loaded || frm.is_new()) return;
+    frm.usp_payload_loaded = true;
+    
+    const $wrapper = frm.fields_dict.payload_html.$wrapper;
+    $wrapper.html(`<p class="text-muted">${__('Cargando...')}</p>`);
+    
+    frappe.call({
+        method: 'gateway_usp.utils.payload_store.get_transaction_payload',
+        args: { transaction: frm.doc.name },
+        callback: function(r) {
+            const payload = r.message || {};
+            const block = (label, data) => `
+                <label class="control-label">${label}</label>
+                <pre>${data ? frappe.utils.escape_html(JSON.stringify(data, null, 2)) : __('Sin datos')}</pre>`;
+            $wrapper.html(
+                block(__('Response Data'), payload.response_data) +
+                block(__('Webhook Data'), payload.webhook_data)
+            );
+        },
+        error: function() {
+            frm.usp_payload_loaded = false;
+            $wrapper.empty();
+        }
+    });
+}
\ No newline at end of file
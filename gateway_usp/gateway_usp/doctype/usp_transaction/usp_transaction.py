@@ -6,6 +6,30 @@ from frappe.model.document import Document
 from frappe.utils import now, flt
 import json
 
+# Índices compuestos de las consultas frecuentes:
+# conciliación y retención (status + created_at), webhook/formularios por documento de referencia
+# e historial por cliente. transaction_id ya es único.
+COMPOSITE_INDEXES = (
+    ("status", "created_at"),
+    ("reference_doctype", "reference_docname"),
+    ("customer", "created_at"),
+)
+
+def on_doctype_update():
+    """Crea los índices compuestos si faltan (los sitios existentes los reciben en línea por el patch)"""
+    for fields in COMPOSITE_INDEXES:
+        frappe.db.add_index("USP Transaction", list(fields))
+
+def make_transaction_id():
+    """Generar ID de transacción único"""
+    import random
+    import string
+    
+    timestamp = str(int(frappe.utils.now_datetime().timestamp()))
+    random_chars = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    
+    return f"USP-{timestamp}-{random_chars}"
+
 class USPTransaction(Document):
     def before_insert(self):
         """Antes de insertar"""
@@ -38,13 +62,7 @@ class USPTransaction(Document):
     
     def generate_transaction_id(self):
         """Generar ID de transacción único"""
-        import random
-        import string
-        
-        timestamp = str(int(frappe.utils.now_datetime().timestamp()))
-        random_chars = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        
-        return f"USP-{timestamp}-{random_chars}"
+        return make_transaction_id()
     
     @frappe.whitelist()
     def retry_payment(self):
@@ -72,52 +90,14 @@ class USPTransaction(Document):
         self.save()
         
         frappe.msgprint("Transacción cancelada", indicator="orange")
-    
+
+    def on_trash(self):
+        """Borrar los payloads guardados aparte"""
+        from gateway_usp.utils.payload_store import delete_payloads
+        delete_payloads([self.name])
+
     def on_update(self):
         """Después de actualizar"""
-        # Notificar cambios de estado importantes
-        if self.status == "Completed":
-            self.send_completion_notification()
-        elif self.status == "Failed":
-            self.send_failure_notification()
-    
-    def send_completion_notification(self):
-        """Enviar notificación de pago completado"""
-        if self.customer:
-            customer_doc = frappe.get_doc("Customer", self.customer)
-            if customer_doc.email_id:
-                frappe.sendmail(
-                    recipients=[customer_doc.email_id],
-                    subject="Pago Completado - USP Gateway",
-                    message=f"""
-                    <h3>Pago Completado</h3>
-                    <p>Su pago ha sido procesado exitosamente:</p>
-                    <ul>
-                        <li><strong>ID Transacción:</strong> {self.transaction_id}</li>
-                        <li><strong>Monto:</strong> {self.currency} {self.amount}</li>
-                        <li><strong>Fecha:</strong> {self.completed_at}</li>
-                    </ul>
-                    """,
-                    header="Pago Completado"
-                )
-    
-    def send_failure_notification(self):
-        """Enviar notificación de pago fallido"""
-        if self.customer:
-            customer_doc = frappe.get_doc("Customer", self.customer)
-            if customer_doc.email_id:
-                frappe.sendmail(
-                    recipients=[customer_doc.email_id],
-                    subject="Pago Fallido - USP Gateway",
-                    message=f"""
-                    <h3>Pago Fallido</h3>
-                    <p>Su pago no pudo ser procesado:</p>
-                    <ul>
-                        <li><strong>ID Transacción:</strong> {self.transaction_id}</li>
-                        <li><strong>Monto:</strong> {self.currency} {self.amount}</li>
-                        <li><strong>Error:</strong> {self.error_message or 'Error desconocido'}</li>
-                    </ul>
-                    <p>Por favor, intente nuevamente o contacte con soporte.</p>
-                    """,
-                    header="Pago Fallido"
-                )
\ No newline at end of file
+        # Notificar cambios de estado importantes (se envían en lote, fuera del guardado)
+        from gateway_usp.utils.notifications import queue_status_notification
+        queue_status_notification(self)
@@ -0,0 +1,9 @@
+# Copyright (c) 2026, EduTech and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+
+class USPTransactionPayload(Document):
+    # Payloads crudos del gateway, comprimidos; los mantiene gateway_usp.utils.payload_store
+    pass
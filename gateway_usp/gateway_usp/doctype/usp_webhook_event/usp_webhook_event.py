@@ -0,0 +1,9 @@
+# Copyright (c) 2026, EduTech and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+
+class USPWebhookEvent(Document):
+    # Bandeja de entrada de webhooks; la procesa gateway_usp.api.webhook_inbox
+    pass
@@ -58,9 +58,28 @@ scheduler_events = {
         "gateway_usp.api.payment_controller.sync_pending_transactions"
     ],
     "daily": [
-        "gateway_usp.api.payment_controller.cleanup_old_transactions"
-    ]
+        "gateway_usp.api.payment_controller.cleanup_old_transactions",
+        "gateway_usp.utils.audit.purge_audit_events",
+        "gateway_usp.api.webhook_inbox.purge_webhook_events",
+        "gateway_usp.api.card_vault.sync_card_vault"
+    ],
+    "cron": {
+        # Cada minuto: prober de salud, drenado de auditoría, red de seguridad de webhooks y notificaciones
+        "* * * * *": [
+            "gateway_usp.utils.health.probe_gateway_health",
+            "gateway_usp.utils.audit.drain_audit_queue",
+            "gateway_usp.api.webhook_inbox.requeue_stale_webhook_events",
+            "gateway_usp.utils.notifications.send_queued_notifications"
+        ]
+    }
 }
 
 # Boot session para inicialización temprana
-boot_session = "gateway_usp.boot.boot_session"
\ No newline at end of file
+boot_session = "gateway_usp.boot.boot_session"
+
+# Volcado de métricas del proceso a Redis
+after_request = ["gateway_usp.utils.metrics.flush_metrics", "gateway_usp.utils.audit.flush_audit"]
+after_job = ["gateway_usp.utils.metrics.flush_metrics", "gateway_usp.utils.audit.flush_audit"]
+
+# bench clear-cache también descarta el SDK registrado en los workers
+clear_cache = "gateway_usp.api.xpresspago_sdk.on_clear_cache"
\ No newline at end of file
@@ -0,0 +1,45 @@
+# gateway_usp/patches/v1_0/add_usp_transaction_indexes.py
+
+import time
+
+import frappe
+
+from gateway_usp.gateway_usp.doctype.usp_transaction.usp_transaction import COMPOSITE_INDEXES
+
+
+def execute():
+    """
+    Construye en línea los índices compuestos de USP Transaction
+
+    Corre antes de sincronizar los DocTypes para que on_doctype_update los encuentre
+    creados y no los reconstruya con un ALTER bloqueante.
+    """
+    if not frappe.db.table_exists("USP Transaction"):
+        return
+
+    for fields in COMPOSITE_INDEXES:
+        # Columnas que aún no existen las crea la sincronización; el índice lo hará on_doctype_update
+        if all(frappe.db.has_column("USP Transaction", field) for field in fields):
+            add_index_online("tabUSP Transaction", fields)
+
+
+def add_index_online(table, fields, index_name=None):
+    """
+    ALTER TABLE ... ADD INDEX sin bloquear escrituras (MariaDB: ALGORITHM=INPLACE, LOCK=NONE)
+
+    Returns:
+        segundos que tomó la construcción, o None si el índice ya existía
+    """
+    index_name = index_name or frappe.db.get_index_name(list(fields))
+    if frappe.db.has_index(table, index_name):
+        return None
+
+    started = time.monotonic()
+    if frappe.db.db_type == "mariadb":
+        columns = ", ".join(f"`{field}`" for field in fields)
+        frappe.db.sql_ddl(
+            f"ALTER TABLE `{table}` ADD INDEX `{index_name}` ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+        )
+    else:
+        frappe.db.add_index(table[3:], list(fields), index_name)
+    return round(time.monotonic() - started, 2)
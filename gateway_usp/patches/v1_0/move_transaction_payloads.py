@@ -0,0 +1,58 @@
+# gateway_usp/patches/v1_0/move_transaction_payloads.py
+
+import frappe
+
+from gateway_usp.utils.payload_store import BULK_FIELDS, DOCTYPE, bulk_row
+
+# Columnas Long Text que salieron de USP Transaction
+LEGACY_COLUMNS = ("response_data", "webhook_data")
+
+BATCH_SIZE = 1000
+
+
+def execute():
+    """
+    Mueve response_data/webhook_data de USP Transaction a USP Transaction Payload
+
+    Recorre la tabla por llave primaria en lotes: inserta los payloads comprimidos,
+    vacía las columnas viejas y confirma cada lote, así que puede reanudarse.
+    Las columnas quedan en NULL; bench trim-tables las elimina si se desea.
+    """
+    columns = [column for column in LEGACY_COLUMNS if frappe.db.has_column("USP Transaction", column)]
+    if not columns:
+        return
+
+    pending = " OR ".join(f"`{column}` IS NOT NULL" for column in columns)
+    select = ", ".join(f"`{column}`" for column in columns)
+    after_name = ""
+
+    while True:
+        rows = frappe.db.sql(f"""
+            SELECT name, {select}
+            FROM `tabUSP Transaction`
+            WHERE name > %(after_name)s AND ({pending})
+            ORDER BY name
+            LIMIT %(limit)s
+        """, {"after_name": after_name, "limit": BATCH_SIZE}, as_dict=True)
+        if not rows:
+            break
+
+        names = [row.name for row in rows]
+        moved = set(frappe.get_all(DOCTYPE, filters={"transaction": ("in", names)}, pluck="transaction"))
+        values = [
+            bulk_row(row.name, response_data=row.get("response_data") or None,
+                     webhook_data=row.get("webhook_data") or None, user="Administrator")
+            for row in rows
+            if row.name not in moved
+        ]
+        if values:
+            frappe.db.bulk_insert(DOCTYPE, fields=list(BULK_FIELDS), values=values)
+
+        frappe.db.sql(
+            "UPDATE `tabUSP Transaction` SET {} WHERE name IN %(names)s".format(
+                ", ".join(f"`{column}` = NULL" for column in columns)
+            ),
+            {"names": names}
+        )
+        frappe.db.commit()
+        after_name = names[-1]
@@ -562,28 +562,12 @@ if (typeof frappe === 'undefined') {
                         payment_data: payment_data
                     },
                     callback: function(r) {
-                        frappe.hide_progress();
-                        
-                        if (r.message && r.message.success) {
+                        me.handle_payment_response(r.message, function(result) {
                             // Limpiar localStorage
                             localStorage.removeItem('usp_payment_data');
                             
-                            frappe.msgprint({
-                                title: __("Pago Exitoso"),
-                                message: __("Su pago ha sido procesado exitosamente. ID: {0}", [r.message.transaction_id]),
-                                indicator: "green"
-                            });
-                            
-                            setTimeout(() => {
-                                window.location.reload();
-                            }, 3000);
-                        } else {
-                            frappe.msgprint({
-                                title: __("Error en el Pago"),
-                                message: r.message?.message || __("Error al procesar el pago"),
-                                indicator: "red"
-                            });
-                        }
+                            return __("Su pago ha sido procesado exitosamente. ID: {0}", [result.transaction_id]);
+                        });
                     },
                     error: function(error) {
                         frappe.hide_progress();
@@ -635,24 +619,9 @@ if (typeof frappe === 'undefined') {
                     }
                 },
                 callback: function(r) {
-                    frappe.hide_progress();
-                    
-                    if (r.message && r.message.success) {
-                        frappe.msgprint({
-                            title: __("Pago Exitoso"),
-                            message: __("Su pago ha sido procesado exitosamente"),
-                            indicator: "green"
-                        });
-                        setTimeout(() => {
-                            window.location.reload();
-                        }, 2000);
-                    } else {
-                        frappe.msgprint({
-                            title: __("Error en el Pago"),
-                            message: r.message?.message || __("Error al procesar el pago"),
-                            indicator: "red"
-                        });
-                    }
+                    me.handle_payment_response(r.message, function() {
+                        return __("Su pago ha sido procesado exitosamente");
+                    });
                 },
                 error: function(error) {
                     frappe.hide_progress();
@@ -666,6 +635,61 @@ if (typeof frappe === 'undefined') {
             });
         }
 
+        // Respuesta de process_payment*: resultado final (modo síncrono) o checkout encolado
+        handle_payment_response(response, on_success) {
+            const me = this;
+            
+            if (response && response.queued) {
+                frappe.show_progress(__("Procesando pago"), 70, 100, __("Esperando respuesta del banco..."));
+                gateway_usp.wait_for_checkout(response.checkout_id).then(function(result) {
+                    frappe.hide_progress();
+                    me.show_payment_result(result, on_success);
+                });
+                return;
+            }
+            
+            frappe.hide_progress();
+            me.show_payment_result(response, on_success);
+        }
+
+        show_payment_result(result, on_success) {
+            if (result && result.timed_out) {
+                frappe.msgprint({
+                    title: __("Pago en verificación"),
+                    message: __("El banco aún no confirma el pago {0}. Revise su estado en unos minutos antes de intentarlo de nuevo.",
+                        [result.transaction_id]),
+                    indicator: "orange"
+                });
+            } else if (result && result.success && result.charged === false) {
+                // El gateway respondió pero no aprobó el cobro: no se cargó la tarjeta
+                frappe.msgprint({
+                    title: __("Pago Rechazado"),
+                    message: __("El banco no aprobó el pago {0}. No se realizó ningún cargo; intente con otra tarjeta.",
+                        [result.transaction_id || ""]),
+                    indicator: "red"
+                });
+            } else if (result && result.success) {
+                const dialog = frappe.msgprint({
+                    title: __("Pago Exitoso"),
+                    message: on_success(result),
+                    indicator: "green"
+                });
+                
+                // Refrescar cuando el resultado ya está confirmado, no tras una espera fija
+                if (window.cur_frm && cur_frm.doc && !cur_frm.is_new()) {
+                    cur_frm.reload_doc();
+                } else if (dialog) {
+                    dialog.onhide = () => window.location.reload();
+                }
+            } else {
+                frappe.msgprint({
+                    title: __("Error en el Pago"),
+                    message: result?.message || __("Error al procesar el pago"),
+                    indicator: "red"
+                });
+            }
+        }
+
         // NUEVO: Función de debug para verificar datos
         debug_payment_data() {
             const debug_info = {
@@ -696,6 +720,78 @@ if (typeof frappe === 'undefined') {
         }
     };
 
+    // Checkouts asíncronos: el worker publica usp_checkout_result por realtime
+    gateway_usp.CHECKOUT_POLL_AFTER = 60000;  // respaldo si el evento realtime no llega
+    gateway_usp.CHECKOUT_POLL_INTERVAL = 5000;
+    gateway_usp.CHECKOUT_MAX_WAIT = 330000;   // timeout del job (300 s) más margen; luego "en verificación"
+    gateway_usp.checkout_results = {};
+    gateway_usp.checkout_waiters = {};
+    
+    if (frappe.realtime && frappe.realtime.on) {
+        frappe.realtime.on("usp_checkout_result", function(result) {
+            const waiter = gateway_usp.checkout_waiters[result.checkout_id];
+            if (waiter) {
+                waiter(result);
+            } else {
+                // El evento puede llegar antes que la respuesta del encolado
+                gateway_usp.checkout_results[result.checkout_id] = result;
+            }
+        });
+    }
+    
+    gateway_usp.wait_for_checkout = function(checkout_id) {
+        return new Promise(function(resolve) {
+            let poll_timer = null;
+            let max_wait_timer = null;
+            
+            const finish = function(result) {
+                if (!gateway_usp.checkout_waiters[checkout_id]) return;
+                delete gateway_usp.checkout_waiters[checkout_id];
+                clearTimeout(poll_timer);
+                clearTimeout(max_wait_timer);
+                resolve(result);
+            };
+            gateway_usp.checkout_waiters[checkout_id] = finish;
+            
+            const early = gateway_usp.checkout_results[checkout_id];
+            if (early) {
+                delete gateway_usp.checkout_results[checkout_id];
+                finish(early);
+                return;
+            }
+            
+            const poll = function() {
+                frappe.call({
+                    method: "gateway_usp.api.checkout.get_checkout_status",
+                    args: { checkout_id: checkout_id },
+                    callback: function(r) {
+                        // Solo el resultado final trae success
+                        if (r.message && r.message.success !== undefined) {
+                            finish(r.message);
+                        } else {
+                            poll_timer = setTimeout(poll, gateway_usp.CHECKOUT_POLL_INTERVAL);
+                        }
+                    },
+                    error: function() {
+                        poll_timer = setTimeout(poll, gateway_usp.CHECKOUT_POLL_INTERVAL);
+                    }
+                });
+            };
+            poll_timer = setTimeout(poll, gateway_usp.CHECKOUT_POLL_AFTER);
+            
+            // Sin resultado a tiempo no se sabe si hubo cobro: no se reporta error ni se reintenta
+            max_wait_timer = setTimeout(function() {
+                finish({
+                    checkout_id: checkout_id,
+                    success: false,
+                    timed_out: true,
+                    status: "Pending",
+                    transaction_id: checkout_id
+                });
+            }, gateway_usp.CHECKOUT_MAX_WAIT);
+        });
+    };
+
     // Función para asegurar que el gateway esté disponible
     gateway_usp.ensure_gateway = function() {
         if (!window.usp_gateway || !window.usp_gateway.initialized) {
@@ -21,6 +21,13 @@ def get_context(context):
         context.environment = "No configurado"
         context.use_mock = False
     
+    # Salud del gateway según el prober en segundo plano (sin llamadas de red)
+    try:
+        from gateway_usp.utils.health import get_gateway_health
+        context.gateway_health = get_gateway_health()
+    except Exception:
+        context.gateway_health = {"status": "unknown", "samples": 0}
+    
     # NUEVO: Incluir token CSRF y datos de sesión
     context.csrf_token = frappe.sessions.get_csrf_token()
     context.sid = frappe.session.sid
@@ -0,0 +1,72 @@
+# gateway_usp/tests/test_payment_controller.py
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from gateway_usp.api.idempotency import client_tracking
+from gateway_usp.api.payment_controller import _process_saved_card_payment
+from gateway_usp.api.retry import clear_idempotency_record
+from gateway_usp.api.xpresspago_sdk import XpresspagoSDK
+
+
+class TestClientTracking(FrappeTestCase):
+    def setUp(self):
+        self.sdk = XpresspagoSDK()
+        self.sent = []
+
+        def approve(operation, func, name, values):
+            self.sent.append(values["clientTracking"])
+            return SimpleNamespace(status_code=200)
+
+        def handle(operation, response):
+            return {
+                "IsSuccess": True,
+                "TransactionId": f"TEST-{frappe.generate_hash(length=10)}",
+                "ResponseCode": "00",
+                "ResponseMessage": "Approved"
+            }
+
+        self.patches = [
+            patch.object(self.sdk, "_guarded", side_effect=approve),
+            patch.object(self.sdk, "_handle_response", side_effect=handle),
+            patch("gateway_usp.api.payment_controller.get_xpresspago_sdk", return_value=self.sdk),
+            patch("frappe.db.commit"),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        for tracking in set(self.sent):
+            clear_idempotency_record(tracking)
+
+    def payment(self, client_key):
+        return {
+            "reference_doctype": "Sales Invoice",
+            "reference_docname": "TEST-SINV-CLIENT-KEY",
+            "client_key": client_key,
+            "amount": 25,
+            "currency": "USD",
+            "card_token": "TEST-CARD",
+            "customer_id": "TEST-CUSTOMER",
+            "async_mode": False
+        }
+
+    def test_client_key_is_part_of_client_tracking(self):
+        self.assertEqual(client_tracking(self.payment("a")), "TEST-SINV-CLIENT-KEY:a")
+        self.assertEqual(client_tracking({"reference_docname": "TEST-SINV"}), "TEST-SINV")
+        self.assertLessEqual(len(client_tracking({"reference_docname": "X" * 80, "client_key": "a"})), 50)
+
+    def test_two_client_keys_on_one_document_are_two_sales(self):
+        first = _process_saved_card_payment(self.payment("first"))
+        second = _process_saved_card_payment(self.payment("second"))
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertNotEqual(first["transaction_id"], second["transaction_id"])
+        self.assertTrue(first["charged"] and second["charged"])
+        for result in (first, second):
+            self.assertTrue(frappe.db.exists("USP Transaction", {"transaction_id": result["transaction_id"]}))
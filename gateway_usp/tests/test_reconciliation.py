@@ -0,0 +1,61 @@
+# gateway_usp/tests/test_reconciliation.py
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from gateway_usp.utils.reconciliation import apply_changes
+
+
+def make_pending_transaction(reference_doctype, reference_docname, amount, customer=None):
+    return frappe.get_doc({
+        "doctype": "USP Transaction",
+        "transaction_id": f"TEST-{frappe.generate_hash(length=10)}",
+        "reference_doctype": reference_doctype,
+        "reference_docname": reference_docname,
+        "amount": amount,
+        "currency": "USD",
+        "customer": customer,
+        "status": "Pending"
+    }).insert(ignore_permissions=True)
+
+
+class TestReconciliation(FrappeTestCase):
+    def setUp(self):
+        if not frappe.db.exists("Mode of Payment", "USP Gateway"):
+            frappe.get_doc({
+                "doctype": "Mode of Payment",
+                "mode_of_payment": "USP Gateway",
+                "type": "Bank"
+            }).insert(ignore_permissions=True)
+
+    @patch("frappe.db.commit")
+    def test_resolver_completed_creates_payment_entry(self, _commit):
+        from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+        invoice = create_sales_invoice(rate=100)
+        transaction = make_pending_transaction("Sales Invoice", invoice.name, invoice.grand_total,
+                                               invoice.customer)
+
+        self.assertEqual(apply_changes({transaction.name: {"status": "Completed"}}), 1)
+
+        transaction.reload()
+        self.assertEqual(transaction.status, "Completed")
+        self.assertTrue(transaction.completed_at)
+        self.assertTrue(frappe.db.exists("Payment Entry", {
+            "reference_no": transaction.transaction_id,
+            "docstatus": 1
+        }))
+
+    @patch("frappe.db.commit")
+    def test_resolver_skips_transaction_resolved_by_webhook(self, _commit):
+        from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+        invoice = create_sales_invoice(rate=100)
+        transaction = make_pending_transaction("Sales Invoice", invoice.name, invoice.grand_total,
+                                               invoice.customer)
+        frappe.db.set_value("USP Transaction", transaction.name, "status", "Cancelled")
+
+        self.assertEqual(apply_changes({transaction.name: {"status": "Completed"}}), 0)
+        self.assertFalse(frappe.db.exists("Payment Entry", {"reference_no": transaction.transaction_id}))
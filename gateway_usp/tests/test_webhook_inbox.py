@@ -0,0 +1,65 @@
+# gateway_usp/tests/test_webhook_inbox.py
+
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from gateway_usp.api.webhook_inbox import _process_queued
+from gateway_usp.tests.test_reconciliation import make_pending_transaction
+
+
+def queue_event(transaction_id, status):
+    data = {"transaction_id": transaction_id, "status": status}
+    return frappe.get_doc({
+        "doctype": "USP Webhook Event",
+        "transaction_id": transaction_id,
+        "event_status": status,
+        "event_hash": frappe.generate_hash(),
+        "status": "Queued",
+        "received_at": frappe.utils.now(),
+        "payload": json.dumps(data)
+    }).insert(ignore_permissions=True)
+
+
+class TestWebhookInbox(FrappeTestCase):
+    def setUp(self):
+        if not frappe.db.exists("Mode of Payment", "USP Gateway"):
+            frappe.get_doc({
+                "doctype": "Mode of Payment",
+                "mode_of_payment": "USP Gateway",
+                "type": "Bank"
+            }).insert(ignore_permissions=True)
+
+    @patch("frappe.db.commit")
+    def test_completed_then_refunded_burst_books_the_payment(self, _commit):
+        from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+        invoice = create_sales_invoice(rate=100)
+        transaction = make_pending_transaction("Sales Invoice", invoice.name, invoice.grand_total,
+                                               invoice.customer)
+        completed = queue_event(transaction.transaction_id, "Completed")
+        refunded = queue_event(transaction.transaction_id, "Refunded")
+
+        self.assertFalse(_process_queued(transaction.transaction_id))
+
+        self.assertEqual(frappe.db.get_value("USP Transaction", transaction.name, "status"), "Refunded")
+        self.assertTrue(frappe.db.exists("Payment Entry", {
+            "reference_no": transaction.transaction_id,
+            "docstatus": 1
+        }))
+        for event in (completed, refunded):
+            self.assertEqual(frappe.db.get_value("USP Webhook Event", event.name, "status"), "Processed")
+
+    @patch("frappe.db.commit")
+    def test_burst_without_completed_applies_only_final_status(self, _commit):
+        transaction = make_pending_transaction(None, None, 50)
+        authorized = queue_event(transaction.transaction_id, "Authorized")
+        failed = queue_event(transaction.transaction_id, "Failed")
+
+        self.assertFalse(_process_queued(transaction.transaction_id))
+
+        self.assertEqual(frappe.db.get_value("USP Transaction", transaction.name, "status"), "Failed")
+        self.assertEqual(frappe.db.get_value("USP Webhook Event", authorized.name, "status"), "Coalesced")
+        self.assertEqual(frappe.db.get_value("USP Webhook Event", failed.name, "status"), "Processed")
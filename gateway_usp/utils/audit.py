@@ -0,0 +1,163 @@
+# gateway_usp/utils/audit.py
+
+import json
+import random
+import threading
+from collections.abc import Mapping
+
+import frappe
+
+from .metrics import inc, instrumented_job
+
+DOCTYPE = "USP Audit Event"
+
+# Cola compartida entre workers; el job de drenado la vuelca a la tabla en bloques
+REDIS_QUEUE = "usp_audit_queue"
+
+DEFAULTS = {
+    "usp_audit_debug_sample_rate": 0.0,   # fracción de eventos debug que se guardan (0 a 1)
+    "usp_audit_buffer_size": 5000,         # eventos en memoria por proceso antes de descartar los más viejos
+    "usp_audit_batch_size": 500,           # filas por bulk_insert al drenar
+    "usp_audit_retention_days": 90,
+}
+
+# Un proceso con muchos eventos (p. ej. ventas en lote) vuelca antes de terminar el request
+FLUSH_SIZE = 200
+
+FIELDS = ("name", "event_type", "level", "timestamp", "user", "transaction_id", "payload",
+          "owner", "modified_by", "creation", "modified")
+
+# Pendientes por sitio: {sitio: [evento serializado, ...]}
+_buffer = {}
+_lock = threading.Lock()
+
+
+def _conf(key):
+    value = frappe.conf.get(key)
+    return DEFAULTS[key] if value is None else value
+
+
+def _site():
+    return getattr(frappe.local, "site", None)
+
+
+def audit(event_type, data=None, response=None, error=None, level="info", transaction_id=None):
+    """
+    Registra un evento de auditoría sin tocar la BD
+
+    El evento queda en memoria y se vuelca a Redis al terminar el request o job
+    (hooks after_request/after_job). Los eventos debug se muestrean.
+    """
+    if level == "debug" and random.random() >= float(_conf("usp_audit_debug_sample_rate")):
+        return
+
+    if isinstance(response, Mapping):
+        response = dict(response)
+    if transaction_id is None and isinstance(response, dict):
+        transaction_id = response.get("TransactionId")
+
+    event = json.dumps({
+        "event_type": event_type,
+        "level": level,
+        "timestamp": frappe.utils.now(),
+        "user": frappe.session.user if getattr(frappe.local, "session", None) else None,
+        "transaction_id": transaction_id,
+        "payload": {"data": data, "response": response, "error": error}
+    }, separators=(",", ":"), default=str)
+
+    site = _site()
+    with _lock:
+        pending = _buffer.setdefault(site, [])
+        pending.append(event)
+        dropped = len(pending) - int(_conf("usp_audit_buffer_size"))
+        if dropped > 0:
+            del pending[:dropped]
+        size = len(pending)
+
+    if dropped > 0:
+        inc("usp_audit_events_total", dropped, event="dropped")
+    if size >= FLUSH_SIZE:
+        flush_audit()
+
+
+def flush_audit():
+    """Vuelca los eventos del proceso a la cola de Redis en una sola escritura"""
+    site = _site()
+    with _lock:
+        pending = _buffer.pop(site, None)
+    if not pending:
+        return
+
+    try:
+        cache = frappe.cache()
+        pipe = cache.pipeline(transaction=False)
+        pipe.rpush(cache.make_key(REDIS_QUEUE), *pending)
+        pipe.execute()
+        inc("usp_audit_events_total", len(pending), event="queued")
+    except Exception:
+        # Sin Redis se conservan para el siguiente volcado (el tope del buffer sigue aplicando)
+        with _lock:
+            _buffer[site] = pending + _buffer.get(site, [])
+
+
+@instrumented_job("drain_audit_queue")
+def drain_audit_queue():
+    """Mueve la cola de Redis a USP Audit Event con bulk_insert (cron cada minuto)"""
+    flush_audit()
+
+    cache = frappe.cache()
+    lock = cache.make_key(f"{REDIS_QUEUE}|drain_lock")
+    if not cache.set(lock, 1, nx=True, ex=300):
+        return
+
+    try:
+        batch_size = int(_conf("usp_audit_batch_size"))
+        while True:
+            # Se lee antes de recortar: si el insert falla los eventos siguen en la cola
+            raw_events = cache.lrange(REDIS_QUEUE, 0, batch_size - 1)
+            if not raw_events:
+                break
+
+            _insert(raw_events)
+            frappe.db.commit()
+            # Los productores solo agregan al final, así que recortar el inicio es seguro
+            cache.ltrim(REDIS_QUEUE, len(raw_events), -1)
+            inc("usp_audit_events_total", len(raw_events), event="stored")
+
+            if len(raw_events) < batch_size:
+                break
+    finally:
+        cache.delete(lock)
+
+
+def _insert(raw_events):
+    now = frappe.utils.now()
+    values = []
+    for raw in raw_events:
+        try:
+            event = json.loads(raw)
+        except (TypeError, ValueError):
+            continue
+        values.append((
+            frappe.generate_hash(length=12),
+            event["event_type"],
+            event["level"],
+            event["timestamp"],
+            event["user"],
+            event["transaction_id"],
+            json.dumps(event["payload"], separators=(",", ":")),
+            "Administrator",
+            "Administrator",
+            now,
+            now
+        ))
+    if values:
+        frappe.db.bulk_insert(DOCTYPE, FIELDS, values)
+
+
+@instrumented_job("purge_audit_events")
+def purge_audit_events():
+    """Elimina eventos más viejos que usp_audit_retention_days (diario)"""
+    cutoff = frappe.utils.add_days(frappe.utils.now(), -int(_conf("usp_audit_retention_days")))
+    frappe.db.delete(DOCTYPE, {"timestamp": ("<", cutoff)})
+    frappe.db.commit()
@@ -0,0 +1,411 @@
+# gateway_usp/utils/croem_standin.py
+#
+# Servidor local que imita TokenWebService.asmx y el UIComponent de CROEM
+# para pruebas de carga y resiliencia del XpresspagoSDK real (pool HTTP,
+# timeouts, parser y reintentos). No depende de Frappe.
+#
+# Uso:
+#   python -m gateway_usp.utils.croem_standin --port 8088 --latency lognormal:80:0.5 --error-rate 0.02
+#
+# Desde código:
+#   with CroemStandIn(profiles={"Sale": FaultProfile(reset_rate=0.1)}) as standin:
+#       sdk = XpresspagoSDK(base_urls=standin.base_urls)
+
+import argparse
+import hashlib
+import math
+import random
+import re
+import socket
+import struct
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape, unescape
+
+API_PATH = "/TokenWebService.asmx"
+WIDGET_PATH = "/UIComponent/CreditCard"
+
+_PARAM_RE = re.compile(r"<(?:\w+:)?(\w+)>([^<]*)</(?:\w+:)?\1>")
+_OPERATION_RE = re.compile(r"<soap:Body>\s*<(?:\w+:)?(\w+)", re.S)
+
+
+class LatencyDistribution:
+    """Distribución de latencia en milisegundos: fixed, uniform, normal o lognormal"""
+
+    KINDS = {
+        "fixed": 1,         # fixed:ms
+        "uniform": 2,       # uniform:min_ms:max_ms
+        "normal": 2,        # normal:media_ms:desviación_ms
+        "lognormal": 2,     # lognormal:mediana_ms:sigma (cola larga, similar a un gateway real)
+    }
+
+    def __init__(self, kind="fixed", *params):
+        if kind not in self.KINDS or len(params) != self.KINDS[kind]:
+            raise ValueError(f"Distribución de latencia inválida: {kind}{params}")
+        self.kind = kind
+        self.params = tuple(float(p) for p in params)
+
+    @classmethod
+    def parse(cls, spec):
+        """Crea la distribución desde 'tipo:param[:param]'"""
+        kind, *params = spec.split(":")
+        return cls(kind, *params)
+
+    def sample(self, rng):
+        """Latencia en segundos"""
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            ms = rng.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            ms = rng.lognormvariate(math.log(median), sigma) if median > 0 else 0
+        return max(ms, 0) / 1000.0
+
+    def __repr__(self):
+        return ":".join([self.kind] + [f"{p:g}" for p in self.params])
+
+
+class FaultProfile:
+    """Latencia y tasas de fallo de una operación (las tasas son probabilidades 0..1)"""
+
+    def __init__(self, latency=None, error_rate=0.0, decline_rate=0.0, retryable_rate=0.0,
+                 slow_loris_rate=0.0, reset_rate=0.0, slow_loris_interval=0.5):
+        """
+        Args:
+            latency: LatencyDistribution o especificación 'tipo:params' (por defecto fixed:0)
+            error_rate: HTTP 500 sin procesar la operación
+            decline_rate: Sale rechazada con código 05
+            retryable_rate: Sale rechazada con código 96 (reintentable)
+            slow_loris_rate: respuesta válida enviada byte a byte cada slow_loris_interval segundos
+            reset_rate: la conexión se corta con RST después de recibir la petición
+        """
+        if isinstance(latency, str):
+            latency = LatencyDistribution.parse(latency)
+        self.latency = latency or LatencyDistribution("fixed", 0)
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+        self.retryable_rate = retryable_rate
+        self.slow_loris_rate = slow_loris_rate
+        self.reset_rate = reset_rate
+        self.slow_loris_interval = slow_loris_interval
+
+
+class CroemStandIn:
+    """Servidor CROEM falso en un hilo; expone base_urls para el XpresspagoSDK"""
+
+    def __init__(self, host="127.0.0.1", port=0, profiles=None, default_profile=None,
+                 seed=None, unknown_token_prefix="unknown"):
+        """
+        Args:
+            host, port: dirección de escucha (port=0 elige uno libre)
+            profiles: FaultProfile por operación (Ping, Sale, GetTokenDetails, Widget)
+            default_profile: perfil de las operaciones sin uno propio
+            seed: semilla para reproducir la secuencia de fallos
+            unknown_token_prefix: los accountNumber con este prefijo no existen (T04)
+        """
+        self.profiles = dict(profiles or {})
+        self.default_profile = default_profile or FaultProfile()
+        self.unknown_token_prefix = unknown_token_prefix
+
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._scripted = {}
+        self._stats_lock = threading.Lock()
+        self._sequence = 0
+        self.requests = Counter()
+        self.outcomes = Counter()
+        self.sales_by_tracking = Counter()
+        self.latencies = deque(maxlen=10000)
+
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_urls(self):
+        """URLs para XpresspagoSDK(base_urls=...) en ambos ambientes"""
+        urls = {"api": self.url + API_PATH, "widget": self.url + WIDGET_PATH}
+        return {"SANDBOX": dict(urls), "PRODUCTION": dict(urls)}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="croem-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def queue_fault(self, operation, outcome, count=1):
+        """Fuerza el resultado de las próximas peticiones: error, decline, retryable, slow_loris, reset u ok"""
+        with self._stats_lock:
+            self._scripted.setdefault(operation, deque()).extend([outcome] * count)
+
+    def stats(self):
+        """Peticiones por operación, resultados inyectados y ventas duplicadas por clientTracking"""
+        with self._stats_lock:
+            latencies = sorted(self.latencies)
+            duplicates = {k: v for k, v in self.sales_by_tracking.items() if k and v > 1}
+            return {
+                "requests": dict(self.requests),
+                "outcomes": dict(self.outcomes),
+                "duplicate_sales": duplicates,
+                "p50_injected_ms": _percentile(latencies, 50),
+                "p99_injected_ms": _percentile(latencies, 99)
+            }
+
+    def profile(self, operation):
+        return self.profiles.get(operation, self.default_profile)
+
+    def decide(self, operation):
+        """Elige latencia y resultado de la petición según el perfil o los fallos encolados"""
+        profile = self.profile(operation)
+        with self._rng_lock:
+            latency = profile.latency.sample(self._rng)
+            roll = self._rng.random()
+
+        with self._stats_lock:
+            scripted = self._scripted.get(operation)
+            outcome = scripted.popleft() if scripted else None
+            self.requests[operation] += 1
+            self.latencies.append(round(latency * 1000, 1))
+
+        if outcome is None:
+            outcome = "ok"
+            threshold = 0.0
+            for name, rate in (("reset", profile.reset_rate), ("error", profile.error_rate),
+                               ("slow_loris", profile.slow_loris_rate), ("retryable", profile.retryable_rate),
+                               ("decline", profile.decline_rate)):
+                threshold += rate
+                if roll < threshold:
+                    outcome = name
+                    break
+
+        with self._stats_lock:
+            self.outcomes[f"{operation}:{outcome}"] += 1
+        return latency, outcome
+
+    def next_transaction_id(self):
+        with self._stats_lock:
+            self._sequence += 1
+            return f"{int(time.time())}{self._sequence:06d}"
+
+    def next_authorization_number(self):
+        with self._rng_lock:
+            return f"{self._rng.randint(0, 999999):06d}"
+
+    def record_sale(self, client_tracking):
+        with self._stats_lock:
+            self.sales_by_tracking[client_tracking or ""] += 1
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)]
+
+
+def _envelope(operation, fields):
+    body = "".join(f"<{name}>{escape(str(value))}</{name}>" for name, value in fields.items())
+    result = f"<{operation}Result>{body}</{operation}Result>" if operation != "Ping" else body
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+        f'<soap:Body><{operation}Response xmlns="http://tempuri.org/">{result}'
+        f'</{operation}Response></soap:Body></soap:Envelope>'
+    ).encode("utf-8")
+
+
+def _soap_response(standin, operation, params, outcome):
+    """Cuerpo SOAP de la operación con el resultado elegido"""
+    if operation == "Ping":
+        return _envelope("Ping", {"PingResult": datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")})
+
+    if operation == "Sale":
+        standin.record_sale(params.get("clientTracking"))
+        if outcome in ("decline", "retryable"):
+            code, message = ("05", "Denegada") if outcome == "decline" else ("96", "Mal funcionamiento del sistema")
+            return _envelope("Sale", {"IsSuccess": "false", "ResponseCode": code, "ResponseDescription": message})
+        return _envelope("Sale", {
+            "IsSuccess": "true",
+            "ResponseCode": "00",
+            "ResponseDescription": "Aprobada",
+            "TransactionId": standin.next_transaction_id(),
+            "AuthorizationNumber": standin.next_authorization_number(),
+            "ClientTracking": params.get("clientTracking", ""),
+            "Amount": params.get("amount", ""),
+            "CurrencyCode": params.get("currencyCode", "840")
+        })
+
+    if operation == "GetTokenDetails":
+        account = params.get("accountNumber", "")
+        if account.startswith(standin.unknown_token_prefix):
+            return _envelope("GetTokenDetails", {
+                "IsSuccess": "false", "ResponseCode": "T04", "ResponseDescription": "Token not found"
+            })
+        token = hashlib.sha1(account.encode()).hexdigest()
+        return _envelope("GetTokenDetails", {
+            "IsSuccess": "true",
+            "ResponseCode": "T00",
+            "ResponseDescription": "Success",
+            "AccountToken": f"{token[:8]}-{token[8:12]}-{token[12:16]}-{token[16:20]}-{token[20:32]}",
+            "MaskedCardNumber": "411111******1111",
+            "CardHolderName": "CLIENTE PRUEBA",
+            "ExpirationDate": "1229",
+            "CardType": "VISA"
+        })
+
+    return None
+
+
+def _widget_html(params):
+    culture = params.get("Culture", "es")
+    label = "Número de tarjeta" if culture.startswith("es") else "Card number"
+    token = params.get("Token", "")
+    return (
+        f'<div class="croem-widget" data-culture="{escape(culture)}" data-token="{escape(token)}">'
+        f'<label>{label}</label><input name="card_number" autocomplete="cc-number"/>'
+        '<input name="expiry"/><input name="cvv"/></div>'
+    ).encode("utf-8")
+
+
+def _make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive para ejercitar el pool del SDK
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8", "replace")
+            operation = (self.headers.get("SOAPAction") or "").strip('"').rsplit("/", 1)[-1]
+            if not operation:
+                match = _OPERATION_RE.search(body)
+                operation = match.group(1) if match else ""
+
+            params = {name: unescape(value) for name, value in _PARAM_RE.findall(body)}
+            latency, outcome = standin.decide(operation)
+            time.sleep(latency)
+
+            if self._fault(outcome):
+                return
+
+            payload = _soap_response(standin, operation, params, outcome)
+            if payload is None:
+                self._send(500, _envelope("Fault", {"faultstring": f"Operación desconocida: {operation}"}))
+                return
+            self._send(200, payload, slow=outcome == "slow_loris", interval=standin.profile(operation).slow_loris_interval)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != WIDGET_PATH:
+                self._send(404, b"Not Found", content_type="text/plain")
+                return
+
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            latency, outcome = standin.decide("Widget")
+            time.sleep(latency)
+
+            if self._fault(outcome):
+                return
+
+            payload = _widget_html(params)
+            etag = '"%s"' % hashlib.sha1(payload).hexdigest()[:16]
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", headers={"ETag": etag})
+                return
+            self._send(200, payload, content_type="text/html; charset=utf-8",
+                       headers={"ETag": etag, "Cache-Control": "private, max-age=0"},
+                       slow=outcome == "slow_loris", interval=standin.profile("Widget").slow_loris_interval)
+
+        def _fault(self, outcome):
+            """Aplica los fallos que no producen una respuesta normal; True si la petición terminó"""
+            if outcome == "reset":
+                # SO_LINGER 0: close() envía RST en vez de FIN
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.close_connection = True
+                self.connection.close()
+                return True
+            if outcome == "error":
+                self._send(500, _envelope("Fault", {"faultstring": "Internal Server Error"}))
+                return True
+            return False
+
+        def _send(self, status, payload, content_type="text/xml; charset=utf-8", headers=None,
+                  slow=False, interval=0.5):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            if not slow:
+                self.wfile.write(payload)
+                return
+            # Slow-loris: cada byte llega antes del timeout de lectura, pero la respuesta completa tarda mucho
+            try:
+                for i in range(len(payload)):
+                    self.wfile.write(payload[i:i + 1])
+                    self.wfile.flush()
+                    time.sleep(interval)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor CROEM local con latencia y fallos inyectados")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:ms | uniform:min:max | normal:media:desv | lognormal:mediana:sigma")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--retryable-rate", type=float, default=0.0)
+    parser.add_argument("--slow-loris-rate", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    profile = FaultProfile(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        decline_rate=args.decline_rate,
+        retryable_rate=args.retryable_rate,
+        slow_loris_rate=args.slow_loris_rate,
+        reset_rate=args.reset_rate
+    )
+    standin = CroemStandIn(args.host, args.port, default_profile=profile, seed=args.seed)
+    print(f"CROEM stand-in en {standin.url}")
+    print(f"  api:    {standin.base_urls['SANDBOX']['api']}")
+    print(f"  widget: {standin.base_urls['SANDBOX']['widget']}")
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.server.server_close()
+        print(standin.stats())
+
+
+if __name__ == "__main__":
+    main()
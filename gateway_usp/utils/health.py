@@ -0,0 +1,154 @@
+# gateway_usp/utils/health.py
+
+import json
+import time
+
+import frappe
+
+from .metrics import instrumented_job, set_gauge
+
+# Muestras guardadas por ambiente (con el cron cada minuto: una hora de historia)
+DEFAULT_SAMPLES = 60
+
+# Muestras recientes que definen el estado actual
+RECENT_SAMPLES = 5
+
+# Si la última muestra es más vieja que esto, el prober no está corriendo
+STALE_AFTER_SECONDS = 180
+
+
+def _key(environment):
+    return f"usp_health|{environment}"
+
+
+def _max_samples():
+    return frappe.conf.get("usp_health_samples") or DEFAULT_SAMPLES
+
+
+def _environments(settings):
+    """Ambiente configurado más los adicionales de site_config (usp_health_environments)"""
+    environments = [settings.environment]
+    for environment in frappe.conf.get("usp_health_environments") or []:
+        if environment not in environments:
+            environments.append(environment)
+    return environments
+
+
+@instrumented_job("probe_gateway_health")
+def probe_gateway_health():
+    """Hace ping a cada ambiente y guarda la muestra en el buffer circular (cron cada minuto)"""
+    settings = frappe.get_single("USP Payment Gateway Settings")
+    if not settings.is_enabled or settings.use_mock_mode or frappe.conf.get("usp_use_mock"):
+        return
+
+    from gateway_usp.api.xpresspago_sdk import XpresspagoSDK, get_xpresspago_sdk
+
+    configured = get_xpresspago_sdk()
+    for environment in _environments(settings):
+        sdk = configured
+        if environment != configured.environment:
+            sdk = XpresspagoSDK(
+                environment=environment,
+                api_key=configured.api_key,
+                access_code=configured.access_code,
+                merchant_account_number=configured.merchant_account_number,
+                terminal_name=configured.terminal_name
+            )
+        record_sample(environment, *_ping(sdk))
+
+
+def _ping(sdk):
+    started = time.monotonic()
+    try:
+        result = sdk.ping()
+    except Exception as e:
+        result = {"IsSuccess": False, "ResponseCode": "999", "ResponseMessage": str(e)}
+    latency_ms = round((time.monotonic() - started) * 1000, 1)
+    return bool(result.get("IsSuccess")), latency_ms, result.get("ResponseCode"), result.get("ResponseMessage")
+
+
+def record_sample(environment, ok, latency_ms, code=None, message=None):
+    """Agrega una muestra al buffer circular del ambiente"""
+    sample = {
+        "ts": time.time(),
+        "ok": ok,
+        "latency_ms": latency_ms,
+        "code": code,
+        "message": (message or "")[:140]
+    }
+    cache = frappe.cache()
+    cache.lpush(_key(environment), json.dumps(sample))
+    cache.ltrim(_key(environment), 0, _max_samples() - 1)
+    set_gauge("usp_gateway_up", 1 if ok else 0, environment=environment)
+
+
+def get_samples(environment):
+    """Muestras del ambiente, de la más reciente a la más antigua"""
+    samples = []
+    for raw in frappe.cache().lrange(_key(environment), 0, -1) or []:
+        try:
+            samples.append(json.loads(raw))
+        except (TypeError, ValueError):
+            continue
+    return samples
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)]
+
+
+def get_gateway_health(environment=None):
+    """
+    Estado del gateway a partir de las muestras del prober, sin tocar la red
+
+    status: healthy, degraded, down o unknown (sin muestras)
+    """
+    if not environment:
+        environment = frappe.db.get_single_value("USP Payment Gateway Settings", "environment") or "SANDBOX"
+
+    samples = get_samples(environment)
+    if not samples:
+        return {"environment": environment, "status": "unknown", "samples": 0, "stale": True}
+
+    recent = samples[:RECENT_SAMPLES]
+    recent_failures = sum(1 for sample in recent if not sample["ok"])
+    if not recent_failures:
+        status = "healthy"
+    elif recent_failures < len(recent):
+        status = "degraded"
+    else:
+        status = "down"
+
+    latencies = sorted(sample["latency_ms"] for sample in samples if sample["ok"])
+    last = samples[0]
+    last_success = next((sample["ts"] for sample in samples if sample["ok"]), None)
+
+    return {
+        "environment": environment,
+        "status": status,
+        "samples": len(samples),
+        "availability": round(sum(1 for sample in samples if sample["ok"]) / len(samples), 4),
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "last_sample": last,
+        "last_success": last_success,
+        "stale": time.time() - last["ts"] > STALE_AFTER_SECONDS
+    }
+
+
+def request_health_probe():
+    """Encola una muestra inmediata (p. ej. tras guardar la configuración)"""
+    frappe.enqueue(
+        "gateway_usp.utils.health.probe_gateway_health",
+        queue="short",
+        enqueue_after_commit=True
+    )
+
+
+@frappe.whitelist()
+def get_health(environment=None):
+    """Estado cacheado del gateway para el formulario de configuración"""
+    frappe.only_for("System Manager")
+    return get_gateway_health(environment)
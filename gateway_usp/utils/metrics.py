@@ -0,0 +1,301 @@
+# gateway_usp/utils/metrics.py
+
+import functools
+import hmac
+import inspect
+import threading
+import time
+from bisect import bisect_left
+
+import frappe
+import redis
+
+# Buckets de latencia en segundos (gateway, endpoints y jobs)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+
+# Buckets del retraso de webhooks en segundos
+LAG_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600, 21600, 86400)
+
+# Catálogo de métricas: nombre -> (tipo, descripción, buckets)
+METRICS = {
+    "usp_gateway_request_duration_seconds": (
+        "histogram", "Latencia de las llamadas HTTP al gateway CROEM", LATENCY_BUCKETS),
+    "usp_gateway_circuit_rejections_total": (
+        "counter", "Llamadas rechazadas por el circuit breaker sin tocar la red", None),
+    "usp_sale_results_total": (
+        "counter", "Resultados de Sale por código de respuesta", None),
+    "usp_sale_retry_events_total": (
+        "counter", "Eventos de reintento e idempotencia de Sale", None),
+    "usp_payment_idempotency_events_total": (
+        "counter", "Cobros repetidos devueltos, en curso o en conflicto por documento de referencia", None),
+    "usp_token_cache_events_total": (
+        "counter", "Aciertos, fallos e invalidaciones de la caché de tokens", None),
+    "usp_audit_events_total": (
+        "counter", "Eventos de auditoría encolados, guardados o descartados", None),
+    "usp_reconciliation_events_total": (
+        "counter", "Transacciones Pending conciliadas o sin resolver por la conciliación", None),
+    "usp_notifications_total": (
+        "counter", "Notificaciones al cliente encoladas, duplicadas, enviadas, sin email o con error", None),
+    "usp_endpoint_duration_seconds": (
+        "histogram", "Duración de los endpoints de pago", LATENCY_BUCKETS),
+    "usp_webhook_events_total": (
+        "counter", "Webhooks recibidos por estado", None),
+    "usp_webhook_inbox_events_total": (
+        "counter", "Eventos de la bandeja de webhooks por resultado (recibidos, duplicados, procesados, combinados...)", None),
+    "usp_webhook_lag_seconds": (
+        "histogram", "Tiempo entre la creación de la transacción y su webhook", LAG_BUCKETS),
+    "usp_job_duration_seconds": (
+        "histogram", "Duración de los jobs programados", LATENCY_BUCKETS),
+    "usp_gateway_up": (
+        "gauge", "Resultado del último ping del prober de salud (1 disponible, 0 caído)", None),
+    "usp_job_last_success_timestamp_seconds": (
+        "gauge", "Última ejecución exitosa de cada job (epoch)", None),
+}
+
+REDIS_KEY = "usp_metrics"
+FLUSH_INTERVAL = 10   # segundos entre volcados de cada proceso a Redis
+
+# Pendientes por sitio: {sitio: {serie: valor}}; los histogramas guardan conteos por bucket sin acumular
+_pending = {}
+_gauges = {}
+_last_flush = {}
+_lock = threading.Lock()
+
+
+def _series(name, labels, extra=None):
+    """Nombre de la serie en formato de exposición, p. ej. name{a="b"}"""
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return name
+    rendered = ",".join(f'{key}="{_escape(value)}"' for key, value in items)
+    return f"{name}{{{rendered}}}"
+
+
+def _escape(value):
+    text = str(value)
+    if "\\" in text or '"' in text or "\n" in text:
+        text = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return text
+
+
+def _site():
+    return getattr(frappe.local, "site", None)
+
+
+def inc(name, value=1, **labels):
+    """Incrementa un contador"""
+    series = _series(name, labels)
+    site = _site()
+    with _lock:
+        pending = _pending.setdefault(site, {})
+        pending[series] = pending.get(series, 0) + value
+    _maybe_flush(site)
+
+
+def observe(name, value, **labels):
+    """Registra una observación en un histograma"""
+    buckets = METRICS[name][2]
+    index = bisect_left(buckets, value)
+    key = (name, tuple(sorted(labels.items())))
+    site = _site()
+    with _lock:
+        pending = _pending.setdefault(site, {})
+        counts = pending.get(key)
+        if counts is None:
+            # [conteo por bucket..., +Inf, suma]
+            counts = pending[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[index] += 1
+        counts[-1] += value
+    _maybe_flush(site)
+
+
+def set_gauge(name, value, **labels):
+    """Fija el valor de un gauge (el último worker en escribir gana)"""
+    series = _series(name, labels)
+    site = _site()
+    with _lock:
+        _gauges.setdefault(site, {})[series] = value
+    _maybe_flush(site)
+
+
+class timer:
+    """Context manager que observa la duración del bloque en un histograma"""
+
+    __slots__ = ("name", "labels", "started")
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def instrumented_endpoint(endpoint):
+    """Decorador: duración del endpoint con outcome success/failure según el dict devuelto"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                if isinstance(result, dict) and "success" in result:
+                    outcome = "success" if result.get("success") else "failure"
+                else:
+                    outcome = "success"
+                return result
+            finally:
+                observe("usp_endpoint_duration_seconds", time.perf_counter() - started,
+                        endpoint=endpoint, outcome=outcome)
+
+        # frappe.call filtra los argumentos del form_dict con fnargs
+        wrapper.fnargs = inspect.getfullargspec(func).args
+        return wrapper
+    return decorator
+
+
+def instrumented_job(job):
+    """Decorador: duración de un job programado y marca de la última ejecución exitosa"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "success"
+                set_gauge("usp_job_last_success_timestamp_seconds", time.time(), job=job)
+                return result
+            finally:
+                observe("usp_job_duration_seconds", time.perf_counter() - started, job=job, outcome=outcome)
+                flush_metrics(force=True)
+
+        wrapper.fnargs = inspect.getfullargspec(func).args
+        return wrapper
+    return decorator
+
+
+def _maybe_flush(site):
+    if time.monotonic() - _last_flush.get(site, 0.0) >= FLUSH_INTERVAL:
+        flush_metrics()
+
+
+def flush_metrics(force=False):
+    """Vuelca los valores pendientes del sitio actual a Redis (hooks after_request/after_job)"""
+    site = _site()
+    now = time.monotonic()
+    with _lock:
+        if not force and now - _last_flush.get(site, 0.0) < FLUSH_INTERVAL:
+            return
+        _last_flush[site] = now
+        pending = _pending.pop(site, None)
+        gauges = _gauges.pop(site, None)
+
+    if not pending and not gauges:
+        return
+
+    try:
+        cache = frappe.cache()
+        key = cache.make_key(REDIS_KEY)
+        pipe = cache.pipeline(transaction=False)
+        for series, value in (pending or {}).items():
+            if isinstance(series, tuple):
+                _flush_histogram(pipe, key, series, value)
+            elif isinstance(value, float):
+                pipe.hincrbyfloat(key, series, value)
+            else:
+                pipe.hincrby(key, series, value)
+        for series, value in (gauges or {}).items():
+            pipe.hset(key, series, value)
+        pipe.execute()
+    except Exception:
+        # Sin Redis se conservan los valores para el siguiente volcado
+        with _lock:
+            target = _pending.setdefault(site, {})
+            for series, value in (pending or {}).items():
+                if not isinstance(series, tuple):
+                    target[series] = target.get(series, 0) + value
+                elif series in target:
+                    target[series] = [a + b for a, b in zip(target[series], value)]
+                else:
+                    target[series] = value
+            for series, value in (gauges or {}).items():
+                _gauges.setdefault(site, {}).setdefault(series, value)
+
+
+def _flush_histogram(pipe, key, series, counts):
+    name, label_items = series
+    labels = dict(label_items)
+    buckets = METRICS[name][2]
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        # Todos los buckets se escriben (aun con 0) para que cada serie tenga el mismo conjunto de le
+        pipe.hincrby(key, _series(f"{name}_bucket", labels, ("le", f"{bound:g}")), cumulative)
+    total = cumulative + counts[len(buckets)]
+    pipe.hincrby(key, _series(f"{name}_bucket", labels, ("le", "+Inf")), total)
+    pipe.hincrby(key, _series(f"{name}_count", labels), total)
+    pipe.hincrbyfloat(key, _series(f"{name}_sum", labels), counts[-1])
+
+
+def render_metrics():
+    """Texto en formato de exposición Prometheus con los valores agregados de todos los workers"""
+    flush_metrics(force=True)
+    cache = frappe.cache()
+    # RedisWrapper.hgetall agrega el prefijo otra vez y deserializa con pickle; el hash se
+    # escribe con el pipeline crudo, así que se lee con el cliente base
+    values = redis.Redis.hgetall(cache, cache.make_key(REDIS_KEY)) or {}
+
+    by_metric = {}
+    for series, value in values.items():
+        series = series.decode() if isinstance(series, bytes) else series
+        value = value.decode() if isinstance(value, bytes) else value
+        base = series.split("{", 1)[0]
+        for suffix in ("_bucket", "_count", "_sum"):
+            if base.endswith(suffix) and base[:-len(suffix)] in METRICS:
+                base = base[:-len(suffix)]
+                break
+        by_metric.setdefault(base, []).append((series, value))
+
+    lines = []
+    for name, (kind, help_text, _buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for series, value in sorted(by_metric.get(name, ()), key=_sort_key):
+            lines.append(f"{series} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _sort_key(item):
+    # Mantener los buckets de cada serie en orden numérico de le
+    series = item[0]
+    if 'le="' in series:
+        le = series.rsplit('le="', 1)[1].split('"', 1)[0]
+        return (series.rsplit('le="', 1)[0], float("inf") if le == "+Inf" else float(le))
+    return (series, 0.0)
+
+
+def _authorized_scrape():
+    """Token de scrape opcional (usp_metrics_token) para Prometheus sin sesión de usuario"""
+    token = frappe.conf.get("usp_metrics_token")
+    header = frappe.get_request_header("Authorization") or ""
+    return bool(token) and hmac.compare_digest(header, f"Bearer {token}")
+
+
+@frappe.whitelist(allow_guest=True)
+def metrics():
+    """Endpoint de métricas en formato texto de Prometheus"""
+    if not _authorized_scrape():
+        frappe.only_for("System Manager")
+
+    from werkzeug.wrappers import Response
+
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -99,8 +99,8 @@ def test_widget_loading():
     try:
         sdk = get_xpresspago_sdk()
         
-        # Probar widget en español
-        widget_result = sdk.create_token_widget(culture="es")
+        # Probar widget en español contra el gateway, sin pasar por la caché
+        widget_result = sdk.create_token_widget(culture="es", use_cache=False)
         
         if widget_result.get("IsSuccess"):
             return {
@@ -318,6 +318,16 @@ def run_full_connectivity_test():
         if not transaction_test.get("success"):
             results["overall_success"] = False
         
+        # Reutilización de conexiones del pool HTTP (informativo)
+        from gateway_usp.api.transport import transport_stats
+        results["transport"] = transport_stats()
+        
+        from gateway_usp.api.retry import retry_metrics
+        results["retries"] = retry_metrics()
+        
+        from gateway_usp.api.token_cache import token_cache_metrics
+        results["token_cache"] = token_cache_metrics()
+        
         return results
     
     except Exception as e:
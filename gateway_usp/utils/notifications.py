@@ -0,0 +1,209 @@
+# gateway_usp/utils/notifications.py
+
+import json
+
+import frappe
+
+from .metrics import inc, instrumented_job
+
+# Intenciones de notificación compartidas entre workers; el cron las envía en lotes
+REDIS_QUEUE = "usp_notification_queue"
+
+# Intenciones que no se pudieron enviar, para revisión (las más recientes)
+DEAD_LETTER_QUEUE = "usp_notification_dead_letter"
+DEAD_LETTER_SIZE = 1000
+
+DEFAULTS = {
+    "usp_notification_batch_size": 200,          # intenciones por lote (una consulta de clientes)
+    "usp_notification_dedup_ttl": 7 * 86400,     # una sola notificación por transacción y estado
+}
+
+TEMPLATES = {
+    "Completed": {
+        "subject": "Pago Completado - USP Gateway",
+        "header": "Pago Completado",
+        "message": """
+            <h3>Pago Completado</h3>
+            <p>Su pago ha sido procesado exitosamente:</p>
+            <ul>
+                <li><strong>ID Transacción:</strong> {{ transaction_id | e }}</li>
+                <li><strong>Monto:</strong> {{ currency | e }} {{ amount }}</li>
+                <li><strong>Fecha:</strong> {{ completed_at | e }}</li>
+            </ul>
+        """
+    },
+    "Failed": {
+        "subject": "Pago Fallido - USP Gateway",
+        "header": "Pago Fallido",
+        "message": """
+            <h3>Pago Fallido</h3>
+            <p>Su pago no pudo ser procesado:</p>
+            <ul>
+                <li><strong>ID Transacción:</strong> {{ transaction_id | e }}</li>
+                <li><strong>Monto:</strong> {{ currency | e }} {{ amount }}</li>
+                <li><strong>Error:</strong> {{ (error_message or 'Error desconocido') | e }}</li>
+            </ul>
+            <p>Por favor, intente nuevamente o contacte con soporte.</p>
+        """
+    },
+}
+
+# Plantillas compiladas una vez por proceso: {estado: Template}
+_compiled = {}
+
+
+def _conf(key):
+    value = frappe.conf.get(key)
+    return DEFAULTS[key] if value is None else value
+
+
+def _enabled():
+    return bool(frappe.db.get_single_value("USP Payment Gateway Settings", "send_notifications"))
+
+
+def _template(status):
+    template = _compiled.get(status)
+    if template is None:
+        template = _compiled[status] = frappe.get_jenv().from_string(TEMPLATES[status]["message"])
+    return template
+
+
+def queue_status_notification(doc):
+    """Notifica al cliente si el guardado cambió la transacción a un estado notificable (on_update)"""
+    if doc.has_value_changed("status"):
+        queue_notification(doc)
+
+
+def queue_notification(doc):
+    """
+    Registra la intención de notificar al cliente el estado actual de la transacción
+
+    Se encola después del commit; una transacción se notifica una sola vez por estado.
+    """
+    if doc.status not in TEMPLATES or not doc.customer:
+        return
+    if not _enabled():
+        return
+
+    name, status = doc.name, doc.status
+    intent = json.dumps({
+        "transaction": name,
+        "status": status,
+        "customer": doc.customer,
+        "transaction_id": doc.transaction_id,
+        "amount": doc.amount,
+        "currency": doc.currency,
+        "completed_at": doc.completed_at,
+        "error_message": doc.error_message
+    }, separators=(",", ":"), default=str)
+
+    def push():
+        try:
+            cache = frappe.cache()
+            dedup_key = cache.make_key(f"usp_notified|{name}|{status}")
+            if not cache.set(dedup_key, 1, nx=True, ex=int(_conf("usp_notification_dedup_ttl"))):
+                inc("usp_notifications_total", event="duplicate")
+                return
+            cache.rpush(REDIS_QUEUE, intent)
+            inc("usp_notifications_total", event="queued")
+        except Exception as e:
+            frappe.log_error(f"Error encolando notificación de {name}: {str(e)}", "USP Notifications")
+
+    frappe.db.after_commit.add(push)
+
+
+@instrumented_job("send_queued_notifications")
+def send_queued_notifications():
+    """Envía las notificaciones encoladas por lotes a la cola de email (cron cada minuto)"""
+    cache = frappe.cache()
+    lock = cache.make_key(f"{REDIS_QUEUE}|send_lock")
+    if not cache.set(lock, 1, nx=True, ex=300):
+        return
+
+    try:
+        batch_size = int(_conf("usp_notification_batch_size"))
+        enabled = _enabled()
+        while True:
+            raw_intents = cache.lrange(REDIS_QUEUE, 0, batch_size - 1)
+            if not raw_intents:
+                break
+
+            try:
+                if enabled:
+                    _send(raw_intents)
+                    frappe.db.commit()
+                else:
+                    inc("usp_notifications_total", len(raw_intents), event="disabled")
+            except Exception as e:
+                # Error del lote (p. ej. la consulta de clientes): se aparta para no bloquear la cola
+                frappe.db.rollback()
+                _dead_letter(raw_intents, e)
+            finally:
+                # Los productores solo agregan al final, así que recortar el inicio es seguro
+                cache.ltrim(REDIS_QUEUE, len(raw_intents), -1)
+
+            if len(raw_intents) < batch_size:
+                break
+    finally:
+        cache.delete(lock)
+
+
+def _dead_letter(raw_intents, error):
+    """Aparta intenciones que no se pudieron enviar y registra el error"""
+    inc("usp_notifications_total", len(raw_intents), event="error")
+    frappe.log_error(f"Error enviando {len(raw_intents)} notificación(es) USP: {str(error)}",
+                     "USP Notifications")
+    try:
+        cache = frappe.cache()
+        cache.rpush(DEAD_LETTER_QUEUE, *raw_intents)
+        cache.ltrim(DEAD_LETTER_QUEUE, -DEAD_LETTER_SIZE, -1)
+    except Exception:
+        pass
+
+
+def _send(raw_intents):
+    intents = []
+    for raw in raw_intents:
+        try:
+            intent = json.loads(raw)
+            if intent.get("status") not in TEMPLATES or not intent.get("customer"):
+                raise ValueError("intención incompleta")
+            intents.append((raw, intent))
+        except (TypeError, ValueError, AttributeError) as e:
+            _dead_letter([raw], e)
+    if not intents:
+        return
+
+    # Correos de todos los clientes del lote en una consulta
+    emails = dict(frappe.get_all(
+        "Customer",
+        filters={"name": ("in", list({intent["customer"] for _raw, intent in intents}))},
+        fields=["name", "email_id"],
+        as_list=True
+    ))
+
+    for raw, intent in intents:
+        email = emails.get(intent["customer"])
+        if not email:
+            inc("usp_notifications_total", event="no_email")
+            continue
+
+        # Una intención con error (email inválido, transacción borrada) no detiene el resto del lote
+        frappe.db.savepoint("usp_notification")
+        try:
+            template = TEMPLATES[intent["status"]]
+            # delayed: queda en Email Queue y la envía el worker de correo
+            frappe.sendmail(
+                recipients=[email],
+                subject=template["subject"],
+                message=_template(intent["status"]).render(intent),
+                header=template["header"],
+                reference_doctype="USP Transaction",
+                reference_name=intent.get("transaction"),
+                delayed=True
+            )
+        except Exception as e:
+            frappe.db.rollback(save_point="usp_notification")
+            _dead_letter([raw], e)
+            continue
+        inc("usp_notifications_total", event="sent")
@@ -0,0 +1,87 @@
+# gateway_usp/utils/payload_store.py
+
+import base64
+import json
+import zlib
+
+import frappe
+
+DOCTYPE = "USP Transaction Payload"
+
+# Payloads guardados por transacción
+PAYLOAD_FIELDS = ("response_data", "webhook_data")
+
+# Columnas escritas en bloque (ventas en lote, backfill)
+BULK_FIELDS = ("name", "owner", "modified_by", "creation", "modified", "docstatus",
+               "transaction", "response_data", "webhook_data")
+
+
+def compress(data):
+    """JSON (dict o texto ya serializado) -> zlib + base64"""
+    if data is None:
+        return None
+    text = data if isinstance(data, str) else json.dumps(data, default=str, separators=(",", ":"))
+    return base64.b64encode(zlib.compress(text.encode(), 6)).decode("ascii")
+
+
+def decompress(value):
+    if not value:
+        return None
+    try:
+        return json.loads(zlib.decompress(base64.b64decode(value)).decode())
+    except (ValueError, zlib.error):
+        frappe.log_error(f"Payload USP ilegible ({len(value)} bytes)", "USP Payload Store")
+        return None
+
+
+def save_payload(transaction, response_data=None, webhook_data=None):
+    """Guarda (o reemplaza) la respuesta de venta y/o el webhook de la transacción"""
+    values = {
+        field: compress(data)
+        for field, data in (("response_data", response_data), ("webhook_data", webhook_data))
+        if data is not None
+    }
+    if not (transaction and values):
+        return
+
+    name = frappe.db.get_value(DOCTYPE, {"transaction": transaction})
+    if name:
+        frappe.db.set_value(DOCTYPE, name, values)
+    else:
+        frappe.get_doc(dict(values, doctype=DOCTYPE, transaction=transaction)).insert(ignore_permissions=True)
+
+
+def bulk_row(transaction, response_data=None, webhook_data=None, user=None, timestamp=None):
+    """Fila de USP Transaction Payload en el orden de BULK_FIELDS"""
+    user = user or frappe.session.user
+    timestamp = timestamp or frappe.utils.now()
+    return (frappe.generate_hash(length=10), user, user, timestamp, timestamp, 0,
+            transaction, compress(response_data), compress(webhook_data))
+
+
+def get_payloads(transactions, fields=PAYLOAD_FIELDS):
+    """{transaction: {campo: dict}} para varias transacciones en una consulta"""
+    if not transactions:
+        return {}
+    rows = frappe.get_all(
+        DOCTYPE,
+        filters={"transaction": ("in", list(transactions))},
+        fields=["transaction", *fields]
+    )
+    return {row.transaction: {field: decompress(row.get(field)) for field in fields} for row in rows}
+
+
+def get_payload(transaction):
+    return get_payloads([transaction]).get(transaction) or dict.fromkeys(PAYLOAD_FIELDS)
+
+
+def delete_payloads(transactions):
+    if transactions:
+        frappe.db.delete(DOCTYPE, {"transaction": ("in", list(transactions))})
+
+
+@frappe.whitelist()
+def get_transaction_payload(transaction):
+    """Payloads de la transacción para el formulario (se cargan al abrir la sección)"""
+    frappe.has_permission("USP Transaction", "read", transaction, throw=True)
+    return get_payload(transaction)
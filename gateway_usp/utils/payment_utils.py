@@ -252,20 +252,9 @@ def debug_payment_data():
         return {"error": str(e)}
 
 def log_usp_transaction(transaction_type, data, response=None, error=None):
-    """Log de transacciones USP para auditoría"""
-    log_entry = {
-        "timestamp": frappe.utils.now(),
-        "transaction_type": transaction_type,
-        "data": data,
-        "response": response,
-        "error": error,
-        "user": frappe.session.user
-    }
-    
-    frappe.log_error(
-        message=json.dumps(log_entry, indent=2),
-        title=f"USP Transaction - {transaction_type}"
-    )
+    """Log de transacciones USP para auditoría (USP Audit Event, escrito en bloque)"""
+    from gateway_usp.utils.audit import audit
+    audit(transaction_type, data, response, error, level="error" if error else "info")
 
 # Función helper para obtener settings de USP
 @frappe.whitelist()
@@ -0,0 +1,276 @@
+# gateway_usp/utils/reconciliation.py
+
+import asyncio
+import json
+import time
+
+import frappe
+
+from .metrics import inc
+from .payload_store import get_payloads
+
+DOCTYPE = "USP Transaction"
+
+# Checkpoint (created_at, name) de la última página conciliada, en tabDefaultValue
+CHECKPOINT_KEY = "usp_reconciliation_checkpoint"
+
+DEFAULTS = {
+    "usp_reconciliation_min_age_minutes": 10,   # no tocar transacciones recién creadas
+    "usp_reconciliation_time_budget": 300,      # segundos por corrida antes de guardar el checkpoint
+    "usp_reconciliation_page_size": 200,
+    "usp_reconciliation_concurrency": 5,        # consultas simultáneas al gateway
+    "usp_reconciliation_rate": 5.0,             # consultas por segundo al gateway
+    "usp_reconciliation_resolver": None,        # ruta a la corrutina que consulta el estado en el gateway
+}
+
+# Códigos que NO prueban un rechazo: el gateway pudo no haber recibido o procesado la venta
+INCONCLUSIVE_CODES = {"997", "998", "999"}
+
+# Campos que usa notifications.queue_notification
+NOTIFICATION_FIELDS = ["name", "status", "customer", "transaction_id", "amount", "currency",
+                       "completed_at", "error_message"]
+
+STATUSES = {"Pending", "Authorized", "Completed", "Failed", "Cancelled", "Refunded", "Partially Refunded"}
+
+
+def _conf(key):
+    value = frappe.conf.get(key)
+    return DEFAULTS[key] if value is None else value
+
+
+class AsyncTokenBucket:
+    """Limitador de tasa para corrutinas: rate fichas por segundo, ráfaga de hasta burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def load_checkpoint():
+    value = frappe.db.get_global(CHECKPOINT_KEY)
+    if not value:
+        return None
+    try:
+        created_at, name = json.loads(value)
+        return created_at, name
+    except (TypeError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint):
+    frappe.db.set_global(CHECKPOINT_KEY, json.dumps([str(checkpoint[0]), checkpoint[1]]) if checkpoint else "")
+
+
+def next_page(checkpoint, cutoff, page_size):
+    """Página de transacciones Pending después del checkpoint, paginada por (created_at, name)"""
+    after_created, after_name = checkpoint or ("1900-01-01 00:00:00", "")
+    rows = frappe.db.sql("""
+        SELECT name, transaction_id, created_at, amount
+        FROM `tabUSP Transaction`
+        WHERE status = 'Pending'
+          AND created_at < %(cutoff)s
+          AND (created_at > %(after_created)s
+               OR (created_at = %(after_created)s AND name > %(after_name)s))
+        ORDER BY created_at, name
+        LIMIT %(limit)s
+    """, {
+        "cutoff": cutoff,
+        "after_created": after_created,
+        "after_name": after_name,
+        "limit": page_size
+    }, as_dict=True)
+
+    # Respuestas de Sale de toda la página en una consulta (row.response_data: dict o None)
+    payloads = get_payloads([row.name for row in rows], fields=("response_data",))
+    for row in rows:
+        row.response_data = (payloads.get(row.name) or {}).get("response_data")
+    return rows
+
+
+def resolve_locally(row):
+    """
+    Estado que se puede concluir sin red a partir de la respuesta de Sale guardada
+
+    Solo un rechazo definitivo es concluyente; una venta aprobada sigue esperando el
+    webhook (o el resolver remoto) para no marcar como completado lo que el gateway no confirmó.
+    """
+    response = row.response_data or {}
+    if not response or response.get("IsSuccess") or response.get("ResponseCode") in INCONCLUSIVE_CODES:
+        return None
+    if not response.get("ResponseCode"):
+        return None
+    return {
+        "status": "Failed",
+        "gateway_response_code": response.get("ResponseCode"),
+        "gateway_message": response.get("ResponseMessage"),
+        "error_message": response.get("ResponseMessage")
+    }
+
+
+def _get_resolver():
+    path = _conf("usp_reconciliation_resolver")
+    return frappe.get_attr(path) if path else None
+
+
+async def _resolve_remote(rows, resolver, deadline):
+    """Consulta el gateway para cada fila con concurrencia y tasa limitadas"""
+    from gateway_usp.api.xpresspago_async import get_async_xpresspago_sdk
+
+    async_sdk = get_async_xpresspago_sdk(max_concurrency=int(_conf("usp_reconciliation_concurrency")))
+    bucket = AsyncTokenBucket(float(_conf("usp_reconciliation_rate")))
+
+    async def query(row):
+        await bucket.acquire()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(resolver(async_sdk, row), remaining)
+        except Exception as e:
+            inc("usp_reconciliation_events_total", outcome="query_error")
+            frappe.log_error(f"Error consultando {row.transaction_id} en el gateway: {str(e)}",
+                             "USP Reconciliation")
+            return None
+
+    try:
+        return await asyncio.gather(*(query(row) for row in rows))
+    finally:
+        async_sdk.close()
+
+
+def apply_changes(changes):
+    """
+    Aplica los cambios de estado de una página; devuelve cuántas transacciones cambiaron
+
+    Los rechazos (Failed) no tienen documento relacionado: se escriben en lote y solo encolan
+    su notificación. Cualquier otro estado pasa por el documento (ver _apply_with_effects)
+    para que, p. ej., un Completed cree su Payment Entry como lo haría el webhook.
+    """
+    from .notifications import queue_notification
+
+    if not changes:
+        return 0
+    now = frappe.utils.now()
+    failed = {}
+    for name, values in changes.items():
+        values["updated_at"] = now
+        values.setdefault("processed_at", now)
+        if values["status"] == "Completed":
+            values.setdefault("completed_at", now)
+        elif values["status"] == "Failed":
+            failed[name] = values
+
+    if failed:
+        frappe.db.bulk_update(DOCTYPE, failed, chunk_size=100, update_modified=True)
+        for row in frappe.get_all(DOCTYPE, filters={"name": ("in", list(failed))}, fields=NOTIFICATION_FIELDS):
+            queue_notification(row)
+        frappe.db.commit()
+
+    applied = len(failed)
+    for name, values in changes.items():
+        if name not in failed and _apply_with_effects(name, values):
+            applied += 1
+    return applied
+
+
+def _apply_with_effects(name, values):
+    """Cambia el estado con hooks y documento relacionado, en su propia transacción de BD"""
+    from gateway_usp.api.payment_controller import set_transaction_status
+
+    values = dict(values)
+    status = values.pop("status")
+    try:
+        transaction = frappe.get_doc(DOCTYPE, name, for_update=True)
+        if transaction.status != "Pending":
+            # Un webhook la resolvió mientras se consultaba el gateway
+            return False
+        set_transaction_status(transaction, status, values)
+        frappe.db.commit()
+        return True
+    except Exception as e:
+        # Se descartan también las notificaciones encoladas; la fila sigue Pending para otra pasada
+        frappe.db.rollback()
+        inc("usp_reconciliation_events_total", outcome="apply_error")
+        frappe.log_error(f"Error aplicando {status} a {name}: {str(e)}", "USP Reconciliation")
+        return False
+
+
+def run_reconciliation(time_budget=None):
+    """
+    Concilia transacciones Pending contra la evidencia local y, si hay resolver, el gateway
+
+    Avanza por páginas y guarda el checkpoint después de cada una; si se agota el tiempo,
+    la siguiente corrida continúa desde ahí. Al llegar al final el checkpoint se reinicia.
+    """
+    started = time.monotonic()
+    deadline = started + float(time_budget or _conf("usp_reconciliation_time_budget"))
+    cutoff = frappe.utils.add_to_date(frappe.utils.now_datetime(),
+                                      minutes=-int(_conf("usp_reconciliation_min_age_minutes")))
+    page_size = int(_conf("usp_reconciliation_page_size"))
+    resolver = _get_resolver()
+
+    stats = {"scanned": 0, "updated": 0, "unresolved": 0, "pages": 0, "completed_pass": False}
+    checkpoint = load_checkpoint()
+
+    while time.monotonic() < deadline:
+        rows = next_page(checkpoint, cutoff, page_size)
+        if not rows:
+            checkpoint = None
+            stats["completed_pass"] = True
+            break
+
+        changes = {}
+        remote_rows = []
+        for row in rows:
+            change = resolve_locally(row)
+            if change:
+                changes[row.name] = change
+            else:
+                remote_rows.append(row)
+
+        if resolver and remote_rows:
+            results = asyncio.run(_resolve_remote(remote_rows, resolver, deadline))
+            for row, change in zip(remote_rows, results):
+                if change and change.get("status") in STATUSES and change["status"] != "Pending":
+                    changes[row.name] = change
+
+        updated = apply_changes(changes)
+
+        stats["pages"] += 1
+        stats["scanned"] += len(rows)
+        stats["updated"] += updated
+        stats["unresolved"] += len(rows) - updated
+        inc("usp_reconciliation_events_total", updated, outcome="updated")
+        inc("usp_reconciliation_events_total", len(rows) - updated, outcome="unresolved")
+
+        checkpoint = (rows[-1].created_at, rows[-1].name)
+        save_checkpoint(checkpoint)
+        frappe.db.commit()
+
+    save_checkpoint(checkpoint)
+    frappe.db.commit()
+
+    stats["elapsed_s"] = round(time.monotonic() - started, 2)
+    return stats
+
+
+@frappe.whitelist()
+def reset_reconciliation_checkpoint():
+    """Reinicia la conciliación desde la transacción Pending más antigua"""
+    frappe.only_for("System Manager")
+    save_checkpoint(None)
+    return {"success": True}
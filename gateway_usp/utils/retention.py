@@ -0,0 +1,145 @@
+# gateway_usp/utils/retention.py
+
+import gzip
+import json
+import os
+import time
+
+import frappe
+
+from .payload_store import delete_payloads, get_payloads
+
+DOCTYPE = "USP Transaction"
+
+DEFAULTS = {
+    "usp_retention_days": 90,
+    "usp_retention_chunk_size": 500,        # filas por DELETE (bloqueos cortos)
+    "usp_retention_sleep": 0.2,             # pausa entre lotes para dejar pasar los inserts del checkout
+    "usp_retention_time_budget": 900,       # segundos por corrida; el resto queda para mañana
+}
+
+# Solo se archivan transacciones terminadas sin efecto contable
+RETENTION_STATUSES = ("Cancelled", "Failed")
+
+
+def _conf(key):
+    value = frappe.conf.get(key)
+    return DEFAULTS[key] if value is None else value
+
+
+def archive_dir():
+    path = frappe.get_site_path("private", "files", "usp_archive")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _cutoff(days):
+    return frappe.utils.add_days(frappe.utils.now(), -int(days))
+
+
+def count_expired(days=None):
+    """Filas que la retención archivaría y borraría (dry run)"""
+    cutoff = _cutoff(days or _conf("usp_retention_days"))
+    row = frappe.db.sql("""
+        SELECT COUNT(*) AS total, MIN(created_at) AS oldest, MAX(created_at) AS newest
+        FROM `tabUSP Transaction`
+        WHERE created_at < %(cutoff)s AND status IN %(statuses)s
+    """, {"cutoff": cutoff, "statuses": RETENTION_STATUSES}, as_dict=True)[0]
+    return {
+        "dry_run": True,
+        "cutoff": str(cutoff),
+        "rows": row.total,
+        "oldest": str(row.oldest) if row.oldest else None,
+        "newest": str(row.newest) if row.newest else None
+    }
+
+
+def _next_chunk(cutoff, after_name, chunk_size):
+    return frappe.db.sql("""
+        SELECT *
+        FROM `tabUSP Transaction`
+        WHERE name > %(after_name)s AND created_at < %(cutoff)s AND status IN %(statuses)s
+        ORDER BY name
+        LIMIT %(limit)s
+    """, {
+        "after_name": after_name,
+        "cutoff": cutoff,
+        "statuses": RETENTION_STATUSES,
+        "limit": chunk_size
+    }, as_dict=True)
+
+
+def run_retention(days=None, dry_run=False, time_budget=None):
+    """
+    Archiva en gzip JSON Lines y borra en lotes las transacciones vencidas
+
+    Cada lote se escribe y sincroniza al archivo antes de borrarse, recorriendo la
+    tabla por llave primaria; entre lotes hay commit y una pausa.
+    """
+    days = days or _conf("usp_retention_days")
+    if dry_run:
+        return count_expired(days)
+
+    cutoff = _cutoff(days)
+    chunk_size = int(_conf("usp_retention_chunk_size"))
+    pause = float(_conf("usp_retention_sleep"))
+    started = time.monotonic()
+    deadline = started + float(time_budget or _conf("usp_retention_time_budget"))
+
+    path = os.path.join(archive_dir(), f"usp_transactions_{frappe.utils.now_datetime():%Y%m%d_%H%M%S}.jsonl.gz")
+    report = {"archive_file": None, "rows": 0, "chunks": 0, "lock_ms_total": 0.0, "lock_ms_max": 0.0,
+              "finished": False}
+
+    after_name = ""
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+        while time.monotonic() < deadline:
+            rows = _next_chunk(cutoff, after_name, chunk_size)
+            if not rows:
+                report["finished"] = True
+                break
+
+            names = [row.name for row in rows]
+            # El archivo guarda los payloads descomprimidos junto a la transacción, como antes
+            payloads = get_payloads(names)
+            for row in rows:
+                row.update(payloads.get(row.name) or {})
+                archive.write(json.dumps(row, default=str, separators=(",", ":")).encode())
+                archive.write(b"\n")
+            # El lote debe estar en disco antes de borrarlo de la BD
+            archive.flush()
+            raw.flush()
+            os.fsync(raw.fileno())
+
+            lock_started = time.monotonic()
+            delete_payloads(names)
+            frappe.db.delete(DOCTYPE, {"name": ("in", names)})
+            frappe.db.commit()
+            lock_ms = (time.monotonic() - lock_started) * 1000
+
+            report["rows"] += len(rows)
+            report["chunks"] += 1
+            report["lock_ms_total"] += lock_ms
+            report["lock_ms_max"] = max(report["lock_ms_max"], lock_ms)
+            after_name = names[-1]
+
+            if len(rows) < chunk_size:
+                report["finished"] = True
+                break
+            time.sleep(pause)
+
+    if report["rows"]:
+        report["archive_file"] = os.path.relpath(path, frappe.get_site_path())
+        report["archive_bytes"] = os.path.getsize(path)
+    else:
+        os.remove(path)
+
+    elapsed = time.monotonic() - started
+    report["elapsed_s"] = round(elapsed, 2)
+    report["rows_per_second"] = round(report["rows"] / elapsed, 1) if elapsed else 0.0
+    report["lock_ms_avg"] = round(report["lock_ms_total"] / report["chunks"], 1) if report["chunks"] else 0.0
+    report["lock_ms_total"] = round(report["lock_ms_total"], 1)
+    report["lock_ms_max"] = round(report["lock_ms_max"], 1)
+
+    from .audit import audit
+    audit("retention_run", report)
+    return report